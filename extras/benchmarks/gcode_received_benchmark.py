@@ -0,0 +1,118 @@
+# coding=utf-8
+# pylint: disable=invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+"""
+Replays recorded serial logs through the octoprint.comm.protocol.gcode.received hook of the
+plugin and reports the overhead per received line (ns/line) on OctoPrint's comm thread.
+
+Usage (from the repository root, in the Python environment OctoPrint is installed in):
+
+    python extras/benchmarks/gcode_received_benchmark.py [--repeat N] [log file ...]
+
+Without log files the bundled Marlin and Klipper logs in extras/benchmarks/logs are replayed.
+Lines may be taken as is from serial.log, a leading "Recv: " (and the timestamp before it) is stripped.
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+# pylint: disable=wrong-import-position
+from octoprint_calibration import CalibrationPlugin
+from octoprint_calibration.calib_tools import EStepsCalibrationTool, PidAutotuneTool
+from octoprint_calibration.tool_registry import ToolRegistry
+
+DEFAULT_LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+
+
+class BenchmarkPluginInstance(object):
+    # Stands in for the CalibrationPlugin the tool reports to, pushing state updates is not benchmarked
+
+    def isOperational(self):
+        return True
+
+    def getExtruderCount(self):
+        return 1
+
+    def hasHeatedBed(self):
+        return True
+
+    def sendPluginMessage(self, data):
+        pass
+
+
+def loadLog(path):
+    lines = []
+    with open(path, encoding="utf-8", errors="replace") as logFile:
+        for line in logFile:
+            line = line.rstrip("\r\n")
+            if "Recv: " in line:
+                line = line.split("Recv: ", 1)[1]
+            elif " - Send: " in line or " - Changing monitoring state" in line:
+                continue
+            lines.append(line)
+    return lines
+
+
+def createPlugin():
+    plugin = CalibrationPlugin()
+    toolRegistry = ToolRegistry(logging.getLogger("benchmark"))
+    tool = EStepsCalibrationTool(logging.getLogger("benchmark"))
+    # idle tools are registered as well, they must not add to the per-line cost
+    for registeredTool in (tool, PidAutotuneTool(logging.getLogger("benchmark"))):
+        registeredTool.initialize(BenchmarkPluginInstance(), None, None, None)
+        toolRegistry.register(registeredTool)
+    # pylint: disable=attribute-defined-outside-init,protected-access
+    plugin._toolRegistry = toolRegistry
+    return plugin, tool
+
+
+def setToolState(tool, state):
+    # pylint: disable=protected-access
+    tool._getSession(0).state = state
+    tool._updateSerialSubscriptions()
+
+
+def replay(plugin, lines, repeat):
+    hook = plugin.on_printer_gcode_received
+    start = time.perf_counter_ns()
+    for _ in range(repeat):
+        for line in lines:
+            hook(None, line)
+    return (time.perf_counter_ns() - start) / (repeat * len(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000, help="number of times each log is replayed")
+    parser.add_argument("logs", nargs="*", help="serial logs to replay")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logPaths = args.logs or sorted(glob.glob(os.path.join(DEFAULT_LOG_DIR, "*.log")))
+
+    plugin, tool = createPlugin()
+    print("%-30s %-30s %10s %12s" % ("log", "tool state", "lines", "ns/line"))
+    for logPath in logPaths:
+        lines = loadLog(logPath)
+        if not lines:
+            continue
+        # A line answering the awaited command would switch the state, the benchmark measures the
+        # per-line cost while waiting, therefore those lines are left out for the waiting state.
+        # pylint: disable=protected-access
+        m92Matcher = tool._getSerialMatcher(frozenset([EStepsCalibrationTool.State.WAITING_FOR_M92_ANSWER]))
+        scenarios = [
+            (EStepsCalibrationTool.State.IDLE, lines),
+            (EStepsCalibrationTool.State.WAITING_FOR_M92_ANSWER, [line for line in lines if not m92Matcher.search(line)]),
+        ]
+        for state, scenarioLines in scenarios:
+            setToolState(tool, state)
+            nsPerLine = replay(plugin, scenarioLines, args.repeat)
+            print("%-30s %-30s %10d %12.1f" % (os.path.basename(logPath), state.name, len(scenarioLines), nsPerLine))
+
+
+if __name__ == "__main__":
+    main()
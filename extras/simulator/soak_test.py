@@ -0,0 +1,406 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+"""
+Load/soak test of the e steps calibration state machine against the virtual printer (virtual_printer.py).
+
+One driver thread per extruder runs complete calibrations (calibrateESteps, startExtruding,
+eStepsMeasured, saveNewESteps) like a user in the frontend would, waiting for the state updates
+pushed by the tool after every command. Afterwards throughput, latency per phase, thread counts
+and all detected problems are reported:
+
+- timeouts: the tool did not reach the expected state in time (e.g. lost reply, race condition)
+- errors: error messages pushed by the tool (e.g. preheat timeout of a stuck heater)
+- early extrusion ends: the tool considered the extrusion finished while the printer was still extruding
+- wrong results: the new e steps do not match the ones the virtual extruder really needs
+
+With --iterative the calibrations apply the estimated e steps and extrude again until the estimate
+converges, --measurement-noise adds the error of a user measuring with a ruler. With --quick-verify
+every calibration after the first one of an extruder is a quick verification (short extrusion, needs
+the filament history of the database).
+
+Usage (from the repository root, in the Python environment OctoPrint is installed in):
+
+    python extras/simulator/soak_test.py [--sessions N] [--extruders N] [--speedup N] [--drop-probability P] ...
+
+The exit code is 1 if more problems than --max-problems were detected, so it can be run in CI.
+"""
+import argparse
+import collections
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import peewee
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=wrong-import-position
+from octoprint_calibration.calib_tools import EStepsCalibrationTool
+from octoprint_calibration.database_manager import DatabaseManager
+from octoprint_calibration.models import EStepsCalibrationModel, EStepsCalibrationPassModel, EStepsSessionTraceModel
+from octoprint_calibration.tool_registry import ToolRegistry
+from virtual_printer import VirtualPrinter, VirtualPrinterConfig
+
+State = EStepsCalibrationTool.State
+
+# Phases of a calibration: name, command starting it and the state ending it
+PHASES = [
+    ("m92+preheat", "calibrateESteps", State.WAITING_FOR_EXTRUDE_START),
+    ("extrusion", "startExtruding", State.WAITING_FOR_MEASUREMENT_INPUT),
+    ("measurement", "eStepsMeasured", State.WAITING_FOR_USER_CONFIRM),
+    ("save", "saveNewESteps", State.IDLE),
+]
+
+
+class SoakPluginInstance(object):
+    # Stands in for the CalibrationPlugin, collects the messages pushed by the tool per extruder
+
+    def __init__(self, extruderCount):
+        self._extruderCount = extruderCount
+        self._condition = threading.Condition()
+        # tool index -> list of (monotonic time, state) in the order they were pushed
+        self._states = collections.defaultdict(list)
+        self._errors = collections.defaultdict(list)
+        # tool index -> last new e steps pushed
+        self._newESteps = {}
+        # tool index -> length (mm) above the extruder entry the filament is marked at
+        self._markLengths = {}
+        # incremented whenever a stuck session forces a reset of all sessions
+        self.resetCount = 0
+
+    def isOperational(self):
+        return True
+
+    def getExtruderCount(self):
+        return self._extruderCount
+
+    # like OctoPrint after connecting, extruding tools are switched back to the first one (see _extrudeFilament)
+    def getActiveTool(self):
+        return 0
+
+    def sendPluginMessage(self, data):
+        with self._condition:
+            toolIndex = data.get("toolIndex")
+            if data["type"] == "stateUpdate" and "eStepsToolState" in data["data"]:
+                self._states[toolIndex].append((time.monotonic(), State(int(data["data"]["eStepsToolState"]))))
+            if data["type"] == "stateUpdate" and "newEsteps" in data["data"]:
+                self._newESteps[toolIndex] = float(data["data"]["newEsteps"])
+            if data["type"] == "stateUpdate" and "markLength" in data["data"]:
+                self._markLengths[toolIndex] = float(data["data"]["markLength"])
+            elif data["type"] == "error":
+                self._errors[toolIndex].append(data["message"])
+            self._condition.notify_all()
+
+    def getNewESteps(self, toolIndex):
+        with self._condition:
+            return self._newESteps.get(toolIndex)
+
+    def getMarkLength(self, toolIndex):
+        with self._condition:
+            return self._markLengths.get(toolIndex)
+
+    def lastState(self, toolIndex):
+        with self._condition:
+            return self._states[toolIndex][-1][1] if self._states[toolIndex] else None
+
+    def resetTool(self, toolIndex):
+        with self._condition:
+            self._states[toolIndex] = []
+            self._errors[toolIndex] = []
+
+    # Returns (time the state was reached, None) or (None, problem) if it was not reached within timeout.
+    # states is a state or a tuple of states of which any ends the wait.
+    def waitForState(self, toolIndex, states, timeout):
+        states = states if isinstance(states, tuple) else (states,)
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if self._errors[toolIndex]:
+                    return None, "error: " + self._errors[toolIndex][0]
+                for reachedAt, reachedState in self._states[toolIndex]:
+                    if reachedState in states:
+                        return reachedAt, None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    lastState = self._states[toolIndex][-1][1].name if self._states[toolIndex] else "no state update"
+                    return None, "timeout: waited for %s, last state %s" % (" or ".join(state.name for state in states), lastState)
+                self._condition.wait(remaining)
+
+
+class SoakSettings(object):
+    # Stands in for the plugin settings
+
+    def __init__(self, values):
+        self._values = values
+
+    def get_int(self, path):
+        return int(self._values[path[0]])
+
+    def get_float(self, path):
+        return float(self._values[path[0]])
+
+
+class SoakStatistics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phaseLatencies = collections.defaultdict(list)
+        self.problems = collections.Counter()
+        self.problemExamples = {}
+        self.completedSessions = 0
+        # number of passes of the completed sessions
+        self.passCounts = collections.Counter()
+        self.maxThreadCount = threading.active_count()
+
+    def addLatency(self, phase, seconds):
+        with self._lock:
+            self.phaseLatencies[phase].append(seconds)
+
+    def addProblem(self, kind, details):
+        with self._lock:
+            self.problems[kind] += 1
+            self.problemExamples.setdefault(kind, details)
+
+    def addCompletedSession(self, passCount):
+        with self._lock:
+            self.completedSessions += 1
+            self.passCounts[passCount] += 1
+
+    def sampleThreadCount(self):
+        with self._lock:
+            self.maxThreadCount = max(self.maxThreadCount, threading.active_count())
+
+
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return float("nan")
+    index = min(len(sortedValues) - 1, int(round(fraction * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+
+def waitForFilamentHistory(databaseManager, filamentName, filamentType, timeout):
+    deadline = time.monotonic() + timeout
+    while databaseManager.loadFilamentHistory(filamentName, filamentType) is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def runSessions(toolIndex, sessionCount, tool, plugin, printer, databaseManager, statistics, args):
+    # every phase may take at most this long, in simulated seconds
+    timeout = args.phase_timeout / args.speedup
+    rng = random.Random(None if args.seed is None else args.seed + toolIndex)
+    for sessionNumber in range(sessionCount):
+        printer.takeExtrudedLength(toolIndex)
+        failedInState = None
+        passCount = 0
+        phaseIndex = 0
+        while phaseIndex < len(PHASES):
+            phase, commandName, endState = PHASES[phaseIndex]
+            if commandName == "calibrateESteps":
+                if args.quick_verify and sessionNumber > 0:
+                    # the previous calibration is stored in the background, a user would not be that fast
+                    waitForFilamentHistory(databaseManager, "Soak %d" % toolIndex, "PLA", timeout)
+                command = dict(command=commandName, filamentName="Soak %d" % toolIndex, filamentType=dict(name="PLA"), \
+                    hotendTemp=args.hotend_temp, iterative=args.iterative, quickVerify=args.quick_verify and sessionNumber > 0)
+            elif commandName == "eStepsMeasured":
+                # measurement the user would take: the filament was marked as told by the tool, the remaining length is measured
+                measurement = plugin.getMarkLength(toolIndex) - printer.takeExtrudedLength(toolIndex) + rng.gauss(0.0, args.measurement_noise)
+                command = dict(command=commandName, measurement="%.3f" % measurement)
+                passCount += 1
+            else:
+                command = dict(command=commandName)
+            command["tool"] = toolIndex
+            # an iterative calibration continues with the next pass until the estimate converged
+            endStates = (endState, State.WAITING_FOR_EXTRUDE_START) if commandName == "eStepsMeasured" and args.iterative else endState
+            plugin.resetTool(toolIndex)
+            resetCount = plugin.resetCount
+            startedAt = time.monotonic()
+            success, reason = tool.handleApiCommand(command["command"], command)
+            if not success:
+                statistics.addProblem("rejected command", "tool %d, session %d: %s" % (toolIndex, sessionNumber, reason))
+                failedInState = State.IDLE
+                break
+            reachedAt, problem = plugin.waitForState(toolIndex, endStates, timeout)
+            statistics.sampleThreadCount()
+            if problem is not None:
+                # the problem of another extruder's session might have caused this one
+                kind = "aborted by reset" if plugin.resetCount != resetCount else problem.split(":")[0]
+                statistics.addProblem(kind, "tool %d, session %d, phase %s: %s" % (toolIndex, sessionNumber, phase, problem))
+                # without any state update the session is still in the state before the command, which can be restarted
+                failedInState = plugin.lastState(toolIndex) or State.IDLE
+                break
+            # latencies are reported in simulated seconds
+            statistics.addLatency(phase, (reachedAt - startedAt) * args.speedup)
+            if phase == "extrusion" and printer.isMoving(toolIndex):
+                statistics.addProblem("early extrusion end", "tool %d, session %d: measurement requested while the extruder was still moving" % (toolIndex, sessionNumber))
+                # the user would wait for the extruder before measuring
+                while printer.isMoving(toolIndex):
+                    time.sleep(0.001)
+            if commandName == "eStepsMeasured" and plugin.lastState(toolIndex) == State.WAITING_FOR_EXTRUDE_START:
+                phaseIndex = [command for _, command, _ in PHASES].index("startExtruding")
+            else:
+                phaseIndex += 1
+        if failedInState is not None:
+            # a stuck session is restarted with the next calibrateESteps, except while it waits for the
+            # extrusion to finish, then only a reset of all sessions (like on disconnect) helps
+            if failedInState == State.WAITING_FOR_EXTRUDE_FINISHED:
+                plugin.resetCount += 1
+                tool.handlePrinterDisconnected()
+                plugin.waitForState(toolIndex, State.IDLE, timeout)
+            continue
+
+        expectedESteps = args.actual_esteps
+        newESteps = plugin.getNewESteps(toolIndex)
+        if newESteps is None or abs(newESteps - expectedESteps) > args.esteps_tolerance:
+            statistics.addProblem("wrong result", "tool %d, session %d: new e steps %s instead of %.2f" % (toolIndex, sessionNumber, newESteps, expectedESteps))
+        statistics.addCompletedSession(passCount)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=200, help="number of calibrations per extruder")
+    parser.add_argument("--extruders", type=int, default=2, help="number of extruders calibrated in parallel")
+    parser.add_argument("--speedup", type=float, default=1000.0, help="factor the simulated printer runs faster than real time")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds until the printer answers a command")
+    parser.add_argument("--latency-jitter", type=float, default=0.03, help="random additional latency in seconds")
+    parser.add_argument("--drop-probability", type=float, default=0.0, help="probability a reply line of the printer is lost")
+    parser.add_argument("--stuck-heater-probability", type=float, default=0.0, help="probability a hotend does not reach its target temperature")
+    parser.add_argument("--auto-report-temperatures", action="store_true", help="temperatures are auto reported (M155) instead of polled (M105)")
+    parser.add_argument("--hotend-temp", type=int, default=210)
+    parser.add_argument("--configured-esteps", type=float, default=93.0, help="e steps the printer starts with")
+    parser.add_argument("--actual-esteps", type=float, default=97.0, help="e steps the virtual extruder really needs")
+    parser.add_argument("--esteps-tolerance", type=float, default=0.05)
+    parser.add_argument("--iterative", action="store_true", help="iterative calibrations (several passes until the estimate converges)")
+    parser.add_argument("--pass-tolerance", type=float, default=0.5, help="percent, see setting eStepsPassTolerance")
+    parser.add_argument("--max-passes", type=int, default=5, help="see setting eStepsMaxPasses")
+    parser.add_argument("--quick-verify", action="store_true", help="calibrations after the first one of an extruder are quick verifications")
+    parser.add_argument("--measurement-noise", type=float, default=0.0, help="standard deviation (mm) of the measurements of the remaining filament")
+    parser.add_argument("--phase-timeout", type=float, default=1500.0, help="simulated seconds a phase may take at most, must be above the preheat timeout")
+    parser.add_argument("--preheat-timeout", type=float, default=600.0, help="simulated seconds, see setting preheatTimeout")
+    parser.add_argument("--inactivity-timeout", type=float, default=1800.0, help="simulated seconds, see setting eStepsInactivityTimeout")
+    parser.add_argument("--no-database", action="store_true", help="do not store the calibrations in a (temporary) database")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--max-problems", type=int, default=0, help="exit code is 1 if more problems are detected")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.quick_verify and (args.iterative or args.no_database):
+        parser.error("--quick-verify cannot be combined with --iterative or --no-database")
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    logger = logging.getLogger("soak")
+    # the tool logs every state switch
+    logging.getLogger("soak.EStepsCalibrationTool").setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+    config = VirtualPrinterConfig()
+    config.extruderCount = args.extruders
+    config.configuredESteps = args.configured_esteps
+    config.actualESteps = args.actual_esteps
+    config.latency = args.latency
+    config.latencyJitter = args.latency_jitter
+    config.pollTemperatures = not args.auto_report_temperatures
+    config.dropReplyProbability = args.drop_probability
+    config.stuckHeaterProbability = args.stuck_heater_probability
+    config.speedup = args.speedup
+    config.seed = args.seed
+
+    threadCountBefore = threading.active_count()
+    plugin = SoakPluginInstance(args.extruders)
+    # the tool measures phases and heating curves in simulated seconds
+    tool = EStepsCalibrationTool(logger, clock=lambda: time.monotonic() * args.speedup)
+    # received lines and temperatures are routed by the registry like by the plugin's hooks
+    toolRegistry = ToolRegistry(logger)
+
+    def onLine(comm, line):
+        for handler in toolRegistry.lineHandlers:
+            handler(comm, line)
+
+    def onTemperatures(parsedTemps):
+        for handler in toolRegistry.temperatureHandlers:
+            handler(parsedTemps)
+
+    printer = VirtualPrinter(config, onLine, onTemperatures, logger)
+
+    databaseManager = None
+    databaseDir = None
+    if not args.no_database:
+        databaseDir = tempfile.mkdtemp(prefix="calibration_soak_")
+        databaseManager = DatabaseManager(logger)
+        databaseManager.initialize(databaseDir, dict(journalMode="wal", synchronous="normal", cacheSizeKiB=2048, mmapSizeMiB=16))
+    else:
+        databaseManager = NullDatabaseManager()
+
+    # the preheat and inactivity timeouts are timers of the tool, they run in real time
+    tool.initialize(plugin, databaseManager, printer, SoakSettings(dict(preheatTimeout=max(1, round(args.preheat_timeout / args.speedup)), \
+        eStepsInactivityTimeout=max(1, round(args.inactivity_timeout / args.speedup)), eStepsPassTolerance=args.pass_tolerance, eStepsMaxPasses=args.max_passes)))
+    toolRegistry.register(tool)
+    printer.start()
+
+    statistics = SoakStatistics()
+    drivers = [threading.Thread(target=runSessions, name="SoakDriver%d" % toolIndex,
+        args=(toolIndex, args.sessions, tool, plugin, printer, databaseManager, statistics, args)) for toolIndex in range(args.extruders)]
+    startedAt = time.monotonic()
+    for driver in drivers:
+        driver.start()
+    for driver in drivers:
+        driver.join()
+    elapsed = time.monotonic() - startedAt
+
+    threadCountDuring = statistics.maxThreadCount
+    tool.shutdown()
+    printer.stop()
+    if databaseDir is not None:
+        # shutdown waits for the pending asynchronous writes
+        databaseManager.shutdown()
+        databaseManager = DatabaseManager(logger)
+        databaseManager.initialize(databaseDir, dict(journalMode="wal", synchronous="normal", cacheSizeKiB=2048, mmapSizeMiB=16))
+        storedCalibrations = EStepsCalibrationModel.select().count()
+        storedTraces = EStepsSessionTraceModel.select().count()
+        traceBytes = EStepsSessionTraceModel.select(peewee.fn.SUM(peewee.fn.LENGTH(EStepsSessionTraceModel.samples) + \
+            peewee.fn.LENGTH(EStepsSessionTraceModel.events))).scalar() or 0
+        storedPasses = EStepsCalibrationPassModel.select().count()
+        traceSamples = EStepsSessionTraceModel.select(peewee.fn.SUM(EStepsSessionTraceModel.sampleCount)).scalar() or 0
+        databaseManager.shutdown()
+        shutil.rmtree(databaseDir, ignore_errors=True)
+
+    totalSessions = args.sessions * args.extruders
+    print("sessions:          %d of %d completed in %.1f s (%.1f sessions/s)" % (statistics.completedSessions, totalSessions, elapsed, statistics.completedSessions / elapsed))
+    print("printer:           %d commands received, %d reply lines dropped" % (printer.receivedCommands, printer.droppedLines))
+    if databaseDir is not None:
+        print("database:          %d calibrations stored (%d passes), %d session traces (%d samples, %.0f bytes per trace)" % \
+            (storedCalibrations, storedPasses, storedTraces, traceSamples, traceBytes / max(1, storedTraces)))
+    print("passes:            %s" % ", ".join("%d x %d" % (count, passCount) for passCount, count in sorted(statistics.passCounts.items())))
+    print("threads:           %d before, at most %d during the test (drivers: %d)" % (threadCountBefore, threadCountDuring, len(drivers)))
+    print()
+    print("%-15s %8s %12s %12s %12s %12s" % ("phase (sim. s)", "count", "p50", "p95", "p99", "max"))
+    for phase, _, _ in PHASES:
+        latencies = sorted(statistics.phaseLatencies[phase])
+        print("%-15s %8d %12.3f %12.3f %12.3f %12.3f" % (phase, len(latencies), percentile(latencies, 0.5), \
+            percentile(latencies, 0.95), percentile(latencies, 0.99), latencies[-1] if latencies else float("nan")))
+    print()
+    problemCount = sum(statistics.problems.values())
+    print("problems:          %d" % problemCount)
+    for kind, count in statistics.problems.most_common():
+        print("  %-22s %6d   e.g. %s" % (kind, count, statistics.problemExamples[kind]))
+
+    sys.exit(1 if problemCount > args.max_problems else 0)
+
+
+class NullDatabaseManager(object):
+    # Used with --no-database, the calibrations are dropped
+
+    def insertEstepsCalibration(self, eStepsCalibrationModel, phaseTimings=None, sessionTrace=None, passes=None):
+        pass
+
+    def insertPhaseTimings(self, phaseTimings, sessionTrace=None, passes=None):
+        pass
+
+    def loadFilamentHistory(self, filamentName, filamentType):
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+# Virtual printer standing in for OctoPrint's printer (octoprint.printer.PrinterInterface) in local tests
+# of the calibration tools. Only the parts used by the tools are modelled:
+#
+# - commands() and set_temperature() are processed by a simulated firmware thread, one command after
+#   another with a configurable latency, replies ("echo: M92 ...", "ok", ...) are passed to lineHandler
+#   like OctoPrint's comm thread passes received lines to the gcode received hook
+# - moves are executed by a simulated planner: like Marlin the "ok" of a G1 is sent as soon as the move
+#   is queued, the move itself takes length / feed rate, M400 waits for all moves to finish
+# - hotend temperatures follow a first order thermal model, temperatures are reported as
+#   "ok T:... @:..." lines (OctoPrint polls them with M105) to lineHandler and afterwards to
+#   temperatureHandler (like the temperatures received hook)
+# - faults: dropped reply lines, latency jitter and heaters that never reach their target
+#
+# All durations are divided by speedup, so e.g. a 120 s extrusion takes 0.12 s with speedup 1000.
+import logging
+import math
+import queue
+import random
+import re
+import threading
+import time
+
+
+class VirtualPrinterConfig(object):
+    def __init__(self):
+        self.extruderCount = 1
+        # e steps reported by M92 (configured in the firmware) and the ones the extruder really needs
+        self.configuredESteps = 93.0
+        self.actualESteps = 97.0
+        # seconds until a command is answered and random additional seconds on top
+        self.latency = 0.005
+        self.latencyJitter = 0.005
+        # thermal model: hotend approaches its target with this time constant (s)
+        self.ambientTemperature = 25.0
+        self.thermalTimeConstant = 40.0
+        self.temperatureNoise = 0.3
+        # interval (s) of temperature reports
+        self.temperatureInterval = 2.0
+        # True: temperatures are polled with M105 ("ok T:..." lines), False: auto reported with M155 ("T:..." lines)
+        self.pollTemperatures = True
+        # fault injection, probabilities per reply line / per heat up
+        self.dropReplyProbability = 0.0
+        self.stuckHeaterProbability = 0.0
+        # a stuck heater stays this many degrees below its target
+        self.stuckHeaterOffset = 20.0
+        self.speedup = 1.0
+        self.seed = None
+
+
+class VirtualPrinter(object):
+    _STOP = object()
+
+    def __init__(self, config, lineHandler, temperatureHandler=None, parentLogger=None):
+        parentLogger = parentLogger or logging.getLogger("simulator")
+        self._logger = logging.getLogger(parentLogger.name + "." + self.__class__.__name__)
+        self._config = config
+        self._lineHandler = lineHandler
+        self._temperatureHandler = temperatureHandler
+        self._random = random.Random(config.seed)
+        self._lock = threading.Lock()
+        # received lines are passed on one at a time, like by OctoPrint's comm thread
+        self._sendLock = threading.Lock()
+        self._commandQueue = queue.Queue()
+        self._stopped = threading.Event()
+
+        extruderCount = config.extruderCount
+        self._eSteps = [config.configuredESteps] * extruderCount
+        self._actualTemps = [config.ambientTemperature] * extruderCount
+        self._targetTemps = [0.0] * extruderCount
+        self._stuckHeaters = [False] * extruderCount
+        self._activeTool = 0
+        self._relativeMoves = False
+        # filament really extruded per tool (mm), with the actual e steps of the extruder
+        self._extruded = [0.0] * extruderCount
+        # monotonic time the planner finishes its last queued move, the same per tool and number of moves
+        # per tool sent but not yet planned (the tool of a sent move is tracked by _sentActiveTool)
+        self._plannerBusyUntil = 0.0
+        self._toolBusyUntil = [0.0] * extruderCount
+        self._pendingMoves = [0] * extruderCount
+        self._sentActiveTool = 0
+        # like OctoPrint, temperatures are only polled again after the last poll was answered
+        self._temperaturePollPending = False
+        self.receivedCommands = 0
+        self.droppedLines = 0
+
+        self._firmwareThread = threading.Thread(target=self._runFirmware, name="VirtualPrinterFirmware")
+        self._firmwareThread.daemon = True
+        self._thermalThread = threading.Thread(target=self._runThermal, name="VirtualPrinterThermal")
+        self._thermalThread.daemon = True
+
+    def start(self):
+        self._firmwareThread.start()
+        self._thermalThread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._commandQueue.put(VirtualPrinter._STOP)
+        self._firmwareThread.join()
+        self._thermalThread.join()
+
+    ##~~ PrinterInterface subset used by the calibration tools
+
+    def commands(self, commands, tags=None, force=False):
+        # pylint: disable=unused-argument
+        if isinstance(commands, str):
+            commands = [commands]
+        for command in commands:
+            toolMatch = re.match(r"T(\d+)\s*$", command, re.IGNORECASE)
+            if toolMatch is not None:
+                self._sentActiveTool = int(toolMatch.group(1))
+            elif re.match(r"G[01]\b.*\bE", command, re.IGNORECASE):
+                with self._lock:
+                    self._pendingMoves[self._sentActiveTool] += 1
+            self._commandQueue.put(command)
+
+    def set_temperature(self, heater, value, tags=None):
+        # pylint: disable=unused-argument
+        self.commands("M104 T%d S%d" % (int(heater[len("tool"):]), value))
+
+    def get_current_temperatures(self):
+        with self._lock:
+            return {"tool%d" % toolIndex: dict(actual=self._actualTemps[toolIndex], target=self._targetTemps[toolIndex]) \
+                for toolIndex in range(self._config.extruderCount)}
+
+    def is_operational(self):
+        return not self._stopped.is_set()
+
+    ##~~ Introspection for test harnesses
+
+    # Filament (mm) extruded by the tool since the last call
+    def takeExtrudedLength(self, toolIndex):
+        with self._lock:
+            extruded = self._extruded[toolIndex]
+            self._extruded[toolIndex] = 0.0
+            return extruded
+
+    # True while a sent move of the tool has not been executed completely
+    def isMoving(self, toolIndex):
+        with self._lock:
+            return self._pendingMoves[toolIndex] > 0 or time.monotonic() < self._toolBusyUntil[toolIndex]
+
+    def getESteps(self, toolIndex):
+        with self._lock:
+            return self._eSteps[toolIndex]
+
+    ##################
+    ### Internal stuff
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            self._stopped.wait(seconds / self._config.speedup)
+
+    def _send(self, line):
+        if self._config.dropReplyProbability and self._random.random() < self._config.dropReplyProbability:
+            self.droppedLines += 1
+            self._logger.debug("Dropping reply line '%s'", line)
+            return
+        with self._sendLock:
+            self._lineHandler(None, line)
+
+    def _runFirmware(self):
+        while True:
+            command = self._commandQueue.get()
+            if command is VirtualPrinter._STOP:
+                return
+            self.receivedCommands += 1
+            self._sleep(self._config.latency + self._random.random() * self._config.latencyJitter)
+            try:
+                reply = self._processCommand(command.strip())
+            except Exception as e:
+                self._logger.exception("Error while processing '%s': %s", command, str(e))
+                self._send("Error:%s" % str(e))
+                reply = "ok"
+            if reply is not None:
+                self._send(reply)
+
+    # Returns the final reply of the command, None if it was already sent
+    def _processCommand(self, command):
+        match = re.match(r"([GMT])(\d+)\s*(.*)", command, re.IGNORECASE)
+        if match is None:
+            return "ok"
+        letter, number, args = match.group(1).upper(), int(match.group(2)), match.group(3)
+        params = {key.upper(): value for key, value in re.findall(r"([A-Za-z])([-\d.]*)", args)}
+        toolIndex = int(params["T"]) if params.get("T") else self._activeTool
+
+        if letter == "T":
+            self._activeTool = number
+        elif (letter, number) == ("G", 90):
+            self._relativeMoves = False
+        elif (letter, number) == ("G", 91):
+            self._relativeMoves = True
+        elif (letter, number) in (("G", 0), ("G", 1)) and "E" in params:
+            self._queueExtrusion(float(params["E"]), float(params.get("F") or 1200.0))
+        elif (letter, number) == ("M", 400):
+            self._sleep((self._plannerBusyUntil - time.monotonic()) * self._config.speedup)
+        elif (letter, number) == ("M", 92):
+            self._processM92(params, toolIndex)
+        elif (letter, number) in (("M", 104), ("M", 109)):
+            self._setTarget(toolIndex, float(params.get("S") or 0.0))
+        elif (letter, number) == ("M", 118):
+            self._send("echo:" + re.sub(r"^(?:[EAP]\d\s+)*", "", args))
+        elif (letter, number) == ("M", 500):
+            self._send("echo:Settings Stored (%d bytes; crc %d)" % (606, self._random.randint(0, 65535)))
+        elif (letter, number) == ("M", 105):
+            self._temperaturePollPending = False
+            self._reportTemperatures("ok ")
+            return None
+        return "ok"
+
+    def _processM92(self, params, toolIndex):
+        if "E" in params and params["E"]:
+            with self._lock:
+                self._eSteps[toolIndex] = float(params["E"])
+            return
+        if self._config.extruderCount > 1:
+            self._send("echo: M92 T%d E%.2f" % (toolIndex, self._eSteps[toolIndex]))
+        else:
+            self._send("echo: M92 X80.00 Y80.00 Z400.00 E%.2f" % self._eSteps[toolIndex])
+
+    def _queueExtrusion(self, length, feedRate):
+        if not self._relativeMoves:
+            raise ValueError("Only relative extrusion is simulated")
+        toolIndex = self._activeTool
+        duration = abs(length) / (feedRate / 60.0) / self._config.speedup
+        now = time.monotonic()
+        with self._lock:
+            # the extruder moves the commanded steps, which is more or less filament depending on the actual e steps
+            self._extruded[toolIndex] += length * self._eSteps[toolIndex] / self._config.actualESteps
+            self._plannerBusyUntil = max(now, self._plannerBusyUntil) + duration
+            self._toolBusyUntil[toolIndex] = self._plannerBusyUntil
+            self._pendingMoves[toolIndex] -= 1
+
+    def _setTarget(self, toolIndex, target):
+        with self._lock:
+            if target > self._targetTemps[toolIndex]:
+                self._stuckHeaters[toolIndex] = self._random.random() < self._config.stuckHeaterProbability
+            self._targetTemps[toolIndex] = target
+
+    def _runThermal(self):
+        lastUpdate = time.monotonic()
+        while not self._stopped.is_set():
+            self._sleep(self._config.temperatureInterval)
+            now = time.monotonic()
+            elapsed = (now - lastUpdate) * self._config.speedup
+            lastUpdate = now
+            self._updateTemperatures(elapsed)
+            if self._config.pollTemperatures:
+                # answered by the firmware thread in between the other commands
+                if not self._temperaturePollPending:
+                    self._temperaturePollPending = True
+                    self.commands("M105")
+            else:
+                self._reportTemperatures()
+
+    def _updateTemperatures(self, elapsed):
+        config = self._config
+        factor = 1.0 - math.exp(-elapsed / config.thermalTimeConstant)
+        with self._lock:
+            for toolIndex in range(config.extruderCount):
+                target = self._targetTemps[toolIndex]
+                settleAt = max(target, config.ambientTemperature)
+                if self._stuckHeaters[toolIndex] and target > 0:
+                    settleAt = max(target - config.stuckHeaterOffset, config.ambientTemperature)
+                actual = self._actualTemps[toolIndex] + (settleAt - self._actualTemps[toolIndex]) * factor
+                self._actualTemps[toolIndex] = actual + self._random.gauss(0.0, config.temperatureNoise)
+
+    # Sends the temperature report line (with the given prefix) and passes the temperatures to temperatureHandler
+    # afterwards, like OctoPrint calls the gcode received hook before the temperatures received hook
+    def _reportTemperatures(self, prefix=""):
+        with self._lock:
+            parsedTemps = {"T%d" % toolIndex: (self._actualTemps[toolIndex], self._targetTemps[toolIndex]) \
+                for toolIndex in range(self._config.extruderCount)}
+        # heater power (0-127) like Marlin's "@:" values, full power far below the target
+        powers = [int(min(127, max(0, (target - actual) * 10 + target / 4))) if target > 0 else 0 \
+            for actual, target in parsedTemps.values()]
+        line = prefix + " ".join("%s:%.2f /%.2f" % (key, actual, target) for key, (actual, target) in parsedTemps.items())
+        if len(powers) > 1:
+            line += "".join(" @%d:%d" % (toolIndex, power) for toolIndex, power in enumerate(powers))
+        else:
+            line += " @:%d" % powers[0]
+        self._send(line)
+        if self._temperatureHandler is not None:
+            self._temperatureHandler(parsedTemps)
@@ -2,20 +2,29 @@
 # pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
 from __future__ import absolute_import
 
+import functools
+
 import flask
+import tornado.web
 
 import octoprint.plugin
 
-from octoprint_calibration.calib_tools import EStepsCalibrationTool
+from octoprint_calibration.calib_tools import EStepsCalibrationTool, PidAutotuneTool
+from octoprint_calibration.call_timer import CallTimer, timedCall
+from octoprint_calibration.database_maintenance import DatabaseMaintenance
 from octoprint_calibration.database_manager import DatabaseManager
 from octoprint_calibration.calibration_api import CalibrationAPI
+from octoprint_calibration.gcode_generator import CalibrationGcodeGenerator
+from octoprint_calibration.response_cache import ResponseCache
+from octoprint_calibration.tool_registry import ToolRegistry
 
 class CalibrationPlugin(CalibrationAPI,
                         octoprint.plugin.SettingsPlugin,
                         octoprint.plugin.AssetPlugin,
                         octoprint.plugin.TemplatePlugin,
                         octoprint.plugin.SimpleApiPlugin,
-                        octoprint.plugin.EventHandlerPlugin):
+                        octoprint.plugin.EventHandlerPlugin,
+                        octoprint.plugin.ShutdownPlugin):
 
     # pylint: disable=attribute-defined-outside-init
     def initialize(self):
@@ -23,11 +32,27 @@ class CalibrationPlugin(CalibrationAPI,
             self._connected = True
         else:
             self._connected = False
-
-        self._databaseManager = DatabaseManager(self._logger)
-        self._databaseManager.initialize(self.get_plugin_data_folder())
-        self._eStepsCalibTool = EStepsCalibrationTool(self._logger)
-        self._eStepsCalibTool.initialize(self, self._databaseManager, self._printer)
+        # tool OctoPrint last selected (see on_event), it assumes the first one after connecting
+        self._activeTool = 0
+
+        self._responseCache = ResponseCache()
+        self._callTimer = CallTimer(self._logger, enabled=self._settings.get_boolean(["metrics", "timeCalls"]))
+        self._databaseManager = DatabaseManager(self._logger, self._callTimer)
+        self._databaseManager.initialize(self.get_plugin_data_folder(), self._settings.get(["database"]))
+        self._toolRegistry = ToolRegistry(self._logger)
+        for tool in (EStepsCalibrationTool(self._logger), PidAutotuneTool(self._logger)):
+            tool.initialize(self, self._databaseManager, self._printer, self._settings)
+            self._toolRegistry.register(tool)
+        self._databaseMaintenance = DatabaseMaintenance(self._logger, self._databaseManager, self.isIdleForMaintenance, self._settings)
+        self._databaseMaintenance.start()
+        self._gcodeGenerator = CalibrationGcodeGenerator(self._logger, self._file_manager)
+
+    ##~~ ShutdownPlugin mixin
+
+    def on_shutdown(self):
+        self._databaseMaintenance.stop()
+        self._toolRegistry.shutdown()
+        self._databaseManager.shutdown()
 
     ##~~ SettingsPlugin mixin
 
@@ -35,9 +60,45 @@ class CalibrationPlugin(CalibrationAPI,
         return dict(
             # put your plugin's default settings here
             hotendTemp=210,
-            entriesPerPageForTables=20
+            entriesPerPageForTables=20,
+            # seconds to wait for the hotend to reach its target temperature
+            preheatTimeout=600,
+            # seconds an e steps calibration waits for the next action of the user before it is cancelled
+            eStepsInactivityTimeout=1800,
+            # iterative e steps calibration: passes end once the estimate changes less than this many percent
+            # of the applied e steps, or after eStepsMaxPasses passes
+            eStepsPassTolerance=0.5,
+            eStepsMaxPasses=5,
+            # defaults of the PID autotune and seconds to wait for its end
+            pidAutotuneBedTemp=60,
+            pidAutotuneCycles=8,
+            pidAutotuneTimeout=1800,
+            # SQLite tuning, changes take effect after a restart of OctoPrint
+            database=dict(
+                journalMode="wal",
+                synchronous="normal",
+                cacheSizeKiB=2048,
+                mmapSizeMiB=16
+            ),
+            maintenance=dict(
+                # detail of calibration sessions (phase timings, temperature traces, passes) and PID autotune cycles
+                # older than this is rolled up into monthly summaries, 0 keeps it forever
+                detailRetentionDays=180,
+                intervalHours=24
+            ),
+            metrics=dict(
+                # records the durations of API and database calls, see /eStepCalibrations/metrics
+                timeCalls=False
+            )
         )
 
+    def on_settings_save(self, data):
+        diff = octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self._callTimer.enabled = self._settings.get_boolean(["metrics", "timeCalls"])
+        if not self._callTimer.enabled:
+            self._callTimer.clear()
+        return diff
+
     ##~~ AssetPlugin mixin
 
     def get_assets(self):
@@ -54,7 +115,8 @@ class CalibrationPlugin(CalibrationAPI,
     # pylint: disable=no-self-use
     def get_template_configs(self):
         return [
-            dict(type="settings", custom_bindings=False)
+            # bound to CalibrationSettingsViewModel (database statistics), the settings are its "settings.settings"
+            dict(type="settings", custom_bindings=True)
         ]
 
     ##~~ Softwareupdate hook
@@ -81,15 +143,18 @@ class CalibrationPlugin(CalibrationAPI,
 
     #~~ SimpleApiPlugin mixin
     def get_api_commands(self):
-        return self._eStepsCalibTool.getApiCommands()
+        return self._toolRegistry.getApiCommands()
 
+    @timedCall("api.POST /")
     def on_api_command(self, command, data):
-        success, reason = self._eStepsCalibTool.handleApiCommand(command, data)
+        success, reason = self._toolRegistry.handleApiCommand(command, data)
         if not success:
             return flask.Response(response=reason, status=400)
 
+    # States of all tools by tool name
+    @timedCall("api.GET /")
     def on_api_get(self, _):
-        return flask.jsonify(self._eStepsCalibTool.getToolState())
+        return flask.jsonify(self._toolRegistry.getToolStates())
 
     #~~ EventHandlerPlugin mixin
     def on_event(self, event, payload):
@@ -97,22 +162,76 @@ class CalibrationPlugin(CalibrationAPI,
             self._logger.info("Printer disconnected. \n" + str(payload))
             self._connected = False
             #self._state = CalibrationPlugin.PluginState.IDLE
-            self._eStepsCalibTool.handlePrinterDisconnected()
+            self._toolRegistry.handlePrinterDisconnected()
         if event == 'Connected':
             self._logger.info("Printer connected. \n" + str(payload))
             self._connected = True
+            self._activeTool = 0
             # event["port"], event["baudrate"]
+        if event == 'ToolChange':
+            self._activeTool = payload["new"]
+        if event == 'PrintDone' and payload.get("origin") == "local" and \
+                payload.get("path", "").startswith(CalibrationGcodeGenerator.FOLDER + "/"):
+            # the calibration print can be measured now
+            self._databaseManager.markCalibrationPrintPrinted(payload["path"])
 
     #~~ Gcode Received hook
 
     def on_printer_gcode_received(self, comm, line, *args, **kwargs):
-        #if "wait" != line:
-        #    self._logger.info("on_printer_gcode_received: line=" + line)
-
-        self._eStepsCalibTool.handleGcodeReceived(comm, line, args, kwargs)
+        # This is on the comm thread's hot path (called for every line sent by the firmware),
+        # only the tools currently waiting for serial input get the line (usually none).
+        for handler in self._toolRegistry.lineHandlers:
+            handler(comm, line, args, kwargs)
 
         return line
 
+    #~~ Temperatures received hook
+
+    # pylint: disable=unused-argument
+    def on_printer_temperatures_received(self, comm, parsed_temps, *args, **kwargs):
+        for handler in self._toolRegistry.temperatureHandlers:
+            handler(parsed_temps)
+        return parsed_temps
+
+    #~~ Body size hook
+
+    # pylint: disable=unused-argument,no-self-use
+    def get_bodysize_limits(self, current_max_body_sizes, *args, **kwargs):
+        # imports of calibration records may be larger than OctoPrint's default request body limit
+        return [("POST", r"/eStepCalibrations/import", CalibrationAPI.MAX_IMPORT_SIZE)]
+
+    #~~ Server routes hook
+
+    # pylint: disable=unused-argument
+    def get_server_routes(self, server_routes, *args, **kwargs):
+        # The export of all e steps calibrations is served by Tornado instead of the blueprint: OctoPrint's WSGI
+        # container joins the whole response of a Flask view in memory before sending it, GeneratingDataHandler
+        # flushes each batch to the client before the next one is loaded.
+        # GET /plugin/calibration/eStepCalibrations/export.csv (or export.ndjson)
+        from octoprint.server import app
+        from octoprint.server.util.tornado import GeneratingDataHandler, access_validation_factory
+
+        accessValidation = access_validation_factory(app, self._validateExportAccess)
+        return [(r"/eStepCalibrations/export\.%s" % exportFormat, GeneratingDataHandler, dict(
+            generator=functools.partial(self._generateEStepsExport, exportFormat),
+            content_type=contentType,
+            as_attachment="eStepCalibrations.%s" % exportFormat,
+            access_validation=accessValidation
+        )) for exportFormat, contentType in CalibrationAPI.EXPORT_FORMATS.items()]
+
+    # pylint: disable=no-self-use
+    def _validateExportAccess(self, request):
+        # like the routes of the blueprint (see is_blueprint_protected), a logged in user is required once access
+        # control is set up
+        import octoprint.server
+        from octoprint.server.util.flask import get_flask_user_from_request
+
+        if not octoprint.server.userManager.has_been_customized():
+            return
+        user = get_flask_user_from_request(request)
+        if user is None or user.is_anonymous or not user.is_active:
+            raise tornado.web.HTTPError(403)
+
     ### Public Interface
     # Function to be called by calib_tools to check if calibration can be performed
     # E.g. for this to succeed printer must not be printing, paused, disconnected etc.
@@ -120,6 +239,29 @@ class CalibrationPlugin(CalibrationAPI,
         return self._connected and \
             self._printer.get_state_id() == "OPERATIONAL"
 
+    # Number of extruders of the current printer profile
+    def getExtruderCount(self):
+        return self._printer_profile_manager.get_current_or_default()["extruder"]["count"]
+
+    # Index of the extruder currently selected on the printer (last T command sent)
+    def getActiveTool(self):
+        return self._activeTool
+
+    # The database maintenance must not slow down prints or calibrations
+    def isIdleForMaintenance(self):
+        return not (self._printer.is_printing() or self._printer.is_paused()) and not self._toolRegistry.isBusy()
+
+    # "volume" of the current printer profile (width, depth, height and origin of the bed)
+    def getPrinterVolume(self):
+        return self._printer_profile_manager.get_current_or_default()["volume"]
+
+    def hasHeatedBed(self):
+        return bool(self._printer_profile_manager.get_current_or_default()["heatedBed"])
+
+    # Function to be called by calib_tools to push state changes to the frontend
+    def sendPluginMessage(self, data):
+        self._plugin_manager.send_plugin_message(self._identifier, data)
+
     ### Internal stuff
     ###
 
@@ -145,5 +287,8 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
         'octoprint.comm.protocol.gcode.received': __plugin_implementation__.on_printer_gcode_received,
+        'octoprint.comm.protocol.temperatures.received': __plugin_implementation__.on_printer_temperatures_received,
+        'octoprint.server.http.bodysize': __plugin_implementation__.get_bodysize_limits,
+        'octoprint.server.http.routes': __plugin_implementation__.get_server_routes,
     }
 
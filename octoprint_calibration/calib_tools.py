@@ -1,25 +1,57 @@
 # coding=utf-8
 # pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import collections
 from enum import Enum
 import logging
+import math
+import re
 import threading
+import time
+import uuid
 
-from octoprint_calibration.models import EStepsCalibrationModel
+from octoprint_calibration.executor import SerialExecutor
+from octoprint_calibration.models import EStepsCalibrationModel, PidAutotuneModel
+from octoprint_calibration.preheat_estimator import PreheatEstimator
+from octoprint_calibration.session_trace import SessionTraceRecorder
 
+# E steps calibration of all extruders of the printer. Every extruder (tool index) has its own
+# EStepsCalibrationSession, so several extruders can be preheated at the same time. Extrusions
+# are serialized: only one extruder extrudes at a time, the others wait in a queue.
 class EStepsCalibrationTool(object):
-    def __init__(self, parentLogger):
+    # see ToolRegistry
+    NAME = "eSteps"
+    START_COMMANDS = ("calibrateESteps",)
+
+    # clock: monotonic time in seconds used for phase timings and temperature samples (replaced by simulations)
+    def __init__(self, parentLogger, clock=time.monotonic):
         self._logger = logging.getLogger(parentLogger.name + "." + self.__class__.__name__)
+        self._clock = clock
         self._calibPluginInstance = None
         self._databaseManager = None
         self._printer = None
-        self._state = EStepsCalibrationTool.State.IDLE
-        self._startExtrudingClicked = False
-        self._eSteps = 0.0
-        self._newEsteps = 0.0
-        self._toolTemperature = 0.0
-        self._newEstepsValid = False
-        self._filamentName = ""
-        self._filamentType = ""
+        self._settings = None
+        self._executor = None
+        # tool index -> EStepsCalibrationSession, sessions are created on first use
+        self._sessions = {}
+        # tool indices waiting for the answer of their M92 command, in the order the commands were sent
+        self._m92Waiting = []
+        # tool index of the extruder currently extruding (None if none) and the ones waiting for it
+        self._extrudingTool = None
+        self._extrusionQueue = collections.deque()
+        # marker echoed by the printer when the current extrusion is finished and the deadline for it
+        self._extrusionMarker = None
+        self._extrusionDeadline = None
+        # cache of combined serial matchers per set of awaited states
+        self._serialMatcherCache = {}
+        # matcher for the serial lines the tool currently waits for, None if no serial input is expected
+        # (read on the comm thread for every received line, therefore kept as a plain attribute)
+        self.serialMatcher = None
+        # tool indices of the running sessions, their temperatures are traced (read on the comm thread as well)
+        self.tracedTools = ()
+        # tool index -> latest heater power reported by the firmware, only accessed on the comm thread
+        self._latestHeaterPower = {}
+        # called with (tool, lines, temperatures) whenever the tool starts or stops waiting for them, see ToolRegistry
+        self._subscriptionListener = None
 
     class State(Enum):
         IDLE = 1
@@ -30,174 +62,1252 @@ class EStepsCalibrationTool(object):
         WAITING_FOR_MEASUREMENT_INPUT = 6
         WAITING_FOR_USER_CONFIRM = 7
 
-    def initialize(self, calibPluginInstance, databaseManager, printer):
+    # Patterns of the serial lines awaited in a state, states not contained need no serial input.
+    # The patterns of all states awaited by any session are combined into one precompiled matcher.
+    SERIAL_PATTERNS = {
+        # Recv: echo: M92 X80.0 Y80.0 Z800.0 E90.0
+        # Recv: echo: M92 T1 E93.0 (firmware with distinct e steps per extruder)
+        State.WAITING_FOR_M92_ANSWER: r"\bM92\b(?:\s+T(?P<m92Tool>\d+))?.*\bE(?P<m92ESteps>\d+(?:\.\d+)?)",
+        # Recv: echo:CALIB_EXTRUDED_3f2a9c41 (M118 sent after M400, see _extrudeFilament)
+        State.WAITING_FOR_EXTRUDE_FINISHED: r"\bCALIB_EXTRUDED_(?P<extrudedMarker>[0-9a-f]+)\b",
+    }
+
+    # Filament extruded for the calibration (mm) and feed rate (mm/min), i.e. the extrusion takes 120 s
+    EXTRUSION_LENGTH = 100
+    EXTRUSION_FEED_RATE = 50
+    # Quick verification of a filament calibrated before: shorter extrusion (24 s), the result is considered
+    # verified if it deviates less than QUICK_VERIFY_TOLERANCE (relative) from the median of the filament's history
+    QUICK_VERIFY_EXTRUSION_LENGTH = 20
+    QUICK_VERIFY_TOLERANCE = 0.02
+    # the filament is marked this many mm above the extrusion length, the remaining length up to the mark is measured
+    MARK_MARGIN = 20
+    EXTRUSION_MARKER_PREFIX = "CALIB_EXTRUDED_"
+    # the end of an extrusion must be reported within its expected duration plus this many seconds
+    EXTRUSION_TIMEOUT_MARGIN = 60
+
+    # Recv: ok T:210.12 /210.00 B:60.00 /60.00 @:64 B@:0 (Marlin, "@0:", "@1:", ... per hotend with several hotends)
+    HEATER_POWER_PATTERN = re.compile(r"(?<![A-Za-z])@(\d*):(\d+)")
+
+    # Hotend is considered preheated if its temperature is stable within this many degrees of the target
+    PREHEAT_TOLERANCE = 3.0
+
+    # States waiting for the user, a session staying in one of them longer than the setting eStepsInactivityTimeout
+    # (seconds) is considered abandoned (e.g. the browser was closed) and cancelled
+    USER_WAIT_STATES = (State.WAITING_FOR_EXTRUDE_START, State.WAITING_FOR_MEASUREMENT_INPUT, State.WAITING_FOR_USER_CONFIRM)
+
+    # Allowed range of the setting eStepsMaxPasses (passes of an iterative calibration)
+    MIN_PASSES = 2
+    MAX_PASSES = 10
+
+    # Phase of a calibration session per state, the time spent in each phase is stored with the calibration
+    # (see EStepsPhaseTimingModel). The "save" phase lasts from the saveNewESteps request until it was processed.
+    PHASES = {
+        State.WAITING_FOR_M92_ANSWER: "m92",
+        State.WAITING_FOR_EXTRUDER_TEMP: "preheat",
+        State.WAITING_FOR_EXTRUDE_START: "extrudeStart",
+        State.WAITING_FOR_EXTRUDE_FINISHED: "extrusion",
+        State.WAITING_FOR_MEASUREMENT_INPUT: "measurement",
+        State.WAITING_FOR_USER_CONFIRM: "confirm",
+    }
+
+    def initialize(self, calibPluginInstance, databaseManager, printer, settings):
         self._calibPluginInstance = calibPluginInstance
         self._databaseManager = databaseManager
         self._printer = printer
+        self._settings = settings
+        # owns the state machine, see handleApiCommand
+        self._executor = SerialExecutor(self._logger, self.__class__.__name__)
+
+    # True while a calibration session of any extruder is running (read from other threads)
+    def isBusy(self):
+        return bool(self.tracedTools)
 
+    def setSubscriptionListener(self, listener):
+        self._subscriptionListener = listener
+
+    # Full state of all extruders, used by the polling fallback of the frontend
     def getToolState(self):
-        #self._logger.info(str(self._printer.get_current_temperatures()))
-        return dict(
-            oldEsteps="%.2f" % self._eSteps,
-            newEsteps="%.2f" % self._newEsteps,
-            newEstepsValid=str(self._newEstepsValid),
-            eStepsToolState=str(self._state.value),
-            currTemp="%.2f" % self._printer.get_current_temperatures()["tool0"]["actual"]
-        )
+        temps = self._printer.get_current_temperatures()
+        extruderCount = self._calibPluginInstance.getExtruderCount()
+        tools = {}
+        for toolIndex in range(extruderCount):
+            # sessions are only created on the executor, an extruder without session is idle
+            session = self._sessions.get(toolIndex) or EStepsCalibrationSession(toolIndex)
+            tools[str(toolIndex)] = self._buildToolState(session, temps.get("tool%d" % toolIndex, {}).get("actual"))
+        return dict(extruderCount=extruderCount, tools=tools)
 
     # pylint: disable=no-self-use
     def getApiCommands(self):
+        # all commands take the optional parameter "tool" (extruder index, default 0), calibrateESteps the
+        # optional parameters "iterative" (several passes, see _eStepsMeasured) and "quickVerify" (short extrusion)
         return dict(
             calibrateESteps=["filamentName", "filamentType", "hotendTemp"],
             startExtruding=[],
             eStepsMeasured=["measurement"],
             saveNewESteps=[],
+            cancelESteps=[],
         )
 
+    # Validates the command's parameters on the calling (request) thread and enqueues the command
+    # for the state machine, which runs on the tool's executor. Errors detected by the state machine
+    # (e.g. command not allowed in the current state) are pushed to the frontend.
     def handleApiCommand(self, command, data):
         if not self._calibPluginInstance.isOperational():
             reason = "Not operational. Cannot calibrate e steps. E.g. printer must not be in PRINTING, PAUSED, ERROR etc. state."
             self._logger.error(reason)
             return False, reason
 
+        extruderCount = self._calibPluginInstance.getExtruderCount()
+        try:
+            toolIndex = int(data.get("tool", 0))
+        except (TypeError, ValueError):
+            reason = "Given value '%s' for 'tool' is not an integer." % data.get("tool")
+            self._logger.error(reason)
+            return False, reason
+        if toolIndex < 0 or toolIndex >= extruderCount:
+            reason = "Given tool %d is out of allowed range [0;%d]." % (toolIndex, extruderCount - 1)
+            self._logger.error(reason)
+            return False, reason
+
         if command == "calibrateESteps":
-            self._filamentName = data["filamentName"]
-            self._filamentType = data["filamentType"]["name"]
+            filamentName = data["filamentName"]
+            filamentType = data["filamentType"]["name"]
             try:
-                self._toolTemperature = int(data["hotendTemp"])
-            except ValueError:
+                toolTemperature = int(data["hotendTemp"])
+            except (TypeError, ValueError):
                 reason = "Given value '%s' for 'hotendTemp' is not an integer." % data["hotendTemp"]
                 self._logger.error(reason)
                 return False, reason
 
-            if not self._filamentName or not self._filamentName.strip():
+            if not filamentName or not filamentName.strip():
                 reason = "Filament Name must not be empty."
                 self._logger.error(reason)
                 return False, reason
 
-            if not self._filamentType or not self._filamentType.strip():
+            if not filamentType or not filamentType.strip():
                 reason = "Filament Type must not be empty."
                 self._logger.error(reason)
                 return False, reason
 
             # TODO make allowed temperature range configurable
-            if self._toolTemperature < 180 or self._toolTemperature > 500:
-                reason = "Given tool temperature %d is out of allowed range [180;500]." % self._toolTemperature
+            if toolTemperature < 180 or toolTemperature > 500:
+                reason = "Given tool temperature %d is out of allowed range [180;500]." % toolTemperature
+                self._logger.error(reason)
+                return False, reason
+
+            iterative = data.get("iterative", False) in (True, "true", "True")
+            quickVerify = data.get("quickVerify", False) in (True, "true", "True")
+            if iterative and quickVerify:
+                reason = "Iterative calibration and quick verification cannot be combined."
                 self._logger.error(reason)
                 return False, reason
 
-            self._logger.info(
-                "Starting new e steps calibration for filament '%s' of type '%s' with hotend temperature %d.", \
-                    self._filamentName, self._filamentType, self._toolTemperature)
+            # read here instead of on the executor, which would wait for a running migration of the database
+            history = self._loadFilamentHistory(filamentName, filamentType)
+            if quickVerify and history is None:
+                reason = "Filament '%s' of type '%s' was not calibrated before, a quick verification is not possible." % (filamentName, filamentType)
+                self._logger.error(reason)
+                return False, reason
 
-            self._printer.set_temperature("tool0", self._toolTemperature)
-            self._printer.commands("M92")
-            self._switchState(EStepsCalibrationTool.State.WAITING_FOR_M92_ANSWER)
+            self._executor.submit(self._calibrateESteps, toolIndex, filamentName, filamentType, toolTemperature, history, iterative, quickVerify)
 
         if command == "startExtruding":
-            if self._state == EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_START:
-                self._extrudeFilament()
-            else:
-                self._startExtrudingClicked = True
+            self._executor.submit(self._startExtruding, toolIndex)
 
         if command == "eStepsMeasured":
-            if self._state != EStepsCalibrationTool.State.WAITING_FOR_MEASUREMENT_INPUT and \
-                self._state != EStepsCalibrationTool.State.WAITING_FOR_USER_CONFIRM:
-                reason = "Wrong state detected: %s" % self._state
-                self._logger.error(reason)
-                return False, reason
             self._logger.info("Command received: eStepsMeasured")
-
             try:
                 measuredLength = float(data["measurement"])
-            except ValueError:
+            except (TypeError, ValueError):
                 reason = "Given value '%s' for 'measurement' is not a float value." % data["measurement"]
                 self._logger.error(reason)
                 return False, reason
-            self._logger.info("Received measurement %.2f.", measuredLength)
+            # 120 mm are marked on the filament, 100 mm of it are extruded (less for a quick verification, see _eStepsMeasured)
+            markLength = EStepsCalibrationTool.EXTRUSION_LENGTH + EStepsCalibrationTool.MARK_MARGIN
+            if measuredLength < 0 or measuredLength >= markLength:
+                reason = "Given measurement %.2f is out of allowed range [0;%d)." % (measuredLength, markLength)
+                self._logger.error(reason)
+                return False, reason
 
-            filamentExtruded = 120 - measuredLength
-            self._newEsteps = self._eSteps / filamentExtruded * 100
-            self._newEstepsValid = True
+            self._executor.submit(self._eStepsMeasured, toolIndex, measuredLength)
 
-            self._logger.info("E steps should be changed from %.2f to %.2f.", self._eSteps, self._newEsteps)
+        if command == "saveNewESteps":
+            self._logger.info("Command received: saveNewESteps")
+            self._executor.submit(self._saveNewESteps, toolIndex, self._clock())
 
-            self._switchState(EStepsCalibrationTool.State.WAITING_FOR_USER_CONFIRM)
+        if command == "cancelESteps":
+            self._logger.info("Command received: cancelESteps")
+            self._executor.submit(self._cancelESteps, toolIndex)
 
-            # present result to user (with option to save it)
-            # what to use as "return channel" to notify user - WebSockets?
-            # --> for simplicity now the get endpoint is now used by the frontend (not the best solution)
+        return True, ""
 
-        if command == "saveNewESteps":
-            if self._state != EStepsCalibrationTool.State.WAITING_FOR_USER_CONFIRM:
-                reason = "Wrong state detected: %s" % self._state
+    # Called on the comm thread for every received line (as long as serialMatcher or tracedTools is set),
+    # only matching lines are handed over to the executor.
+    # pylint: disable=unused-argument
+    def handleGcodeReceived(self, comm, line, *args, **kwargs):
+        if self.tracedTools and "@" in line:
+            # the heater power is part of the temperature report, which is passed to the temperatures hook afterwards
+            for index, power in EStepsCalibrationTool.HEATER_POWER_PATTERN.findall(line):
+                self._latestHeaterPower[int(index) if index else 0] = int(power)
+        matcher = self.serialMatcher
+        if matcher is None:
+            return
+        match = matcher.search(line)
+        if match is None:
+            return
+        self._executor.submit(self._onSerialMatch, match)
+
+    # parsedTemps as passed to the octoprint.comm.protocol.temperatures.received hook, e.g. {"T0": (210.3, 210.0), "B": (60.1, 60.0)}
+    def handleTemperaturesReceived(self, parsedTemps):
+        # temperature reports are only of interest while a session is running
+        tracedTools = self.tracedTools
+        if not tracedTools:
+            return
+        toolTemps = {}
+        for toolIndex in tracedTools:
+            temps = parsedTemps.get("T%d" % toolIndex)
+            if temps is not None and temps[0] is not None:
+                # (actual, target, heater power or None)
+                toolTemps[toolIndex] = (temps[0], temps[1], self._latestHeaterPower.get(toolIndex))
+        if toolTemps:
+            self._executor.submit(self._onToolTemperatures, toolTemps, self._clock())
+
+    def handlePrinterDisconnected(self):
+        self._executor.submit(self._onPrinterDisconnected)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    ##################
+    ### State machine, only called on the executor
+
+    # history: earlier calibrations of the filament, see _loadFilamentHistory
+    def _calibrateESteps(self, toolIndex, filamentName, filamentType, toolTemperature, history, iterative=False, quickVerify=False):
+        session = self._getSession(toolIndex)
+        if session.state == EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_FINISHED:
+            self._reportWrongState(session)
+            return
+        self._resetSession(session)
+
+        session.sessionId = uuid.uuid4().hex
+        session.trace = SessionTraceRecorder(self._clock())
+        session.filamentName = filamentName
+        session.filamentType = filamentType
+        session.toolTemperature = toolTemperature
+        session.history = history
+        session.quickVerify = quickVerify
+        session.extrusionLength = EStepsCalibrationTool.QUICK_VERIFY_EXTRUSION_LENGTH if quickVerify else EStepsCalibrationTool.EXTRUSION_LENGTH
+        session.iterative = iterative
+        if iterative:
+            # settings are read once, changes take effect with the next session
+            session.passTolerance = self._settings.get_float(["eStepsPassTolerance"]) / 100.0
+            session.maxPasses = min(max(self._settings.get_int(["eStepsMaxPasses"]), EStepsCalibrationTool.MIN_PASSES), \
+                EStepsCalibrationTool.MAX_PASSES)
+        else:
+            session.maxPasses = 1
+        self._logger.info(
+            "Starting new %se steps calibration of tool %d for filament '%s' of type '%s' with hotend temperature %d.", \
+                "iterative " if iterative else "quick verification " if quickVerify else "", toolIndex, session.filamentName, session.filamentType, session.toolTemperature)
+
+        self._printer.set_temperature("tool%d" % toolIndex, session.toolTemperature)
+        self._printer.commands(self._withToolParameter("M92", toolIndex))
+        self._traceEvent(session, "send set temperature %d, %s" % (session.toolTemperature, self._withToolParameter("M92", toolIndex)))
+        self._m92Waiting.append(toolIndex)
+        self._switchState(session, EStepsCalibrationTool.State.WAITING_FOR_M92_ANSWER)
+
+    def _startExtruding(self, toolIndex):
+        session = self._getSession(toolIndex)
+        if session.state == EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_START:
+            self._requestExtrusion(session)
+        elif session.state in (EStepsCalibrationTool.State.WAITING_FOR_M92_ANSWER, EStepsCalibrationTool.State.WAITING_FOR_EXTRUDER_TEMP):
+            # extrusion starts as soon as the hotend is preheated
+            session.startExtrudingClicked = True
+        else:
+            self._reportWrongState(session)
+
+    def _eStepsMeasured(self, toolIndex, measuredLength):
+        session = self._getSession(toolIndex)
+        if session.state != EStepsCalibrationTool.State.WAITING_FOR_MEASUREMENT_INPUT and \
+            session.state != EStepsCalibrationTool.State.WAITING_FOR_USER_CONFIRM:
+            self._reportWrongState(session)
+            return
+        markLength = session.extrusionLength + EStepsCalibrationTool.MARK_MARGIN
+        if measuredLength >= markLength:
+            reason = "Given measurement %.2f is out of allowed range [0;%d)." % (measuredLength, markLength)
+            self._logger.error(reason)
+            self._pushError(reason, toolIndex)
+            return
+        self._logger.info("Received measurement %.2f for tool %d.", measuredLength, toolIndex)
+        self._traceEvent(session, "measurement %.2f" % measuredLength)
+        if session.state == EStepsCalibrationTool.State.WAITING_FOR_USER_CONFIRM:
+            # corrected measurement of the last pass
+            session.passes.pop()
+
+        # every pass estimates the e steps from the ones applied during its extrusion
+        filamentExtruded = markLength - measuredLength
+        estimatedESteps = session.eSteps / filamentExtruded * session.extrusionLength
+        relativeChange = abs(estimatedESteps - session.eSteps) / session.eSteps
+        session.passes.append(dict(
+            passIndex=len(session.passes),
+            appliedESteps=round(session.eSteps, 2),
+            measuredLength=measuredLength,
+            estimatedESteps=round(estimatedESteps, 2),
+            relativeChange=relativeChange
+        ))
+        self._logger.info("Pass %d of tool %d estimated e steps %.2f (applied %.2f).", len(session.passes), toolIndex, estimatedESteps, session.eSteps)
+
+        session.converged = session.iterative and relativeChange <= session.passTolerance
+        if session.iterative and not session.converged and len(session.passes) < session.maxPasses:
+            # apply the estimate (not saved to EEPROM) and measure again, the hotend stays at its temperature
+            session.eSteps = estimatedESteps
+            command = self._withToolParameter("M92", toolIndex) + " E%.2f" % session.eSteps
+            self._printer.commands(command)
+            self._traceEvent(session, "send " + command)
+            self._switchState(session, EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_START)
+            return
+
+        # all passes estimate the same e steps, their mean is the result
+        estimates = [calibPass["estimatedESteps"] for calibPass in session.passes]
+        session.newEsteps, session.confidenceHalfWidth = _meanConfidenceInterval(estimates)
+        session.newEstepsValid = True
+        # compared with the median shown to the user: e steps applied in the firmware may have drifted from the history
+        session.verified = session.quickVerify and \
+            abs(session.newEsteps - session.history["medianNewESteps"]) / session.history["medianNewESteps"] <= EStepsCalibrationTool.QUICK_VERIFY_TOLERANCE
+
+        self._logger.info("E steps of tool %d should be changed from %.2f to %.2f after %d passes.", \
+            toolIndex, session.originalESteps, session.newEsteps, len(session.passes))
+
+        # present result to user (with option to save it), the state switch pushes the new values to the frontend
+        self._switchState(session, EStepsCalibrationTool.State.WAITING_FOR_USER_CONFIRM)
+
+    # requestedAt: monotonic time the saveNewESteps command was received
+    def _saveNewESteps(self, toolIndex, requestedAt):
+        session = self._getSession(toolIndex)
+        if session.state != EStepsCalibrationTool.State.WAITING_FOR_USER_CONFIRM:
+            self._reportWrongState(session)
+            return
+
+        self._printer.set_temperature("tool%d" % toolIndex, 0)
+        self._printer.commands([self._withToolParameter("M92", toolIndex) + " E%.2f" % session.newEsteps, "M500", "G90"])
+
+        self._logger.info("E steps calibration procedure of tool %d finished", toolIndex)
+
+        eStepsCalibModel = EStepsCalibrationModel()
+        eStepsCalibModel.filamentName = session.filamentName
+        eStepsCalibModel.filamentType = session.filamentType
+        eStepsCalibModel.hotendTemperature = session.toolTemperature
+        eStepsCalibModel.oldESteps = round(session.originalESteps, 2)
+        eStepsCalibModel.newESteps = round(session.newEsteps, 2)
+        eStepsCalibModel.toolIndex = toolIndex
+        eStepsCalibModel.sessionId = session.sessionId
+        eStepsCalibModel.passCount = len(session.passes)
+        eStepsCalibModel.confidenceHalfWidth = session.confidenceHalfWidth
+        eStepsCalibModel.extrusionLength = session.extrusionLength
+        session.phaseDurations["save"] = self._clock() - requestedAt
+        self._traceEvent(session, "saved new e steps %.2f" % session.newEsteps)
+        # the saved e steps are the ones applied now
+        session.eSteps = session.originalESteps = session.newEsteps
+        passes = self._takePasses(session)
+        sessionTrace = self._takeSessionTrace(session, True)
+        self._databaseManager.insertEstepsCalibration(eStepsCalibModel, self._takePhaseTimings(session, True), sessionTrace, passes)
+
+        self._switchState(session, EStepsCalibrationTool.State.IDLE)
+
+    def _cancelESteps(self, toolIndex):
+        session = self._getSession(toolIndex)
+        if session.state == EStepsCalibrationTool.State.IDLE:
+            self._reportWrongState(session)
+            return
+        if session.state == EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_FINISHED:
+            # the firmware executes the queued extrusion anyway, the session can be cancelled once it is finished
+            reason = "The extrusion of tool %d cannot be cancelled, cancel the calibration once it is finished." % toolIndex
+            self._logger.error(reason)
+            self._pushError(reason, toolIndex)
+            return
+        self._logger.info("E steps calibration of tool %d cancelled.", toolIndex)
+        self._endSession(session, "cancelled")
+
+    def _onSerialMatch(self, match):
+        # the sessions might have changed their state since the line was matched on the comm thread
+        groups = match.groupdict()
+        line = match.string.strip()
+        if groups.get("state%d" % EStepsCalibrationTool.State.WAITING_FOR_M92_ANSWER.value) is not None:
+            self._onM92Answer(groups, line)
+        elif groups.get("state%d" % EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_FINISHED.value) is not None:
+            self._onExtrudeFinished(groups["extrudedMarker"], line)
+
+    def _onM92Answer(self, groups, line):
+        if not self._m92Waiting:
+            return
+        toolIndex = self._m92Waiting[0]
+        answerTool = groups["m92Tool"]
+        if answerTool is not None and int(answerTool) in self._m92Waiting:
+            toolIndex = int(answerTool)
+        self._m92Waiting.remove(toolIndex)
+
+        session = self._getSession(toolIndex)
+        self._traceEvent(session, "recv " + line)
+        eStepsStr = groups["m92ESteps"]
+        self._logger.info("E steps of tool %d got from printer: %s", toolIndex, eStepsStr)
+        session.eSteps = session.originalESteps = float(eStepsStr)
+        self._startPreheatWait(session)
+
+    def _onExtrudeFinished(self, marker, line):
+        if self._extrudingTool is None or marker != self._extrusionMarker:
+            # e.g. marker of an extrusion which timed out
+            self._logger.debug("Ignoring unexpected extrusion marker %s.", marker)
+            return
+        self._cancelExtrusionDeadline()
+        session = self._getSession(self._extrudingTool)
+        self._traceEvent(session, "recv " + line)
+        self._extrudingTool = None
+        if session.state == EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_FINISHED:
+            self._switchState(session, EStepsCalibrationTool.State.WAITING_FOR_MEASUREMENT_INPUT)
+        self._startNextQueuedExtrusion()
+
+    def _onToolTemperatures(self, toolTemps, sampledAt):
+        for toolIndex, (actualTemp, targetTemp, heaterPower) in toolTemps.items():
+            session = self._getSession(toolIndex)
+            if session.trace is not None:
+                session.trace.addSample(sampledAt, actualTemp, targetTemp, heaterPower)
+            if session.state != EStepsCalibrationTool.State.WAITING_FOR_EXTRUDER_TEMP:
+                continue
+            if not self._checkToolPreheated(session, actualTemp, sampledAt):
+                self._pushStateUpdate(session)
+
+    def _onPrinterDisconnected(self):
+        self._m92Waiting = []
+        self._cancelExtrusionDeadline()
+        self._extrudingTool = None
+        self._extrusionQueue.clear()
+        for session in list(self._sessions.values()):
+            self._traceEvent(session, "printer disconnected")
+            self._resetSession(session)
+            self._switchState(session, EStepsCalibrationTool.State.IDLE)
+
+    ##################
+    ### Internal stuff
+
+    def _getSession(self, toolIndex):
+        session = self._sessions.get(toolIndex)
+        if session is None:
+            session = EStepsCalibrationSession(toolIndex)
+            self._sessions[toolIndex] = session
+        return session
+
+    # Removes the session from all pending waits, an unfinished session's timings are stored as aborted
+    def _resetSession(self, session):
+        self._abortSession(session)
+        self._cancelPreheatDeadline(session)
+        self._cancelInactivityDeadline(session)
+        if session.toolIndex in self._m92Waiting:
+            self._m92Waiting.remove(session.toolIndex)
+        if session.toolIndex in self._extrusionQueue:
+            self._extrusionQueue.remove(session.toolIndex)
+        session.startExtrudingClicked = False
+        session.extrusionQueued = False
+        session.newEstepsValid = False
+        session.preheatEstimator = None
+        session.preheatEta = None
+        session.iterative = False
+        session.passes = []
+        session.converged = False
+        session.confidenceHalfWidth = None
+        session.history = None
+        session.quickVerify = False
+        session.extrusionLength = EStepsCalibrationTool.EXTRUSION_LENGTH
+        session.verified = False
+
+    # Tool index is only passed to the firmware for printers with more than one extruder
+    def _withToolParameter(self, gcode, toolIndex):
+        if self._calibPluginInstance.getExtruderCount() > 1:
+            return "%s T%d" % (gcode, toolIndex)
+        return gcode
+
+    def _buildToolState(self, session, currTemp):
+        extrusionElapsed = ""
+        if session.state == EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_FINISHED and session.extrusionStartedAt is not None:
+            extrusionElapsed = "%.0f" % (self._clock() - session.extrusionStartedAt)
+        return dict(
+            oldEsteps="%.2f" % session.originalESteps,
+            newEsteps="%.2f" % session.newEsteps,
+            newEstepsValid=str(session.newEstepsValid),
+            # iterative calibration: e steps applied for the current pass, the passes so far (dicts with passIndex,
+            # appliedESteps, measuredLength, estimatedESteps and relativeChange) and the result's 95 % confidence interval
+            iterative=str(session.iterative),
+            appliedEsteps="%.2f" % session.eSteps,
+            passes=[dict(calibPass) for calibPass in session.passes],
+            maxPasses=str(session.maxPasses),
+            converged=str(session.converged),
+            confidenceHalfWidth="%.2f" % session.confidenceHalfWidth if session.confidenceHalfWidth is not None else "",
+            # earlier calibrations of the filament (see DatabaseManager.loadFilamentHistory), empty if there are none
+            historyCount=str(session.history["count"]) if session.history is not None else "0",
+            historyLatestEsteps="%.2f" % session.history["latestNewESteps"] if session.history is not None else "",
+            historyMedianEsteps="%.2f" % session.history["medianNewESteps"] if session.history is not None else "",
+            # quick verification: mm extruded and marked on the filament, verified once the measurement confirmed the e steps
+            quickVerify=str(session.quickVerify),
+            extrusionLength=str(session.extrusionLength),
+            markLength=str(session.extrusionLength + EStepsCalibrationTool.MARK_MARGIN),
+            verified=str(session.verified),
+            eStepsToolState=str(session.state.value),
+            extrusionQueued=str(session.extrusionQueued),
+            # expected duration of the extrusion and seconds since it was started, for the progress shown by the frontend
+            extrusionDuration="%.0f" % self._getExtrusionDuration(session),
+            extrusionElapsed=extrusionElapsed,
+            # estimated seconds until the hotend is preheated, empty if unknown
+            preheatEta="%.0f" % session.preheatEta if session.preheatEta is not None else "",
+            sessionId=session.sessionId or "",
+            currTemp="%.2f" % (currTemp if currTemp is not None else 0.0)
+        )
+
+    # Pushes all values of the session's state that changed since the last push to the frontend
+    def _pushStateUpdate(self, session):
+        state = self._buildToolState(session, session.currTemp)
+        delta = {key: value for key, value in state.items() if session.lastPushedState.get(key) != value}
+        if not delta:
+            return
+        session.lastPushedState = state
+        self._calibPluginInstance.sendPluginMessage(dict(tool=EStepsCalibrationTool.NAME, type="stateUpdate", toolIndex=session.toolIndex, data=delta))
+
+    def _reportWrongState(self, session):
+        reason = "Wrong state detected for tool %d: %s" % (session.toolIndex, session.state)
+        self._logger.error(reason)
+        self._pushError(reason, session.toolIndex)
+
+    def _pushError(self, reason, toolIndex):
+        self._traceEvent(self._getSession(toolIndex), "error " + reason)
+        self._calibPluginInstance.sendPluginMessage(dict(tool=EStepsCalibrationTool.NAME, type="error", toolIndex=toolIndex, message=reason))
+
+    def _switchState(self, session, newState):
+        oldState = session.state
+        self._accountPhaseTime(session)
+        session.state = newState
+        self._restartInactivityDeadline(session)
+        self._traceEvent(session, "state " + newState.name)
+        self._updateSerialSubscriptions()
+        self._logger.info("Switching tool %d from state %s to state %s.", session.toolIndex, str(oldState), str(newState))
+        self._pushStateUpdate(session)
+
+    # Adds the time since the session entered its current state to the duration of the state's phase
+    # pylint: disable=no-self-use
+    def _accountPhaseTime(self, session):
+        now = self._clock()
+        phase = EStepsCalibrationTool.PHASES.get(session.state)
+        if session.sessionId is not None and phase is not None and session.stateEnteredAt is not None:
+            session.phaseDurations[phase] = session.phaseDurations.get(phase, 0.0) + now - session.stateEnteredAt
+        session.stateEnteredAt = now
+
+    # Ends the timing of the session, returns the rows for EStepsPhaseTimingModel
+    def _takePhaseTimings(self, session, completed):
+        self._accountPhaseTime(session)
+        rows = [dict(sessionId=session.sessionId, toolIndex=session.toolIndex, phase=phase, durationSeconds=duration, completed=completed) \
+            for phase, duration in session.phaseDurations.items()]
+        session.sessionId = None
+        session.phaseDurations = {}
+        return rows
+
+    # Ends an unfinished session: e steps applied by its passes are reverted, its timings, trace and passes are stored
+    def _abortSession(self, session):
+        if session.sessionId is None:
+            return
+        if session.eSteps != session.originalESteps:
+            if self._calibPluginInstance.isOperational():
+                command = self._withToolParameter("M92", session.toolIndex) + " E%.2f" % session.originalESteps
+                self._printer.commands(command)
+                self._traceEvent(session, "send " + command)
+            session.eSteps = session.originalESteps
+        passes = self._takePasses(session)
+        sessionTrace = self._takeSessionTrace(session, False)
+        rows = self._takePhaseTimings(session, False)
+        if rows or sessionTrace or passes:
+            self._databaseManager.insertPhaseTimings(rows, sessionTrace, passes)
+
+    # Returns the rows for EStepsCalibrationPassModel of the session's passes
+    # pylint: disable=no-self-use
+    def _takePasses(self, session):
+        rows = [dict(calibPass, sessionId=session.sessionId, toolIndex=session.toolIndex) for calibPass in session.passes]
+        session.passes = []
+        return rows
+
+    def _traceEvent(self, session, text):
+        if session.trace is not None:
+            session.trace.addEvent(self._clock(), text)
+
+    # Ends the trace of the session, returns the row for EStepsSessionTraceModel (None if the session was not traced)
+    def _takeSessionTrace(self, session, completed):
+        trace = session.trace
+        if trace is None:
+            return None
+        session.trace = None
+        samples, events = trace.encode()
+        if trace.droppedSamples:
+            self._logger.warning("Dropped %d temperature samples of session %s.", trace.droppedSamples, session.sessionId)
+        return dict(
+            sessionId=session.sessionId,
+            toolIndex=session.toolIndex,
+            completed=completed,
+            started=trace.started,
+            sampleCount=trace.getSampleCount(),
+            eventCount=trace.getEventCount(),
+            samples=samples,
+            events=events,
+            filamentName=session.filamentName,
+            filamentType=session.filamentType
+        )
+
+    # Updates what the comm thread hooks look for after the state of a session changed
+    def _updateSerialSubscriptions(self):
+        awaitedStates = frozenset(session.state for session in self._sessions.values() \
+            if session.state in EStepsCalibrationTool.SERIAL_PATTERNS)
+        self.serialMatcher = self._getSerialMatcher(awaitedStates)
+        self.tracedTools = tuple(session.toolIndex for session in self._sessions.values() if session.trace is not None)
+        if self._subscriptionListener is not None:
+            # received lines are needed for the awaited answers and the heater power of the traced temperatures
+            self._subscriptionListener(self, self.serialMatcher is not None or bool(self.tracedTools), bool(self.tracedTools))
+
+    def _getSerialMatcher(self, awaitedStates):
+        if not awaitedStates:
+            return None
+        matcher = self._serialMatcherCache.get(awaitedStates)
+        if matcher is None:
+            # one named group per state, see _onSerialMatch
+            pattern = "|".join("(?P<state%d>%s)" % (state.value, EStepsCalibrationTool.SERIAL_PATTERNS[state]) \
+                for state in sorted(awaitedStates, key=lambda state: state.value))
+            matcher = re.compile(pattern, re.IGNORECASE)
+            self._serialMatcherCache[awaitedStates] = matcher
+        return matcher
+
+    def _requestExtrusion(self, session):
+        session.startExtrudingClicked = False
+        if self._extrudingTool is None:
+            self._extrudeFilament(session)
+        elif session.toolIndex not in self._extrusionQueue:
+            # another extruder is extruding, this one follows as soon as it is finished
+            self._extrusionQueue.append(session.toolIndex)
+            session.extrusionQueued = True
+            self._pushStateUpdate(session)
+
+    def _startNextQueuedExtrusion(self):
+        while self._extrusionQueue and self._extrudingTool is None:
+            session = self._getSession(self._extrusionQueue.popleft())
+            session.extrusionQueued = False
+            if session.state == EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_START:
+                self._extrudeFilament(session)
+
+    # The "ok" of the G1 only acknowledges that the move was queued. M400 waits for the end of the move,
+    # afterwards the printer echoes the unique marker (M118), which ends the wait for the extrusion.
+    # Absolute positioning is restored right after the extrusion, on printers with several extruders the
+    # calibrated one is selected for the extrusion and the one selected before is selected again with it.
+    def _extrudeFilament(self, session):
+        self._extrudingTool = session.toolIndex
+        self._extrusionMarker = uuid.uuid4().hex[:8]
+        commands = [
+            "G91",
+            "G1 E%d F%d" % (session.extrusionLength, EStepsCalibrationTool.EXTRUSION_FEED_RATE),
+            "M400",
+            "G90",
+            "M118 " + EStepsCalibrationTool.EXTRUSION_MARKER_PREFIX + self._extrusionMarker
+        ]
+        if self._calibPluginInstance.getExtruderCount() > 1:
+            previousTool = self._calibPluginInstance.getActiveTool()
+            commands.insert(0, "T%d" % session.toolIndex)
+            if previousTool != session.toolIndex:
+                commands.insert(-1, "T%d" % previousTool)
+        self._printer.commands(commands)
+        self._traceEvent(session, "send " + ", ".join(commands))
+        session.extrusionStartedAt = self._clock()
+
+        self._cancelExtrusionDeadline()
+        self._extrusionDeadline = threading.Timer(self._getExtrusionDuration(session) + EStepsCalibrationTool.EXTRUSION_TIMEOUT_MARGIN, \
+            self._executor.submit, args=[self._extrusionTimedOut, self._extrusionMarker])
+        self._extrusionDeadline.daemon = True
+        self._extrusionDeadline.start()
+
+        # need to wait till extrude is finished
+        self._switchState(session, EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_FINISHED)
+
+    # Expected duration of the session's extrusion in seconds
+    # pylint: disable=no-self-use
+    def _getExtrusionDuration(self, session):
+        return session.extrusionLength / (EStepsCalibrationTool.EXTRUSION_FEED_RATE / 60.0)
+
+    def _cancelExtrusionDeadline(self):
+        if self._extrusionDeadline is not None:
+            self._extrusionDeadline.cancel()
+            self._extrusionDeadline = None
+
+    def _extrusionTimedOut(self, marker):
+        if marker != self._extrusionMarker or self._extrudingTool is None:
+            return
+        session = self._getSession(self._extrudingTool)
+        reason = "Printer did not report the end of the extrusion of tool %d within %d seconds." % \
+            (session.toolIndex, self._getExtrusionDuration(session) + EStepsCalibrationTool.EXTRUSION_TIMEOUT_MARGIN)
+        self._logger.error(reason)
+        self._extrusionDeadline = None
+        self._extrusionMarker = None
+        self._extrudingTool = None
+        self._printer.set_temperature("tool%d" % session.toolIndex, 0)
+        self._traceEvent(session, "error " + reason)
+        self._abortSession(session)
+        self._switchState(session, EStepsCalibrationTool.State.IDLE)
+        self._pushError(reason, session.toolIndex)
+        self._startNextQueuedExtrusion()
+
+    # Earlier calibrations of the filament (see DatabaseManager.loadFilamentHistory), None if there are none or they cannot be read
+    def _loadFilamentHistory(self, filamentName, filamentType):
+        try:
+            return self._databaseManager.loadFilamentHistory(filamentName, filamentType)
+        except Exception as e:
+            # the calibration works without history
+            self._logger.warning("Could not load the history of filament '%s' of type '%s': %s", filamentName, filamentType, str(e))
+            return None
+
+    def _startPreheatWait(self, session):
+        self._switchState(session, EStepsCalibrationTool.State.WAITING_FOR_EXTRUDER_TEMP)
+
+        # readiness is checked on every temperature report of the printer (see handleTemperaturesReceived),
+        # the only timer is the deadline for reaching the target temperature
+        self._cancelPreheatDeadline(session)
+        session.preheatDeadline = threading.Timer(self._settings.get_int(["preheatTimeout"]), self._executor.submit, \
+            args=[self._preheatTimedOut, session.toolIndex])
+        session.preheatDeadline.daemon = True
+        session.preheatDeadline.start()
+
+        # hotend might already be hot, e.g. when calibrating several times in a row
+        session.preheatEstimator = PreheatEstimator()
+        temps = self._printer.get_current_temperatures().get("tool%d" % session.toolIndex, {})
+        self._checkToolPreheated(session, temps.get("actual"), self._clock())
+
+    # Adds the temperature sample to the session's heating curve and updates the ETA.
+    # Returns True if the temperature is stable at the target (and the state was switched).
+    def _checkToolPreheated(self, session, actualTemp, sampledAt):
+        if actualTemp is None:
+            return False
+        session.currTemp = actualTemp
+        session.preheatEstimator.addSample(sampledAt, actualTemp)
+        estimate = session.preheatEstimator.estimate(session.toolTemperature, EStepsCalibrationTool.PREHEAT_TOLERANCE)
+        session.preheatEta = estimate["etaSeconds"]
+        if not estimate["stable"]:
+            return False
+        self._logger.info("Hotend of tool %d is stable at target temperature (%.2f of %d).", session.toolIndex, actualTemp, session.toolTemperature)
+        self._cancelPreheatDeadline(session)
+        session.preheatEta = None
+        self._switchState(session, EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_START)
+        if session.startExtrudingClicked:
+            # user is already ready for extrude
+            self._requestExtrusion(session)
+        return True
+
+    # pylint: disable=no-self-use
+    def _cancelPreheatDeadline(self, session):
+        if session.preheatDeadline is not None:
+            session.preheatDeadline.cancel()
+            session.preheatDeadline = None
+
+    # Restarts the wait for the user if the session entered a state waiting for them, see USER_WAIT_STATES
+    def _restartInactivityDeadline(self, session):
+        self._cancelInactivityDeadline(session)
+        if session.state not in EStepsCalibrationTool.USER_WAIT_STATES:
+            return
+        session.inactivityDeadline = threading.Timer(self._settings.get_int(["eStepsInactivityTimeout"]), self._executor.submit, \
+            args=[self._sessionInactive, session.toolIndex, session.stateEnteredAt])
+        session.inactivityDeadline.daemon = True
+        session.inactivityDeadline.start()
+
+    # pylint: disable=no-self-use
+    def _cancelInactivityDeadline(self, session):
+        if session.inactivityDeadline is not None:
+            session.inactivityDeadline.cancel()
+            session.inactivityDeadline = None
+
+    # stateEnteredAt: time the state was entered when the deadline was started, the session might have left it since
+    def _sessionInactive(self, toolIndex, stateEnteredAt):
+        session = self._getSession(toolIndex)
+        if session.state not in EStepsCalibrationTool.USER_WAIT_STATES or session.stateEnteredAt != stateEnteredAt:
+            return
+        session.inactivityDeadline = None
+        reason = "E steps calibration of tool %d was cancelled after waiting %d seconds for the user in state %s." % \
+            (toolIndex, self._settings.get_int(["eStepsInactivityTimeout"]), session.state.name)
+        self._logger.error(reason)
+        self._endSession(session, "error " + reason)
+        self._pushError(reason, toolIndex)
+
+    # Ends the session of a cancelled or abandoned calibration: the hotend is turned off and the unfinished session is stored
+    def _endSession(self, session, event):
+        self._printer.set_temperature("tool%d" % session.toolIndex, 0)
+        self._traceEvent(session, event)
+        self._resetSession(session)
+        self._switchState(session, EStepsCalibrationTool.State.IDLE)
+
+    def _preheatTimedOut(self, toolIndex):
+        session = self._getSession(toolIndex)
+        if session.state != EStepsCalibrationTool.State.WAITING_FOR_EXTRUDER_TEMP:
+            return
+        reason = "Hotend of tool %d did not reach target temperature %d within %d seconds." % \
+            (toolIndex, session.toolTemperature, self._settings.get_int(["preheatTimeout"]))
+        self._logger.error(reason)
+        session.preheatDeadline = None
+        session.preheatEta = None
+        self._printer.set_temperature("tool%d" % toolIndex, 0)
+        self._traceEvent(session, "error " + reason)
+        self._abortSession(session)
+        self._switchState(session, EStepsCalibrationTool.State.IDLE)
+        self._pushError(reason, toolIndex)
+
+
+# State of the e steps calibration of one extruder, only accessed on the executor of EStepsCalibrationTool
+class EStepsCalibrationSession(object):
+    def __init__(self, toolIndex):
+        self.toolIndex = toolIndex
+        self.state = EStepsCalibrationTool.State.IDLE
+        self.startExtrudingClicked = False
+        self.extrusionQueued = False
+        # e steps currently applied in the firmware and the ones read at the start of the session
+        self.eSteps = 0.0
+        self.originalESteps = 0.0
+        self.newEsteps = 0.0
+        self.toolTemperature = 0
+        self.newEstepsValid = False
+        self.filamentName = ""
+        self.filamentType = ""
+        self.currTemp = None
+        # heating curve and estimated seconds until preheated, only while waiting for the target temperature
+        self.preheatEstimator = None
+        self.preheatEta = None
+        # clock time the extrusion commands were sent
+        self.extrusionStartedAt = None
+        # deadline for reaching the target temperature, cancelled as soon as it is reached
+        self.preheatDeadline = None
+        # deadline for the next action of the user, see EStepsCalibrationTool.USER_WAIT_STATES
+        self.inactivityDeadline = None
+        # last state pushed to the frontend, only changes to it are pushed
+        self.lastPushedState = {}
+        # id of the running calibration (None if none), monotonic time the current state was entered
+        # and seconds spent per phase so far, see EStepsCalibrationTool.PHASES
+        self.sessionId = None
+        self.stateEnteredAt = None
+        self.phaseDurations = {}
+        # temperature samples and events of the running calibration (None if none), stored when it ends
+        self.trace = None
+        # iterative calibration: passes are repeated with the estimated e steps applied until the estimate changes
+        # less than passTolerance (relative) or maxPasses are done, see EStepsCalibrationTool._eStepsMeasured
+        self.iterative = False
+        self.passTolerance = 0.0
+        self.maxPasses = 1
+        # dicts of the measured passes, see EStepsCalibrationTool._buildToolState
+        self.passes = []
+        self.converged = False
+        # half width of the 95 % confidence interval of newEsteps, None for a single pass
+        self.confidenceHalfWidth = None
+        # earlier calibrations of the filament, see EStepsCalibrationTool._loadFilamentHistory
+        self.history = None
+        # quick verification of a filament calibrated before: shorter extrusion, verified if the e steps were confirmed
+        self.quickVerify = False
+        self.extrusionLength = EStepsCalibrationTool.EXTRUSION_LENGTH
+        self.verified = False
+
+
+# PID autotune (M303) of a hotend or the heated bed. The firmware heats and cools the heater on its own
+# and reports every cycle, the report lines are parsed one by one on the comm thread as they arrive.
+# Only one autotune runs at a time, the firmware does not process other commands while it runs.
+class PidAutotuneTool(object):
+    # see ToolRegistry
+    NAME = "pidAutotune"
+    START_COMMANDS = ("startPidAutotune",)
+
+    # clock: monotonic time in seconds (replaced by simulations)
+    def __init__(self, parentLogger, clock=time.monotonic):
+        self._logger = logging.getLogger(parentLogger.name + "." + self.__class__.__name__)
+        self._clock = clock
+        self._calibPluginInstance = None
+        self._databaseManager = None
+        self._printer = None
+        self._settings = None
+        self._executor = None
+        self._state = PidAutotuneTool.State.IDLE
+        # the running or last finished autotune, None before the first one
+        self._run = None
+        self._deadline = None
+        # last state pushed to the frontend, only changes to it are pushed
+        self._lastPushedState = {}
+        # matcher for the report lines awaited in the current state (read on the comm thread for every received line)
+        self.serialMatcher = None
+        # temperature report key of the autotuned heater while it runs, e.g. "T0" or "B" (read on the comm thread as well)
+        self._tracedHeaterKey = None
+        # see EStepsCalibrationTool.setSubscriptionListener
+        self._subscriptionListener = None
+
+    class State(Enum):
+        IDLE = 1
+        RUNNING = 2
+        # the firmware reported the end of the autotune, the final gains follow
+        WAITING_FOR_RESULT = 3
+        WAITING_FOR_USER_CONFIRM = 4
+
+    # Marlin's M303 output, e.g.
+    #   Recv: PID Autotune start
+    #   Recv:  bias: 92 d: 92 min: 196.56 max: 203.75
+    #   Recv:  bias: 105 d: 105 min: 196.88 max: 203.91 Ku: 38.05 Tu: 19.42
+    #   Recv:  Classic PID
+    #   Recv:  Kp: 22.83 Ki: 2.35 Kd: 55.42
+    #   ...
+    #   Recv: PID Autotune finished! Put the last Kp, Ki and Kd constants from below into Configuration.h
+    #   Recv: #define DEFAULT_Kp 22.20       (DEFAULT_bedKp etc. for the bed)
+    #   Recv: #define DEFAULT_Ki 1.08
+    #   Recv: #define DEFAULT_Kd 114.40
+    #   Recv: ok
+    # The lines of all states are matched by one pattern (the final gains may be received before the executor
+    # processed the end of the autotune), _onSerialMatch decides by the state.
+    _NUMBER = r"-?\d+(?:\.\d+)?"
+    SERIAL_MATCHER = re.compile("|".join([
+        r"\bbias:\s*(?P<bias>%s)\s+d:\s*(?P<d>%s)\s+min:\s*(?P<min>%s)\s+max:\s*(?P<max>%s)(?:\s+Ku:\s*(?P<ku>%s)\s+Tu:\s*(?P<tu>%s))?" % \
+            ((_NUMBER,) * 6),
+        r"\bKp:\s*(?P<kp>%s)\s+Ki:\s*(?P<ki>%s)\s+Kd:\s*(?P<kd>%s)" % ((_NUMBER,) * 3),
+        r"(?P<finished>PID Autotune finished)",
+        r"PID Autotune failed!?\s*(?P<failed>.*)",
+        r"#define\s+DEFAULT_(?:bed)?K(?P<defineTerm>[pid])\s+(?P<defineValue>%s)" % _NUMBER,
+        r"^\s*(?P<ok>ok)\b"
+    ]), re.IGNORECASE)
+
+    # Allowed target temperatures per heater kind and number of cycles (Marlin's limits)
+    HOTEND_TEMPERATURE_RANGE = (150, 350)
+    BED_TEMPERATURE_RANGE = (40, 130)
+    CYCLES_RANGE = (3, 20)
+
+    def initialize(self, calibPluginInstance, databaseManager, printer, settings):
+        self._calibPluginInstance = calibPluginInstance
+        self._databaseManager = databaseManager
+        self._printer = printer
+        self._settings = settings
+        # owns the state machine, see handleApiCommand
+        self._executor = SerialExecutor(self._logger, self.__class__.__name__)
+
+    # True while an autotune is running or its result is not yet confirmed (read from other threads)
+    def isBusy(self):
+        return self._state != PidAutotuneTool.State.IDLE
+
+    def setSubscriptionListener(self, listener):
+        self._subscriptionListener = listener
+
+    def getToolState(self):
+        return self._buildToolState()
+
+    # pylint: disable=no-self-use
+    def getApiCommands(self):
+        return dict(
+            # heater: "tool0", "tool1", ... or "bed"
+            startPidAutotune=["heater", "targetTemp", "cycles"],
+            applyPidAutotune=[],
+            discardPidAutotune=[],
+        )
+
+    # Validates the command's parameters on the calling (request) thread and enqueues the command
+    # for the state machine, like EStepsCalibrationTool.handleApiCommand
+    def handleApiCommand(self, command, data):
+        if not self._calibPluginInstance.isOperational():
+            reason = "Not operational. Cannot autotune PID. E.g. printer must not be in PRINTING, PAUSED, ERROR etc. state."
+            self._logger.error(reason)
+            return False, reason
+
+        if command == "startPidAutotune":
+            heater = str(data["heater"])
+            if heater == "bed":
+                if not self._calibPluginInstance.hasHeatedBed():
+                    reason = "Printer profile has no heated bed."
+                    self._logger.error(reason)
+                    return False, reason
+                temperatureRange = PidAutotuneTool.BED_TEMPERATURE_RANGE
+            else:
+                extruderCount = self._calibPluginInstance.getExtruderCount()
+                match = re.match(r"^tool(\d+)$", heater)
+                if match is None or int(match.group(1)) >= extruderCount:
+                    reason = "Given heater '%s' must be one of tool0 to tool%d or bed." % (heater, extruderCount - 1)
+                    self._logger.error(reason)
+                    return False, reason
+                temperatureRange = PidAutotuneTool.HOTEND_TEMPERATURE_RANGE
+
+            try:
+                targetTemp = int(data["targetTemp"])
+                cycles = int(data["cycles"])
+            except ValueError:
+                reason = "Given values '%s' for 'targetTemp' and '%s' for 'cycles' must be integers." % (data["targetTemp"], data["cycles"])
+                self._logger.error(reason)
+                return False, reason
+            if targetTemp < temperatureRange[0] or targetTemp > temperatureRange[1]:
+                reason = "Given target temperature %d is out of allowed range [%d;%d]." % ((targetTemp,) + temperatureRange)
+                self._logger.error(reason)
+                return False, reason
+            if cycles < PidAutotuneTool.CYCLES_RANGE[0] or cycles > PidAutotuneTool.CYCLES_RANGE[1]:
+                reason = "Given cycles %d is out of allowed range [%d;%d]." % ((cycles,) + PidAutotuneTool.CYCLES_RANGE)
                 self._logger.error(reason)
                 return False, reason
-            self._logger.info("Command received: saveNewESteps")
 
-            self._printer.set_temperature("tool0", 0)
-            self._printer.commands(["M92 E%.2f" % self._newEsteps, "M500", "G90"])
+            self._executor.submit(self._startPidAutotune, heater, targetTemp, cycles)
 
-            self._logger.info("E steps calibration procedure finished")
+        if command == "applyPidAutotune":
+            self._executor.submit(self._applyPidAutotune)
 
-            eStepsCalibModel = EStepsCalibrationModel()
-            eStepsCalibModel.filamentName = self._filamentName
-            eStepsCalibModel.filamentType = self._filamentType
-            eStepsCalibModel.hotendTemperature = self._toolTemperature
-            eStepsCalibModel.oldESteps = round(self._eSteps, 2)
-            eStepsCalibModel.newESteps = round(self._newEsteps, 2)
-            self._databaseManager.insertEstepsCalibration(eStepsCalibModel)
+        if command == "discardPidAutotune":
+            self._executor.submit(self._discardPidAutotune)
 
         return True, ""
 
+    # Called on the comm thread for every received line while serialMatcher is set
     # pylint: disable=unused-argument
     def handleGcodeReceived(self, comm, line, *args, **kwargs):
-        line_lower = line.lower()
-
-        # Recv: echo: M92 X80.0 Y80.0 Z800.0 E90.0
-        if "m92" in line_lower and self._state == EStepsCalibrationTool.State.WAITING_FOR_M92_ANSWER:
-            parts = line_lower.split(" ")
-            eStepsStr = parts[len(parts) - 1][1:]
-            self._logger.info("E steps got from printer: %s", eStepsStr)
-            self._eSteps = float(eStepsStr)
-            self._switchState(EStepsCalibrationTool.State.WAITING_FOR_EXTRUDER_TEMP)
-            threading.Timer(3.0, self._preheatWait).start()
+        matcher = self.serialMatcher
+        if matcher is None:
+            return
+        match = matcher.search(line)
+        if match is None:
+            return
+        self._executor.submit(self._onSerialMatch, match)
 
-        if self._state == EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_FINISHED and "ok" in line_lower:
-            self._switchState(EStepsCalibrationTool.State.WAITING_FOR_MEASUREMENT_INPUT)
+    # parsedTemps as passed to the octoprint.comm.protocol.temperatures.received hook
+    def handleTemperaturesReceived(self, parsedTemps):
+        heaterKey = self._tracedHeaterKey
+        if heaterKey is None:
+            return
+        temps = parsedTemps.get(heaterKey)
+        if temps is not None and temps[0] is not None:
+            self._executor.submit(self._onHeaterTemperature, temps[0])
 
     def handlePrinterDisconnected(self):
-        self._state = EStepsCalibrationTool.State.IDLE
+        self._executor.submit(self._onPrinterDisconnected)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    ##################
+    ### State machine, only called on the executor
+
+    def _startPidAutotune(self, heater, targetTemp, cycles):
+        if self._state in (PidAutotuneTool.State.RUNNING, PidAutotuneTool.State.WAITING_FOR_RESULT):
+            self._reportWrongState()
+            return
+
+        self._run = PidAutotuneRun(uuid.uuid4().hex, heater, targetTemp, cycles, self._clock())
+        self._logger.info("Starting PID autotune of %s at %d degrees with %d cycles.", heater, targetTemp, cycles)
+        # E-1 is the bed
+        heaterParameter = -1 if heater == "bed" else int(heater[len("tool"):])
+        self._printer.commands("M303 E%d S%d C%d" % (heaterParameter, targetTemp, cycles))
+
+        self._cancelDeadline()
+        self._deadline = threading.Timer(self._settings.get_int(["pidAutotuneTimeout"]), self._executor.submit, \
+            args=[self._autotuneTimedOut, self._run.sessionId])
+        self._deadline.daemon = True
+        self._deadline.start()
+
+        self._switchState(PidAutotuneTool.State.RUNNING)
+
+    def _applyPidAutotune(self):
+        if self._state != PidAutotuneTool.State.WAITING_FOR_USER_CONFIRM:
+            self._reportWrongState()
+            return
+        run = self._run
+        gains = "P%.2f I%.2f D%.2f" % (run.kp, run.ki, run.kd)
+        if run.heater == "bed":
+            command = "M304 " + gains
+        elif self._calibPluginInstance.getExtruderCount() > 1:
+            command = "M301 E%d %s" % (int(run.heater[len("tool"):]), gains)
+        else:
+            command = "M301 " + gains
+        self._printer.commands([command, "M500"])
+        self._logger.info("Applied PID gains of %s: %s", run.heater, command)
+        self._databaseManager.markPidAutotuneApplied(run.sessionId)
+        self._switchState(PidAutotuneTool.State.IDLE)
+
+    def _discardPidAutotune(self):
+        if self._state != PidAutotuneTool.State.WAITING_FOR_USER_CONFIRM:
+            self._reportWrongState()
+            return
+        # the result stays in the database, marked as not applied
+        self._switchState(PidAutotuneTool.State.IDLE)
+
+    def _onSerialMatch(self, match):
+        # the state might have changed since the line was matched on the comm thread
+        groups = match.groupdict()
+        run = self._run
+        if self._state == PidAutotuneTool.State.RUNNING:
+            if groups.get("bias") is not None:
+                run.cycles.append(dict(
+                    bias=int(float(groups["bias"])),
+                    d=int(float(groups["d"])),
+                    minTemperature=float(groups["min"]),
+                    maxTemperature=float(groups["max"]),
+                    ku=_toFloatOrNone(groups["ku"]),
+                    tu=_toFloatOrNone(groups["tu"]),
+                    kp=None, ki=None, kd=None
+                ))
+                self._pushStateUpdate()
+            elif groups.get("kp") is not None:
+                # gains calculated from the latest cycle
+                gains = dict(kp=float(groups["kp"]), ki=float(groups["ki"]), kd=float(groups["kd"]))
+                if run.cycles:
+                    run.cycles[-1].update(gains)
+                run.kp, run.ki, run.kd = gains["kp"], gains["ki"], gains["kd"]
+                self._pushStateUpdate()
+            elif groups.get("finished") is not None:
+                self._switchState(PidAutotuneTool.State.WAITING_FOR_RESULT)
+            elif groups.get("failed") is not None:
+                self._autotuneFailed("PID autotune of %s failed: %s" % (run.heater, groups["failed"].strip() or "unknown reason"))
+        elif self._state == PidAutotuneTool.State.WAITING_FOR_RESULT:
+            if groups.get("defineTerm") is not None:
+                setattr(run, "k" + groups["defineTerm"].lower(), float(groups["defineValue"]))
+                run.definedTerms.add(groups["defineTerm"].lower())
+                if len(run.definedTerms) == 3:
+                    self._autotuneFinished()
+            elif groups.get("ok") is not None:
+                # firmware without "#define" lines, the gains of the last cycle are the result
+                self._autotuneFinished()
+
+    def _onHeaterTemperature(self, actualTemp):
+        if self._state != PidAutotuneTool.State.RUNNING:
+            return
+        self._run.currTemp = actualTemp
+        self._pushStateUpdate()
+
+    def _onPrinterDisconnected(self):
+        if self._state in (PidAutotuneTool.State.RUNNING, PidAutotuneTool.State.WAITING_FOR_RESULT):
+            self._cancelDeadline()
+            self._switchState(PidAutotuneTool.State.IDLE)
+            self._pushError("Printer disconnected during the PID autotune of %s." % self._run.heater)
+
+    def _autotuneTimedOut(self, sessionId):
+        if self._run is None or self._run.sessionId != sessionId or \
+            self._state not in (PidAutotuneTool.State.RUNNING, PidAutotuneTool.State.WAITING_FOR_RESULT):
+            return
+        self._deadline = None
+        self._autotuneFailed("PID autotune of %s did not finish within %d seconds." % (self._run.heater, self._settings.get_int(["pidAutotuneTimeout"])))
 
     ##################
     ### Internal stuff
 
+    def _autotuneFinished(self):
+        self._cancelDeadline()
+        run = self._run
+        if run.kp is None or run.ki is None or run.kd is None:
+            self._autotuneFailed("PID autotune of %s finished without reporting gains." % run.heater)
+            return
+        run.durationSeconds = self._clock() - run.startedAt
+        self._logger.info("PID autotune of %s finished after %.0f s: Kp %.2f Ki %.2f Kd %.2f", \
+            run.heater, run.durationSeconds, run.kp, run.ki, run.kd)
+
+        # the last cycle with Ku and Tu reported is the one the final gains are calculated from
+        lastCycle = next((cycle for cycle in reversed(run.cycles) if cycle["ku"] is not None), {})
+        pidAutotuneModel = PidAutotuneModel()
+        pidAutotuneModel.sessionId = run.sessionId
+        pidAutotuneModel.heater = run.heater
+        pidAutotuneModel.targetTemperature = run.targetTemp
+        pidAutotuneModel.requestedCycles = run.requestedCycles
+        pidAutotuneModel.kp = run.kp
+        pidAutotuneModel.ki = run.ki
+        pidAutotuneModel.kd = run.kd
+        pidAutotuneModel.ku = lastCycle.get("ku")
+        pidAutotuneModel.tu = lastCycle.get("tu")
+        pidAutotuneModel.durationSeconds = run.durationSeconds
+        cycleRows = [dict(cycle, sessionId=run.sessionId, cycleIndex=cycleIndex) for cycleIndex, cycle in enumerate(run.cycles)]
+        self._databaseManager.insertPidAutotune(pidAutotuneModel, cycleRows)
+
+        self._switchState(PidAutotuneTool.State.WAITING_FOR_USER_CONFIRM)
+
+    def _autotuneFailed(self, reason):
+        self._logger.error(reason)
+        self._cancelDeadline()
+        # the firmware turns the heater off itself on failures, this covers timeouts
+        self._printer.set_temperature(self._run.heater, 0)
+        self._switchState(PidAutotuneTool.State.IDLE)
+        self._pushError(reason)
+
+    def _cancelDeadline(self):
+        if self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+
+    def _buildToolState(self):
+        run = self._run or PidAutotuneRun(None, "", 0, 0, None)
+        return dict(
+            pidToolState=str(self._state.value),
+            sessionId=run.sessionId or "",
+            heater=run.heater,
+            targetTemp=str(run.targetTemp),
+            requestedCycles=str(run.requestedCycles),
+            # list of dicts (bias, d, minTemperature, maxTemperature, ku, tu, kp, ki, kd), gains are None until reported
+            cycles=[dict(cycle) for cycle in run.cycles],
+            kp="%.2f" % run.kp if run.kp is not None else "",
+            ki="%.2f" % run.ki if run.ki is not None else "",
+            kd="%.2f" % run.kd if run.kd is not None else "",
+            currTemp="%.2f" % run.currTemp if run.currTemp is not None else ""
+        )
+
+    # Pushes all values of the state that changed since the last push to the frontend
+    def _pushStateUpdate(self):
+        state = self._buildToolState()
+        delta = {key: value for key, value in state.items() if self._lastPushedState.get(key) != value}
+        if not delta:
+            return
+        self._lastPushedState = state
+        self._calibPluginInstance.sendPluginMessage(dict(tool=PidAutotuneTool.NAME, type="stateUpdate", data=delta))
+
+    def _reportWrongState(self):
+        reason = "Wrong state detected for PID autotune: %s" % self._state
+        self._logger.error(reason)
+        self._pushError(reason)
+
+    def _pushError(self, reason):
+        self._calibPluginInstance.sendPluginMessage(dict(tool=PidAutotuneTool.NAME, type="error", message=reason))
+
     def _switchState(self, newState):
         oldState = self._state
         self._state = newState
-        self._logger.info("Switching from state %s to state %s.", str(oldState), str(newState))
+        awaitsSerial = newState in (PidAutotuneTool.State.RUNNING, PidAutotuneTool.State.WAITING_FOR_RESULT)
+        self.serialMatcher = PidAutotuneTool.SERIAL_MATCHER if awaitsSerial else None
+        self._tracedHeaterKey = self._getHeaterKey(self._run.heater) if newState == PidAutotuneTool.State.RUNNING else None
+        if self._subscriptionListener is not None:
+            self._subscriptionListener(self, self.serialMatcher is not None, self._tracedHeaterKey is not None)
+        self._logger.info("Switching PID autotune from state %s to state %s.", str(oldState), str(newState))
+        self._pushStateUpdate()
 
-    def _extrudeFilament(self):
-        self._startExtrudingClicked = False
-        self._printer.commands(["G91", "G1 E100 F50"])
+    # Key of the heater in the parsed temperatures, e.g. "tool1" -> "T1"
+    # pylint: disable=no-self-use
+    def _getHeaterKey(self, heater):
+        if heater == "bed":
+            return "B"
+        return "T" + heater[len("tool"):]
 
-        # need to wait till extrude is finished
-        self._switchState(EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_FINISHED)
 
-    def _preheatWait(self):
-        if self._state != EStepsCalibrationTool.State.WAITING_FOR_EXTRUDER_TEMP:
-            self._logger.info("Wrong state detected: %s", self._state)
-            return
-        temps = self._printer.get_current_temperatures()
-        self._logger.info("temps: %s", str(temps))
-        toolReady = True
-        if temps['tool0']['actual'] + 3 < temps['tool0']['target']:
-            toolReady = False
-        if toolReady:
-            self._switchState(EStepsCalibrationTool.State.WAITING_FOR_EXTRUDE_START)
-            if self._startExtrudingClicked:
-                # user is already ready for extrude
-                self._extrudeFilament()
-        else:
-            self._logger.info("Preheating...")
-            threading.Timer(3.0, self._preheatWait).start()
+def _toFloatOrNone(value):
+    return float(value) if value is not None else None
+
+
+# Two-sided 95 % quantiles of Student's t distribution by degrees of freedom
+T_QUANTILES_95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228}
+
+# Returns (mean, half width of its 95 % confidence interval) of the values, the half width is None for a single value.
+# The passes of a calibration are few, so the interval uses the t distribution instead of the normal distribution.
+def _meanConfidenceInterval(values):
+    n = len(values)
+    mean = sum(values) / float(n)
+    if n < 2:
+        return mean, None
+    standardDeviation = math.sqrt(sum((value - mean) ** 2 for value in values) / (n - 1))
+    return mean, T_QUANTILES_95.get(n - 1, 1.96) * standardDeviation / math.sqrt(n)
+
+
+# Running or last finished PID autotune, only accessed on the executor of PidAutotuneTool
+class PidAutotuneRun(object):
+    def __init__(self, sessionId, heater, targetTemp, requestedCycles, startedAt):
+        self.sessionId = sessionId
+        self.heater = heater
+        self.targetTemp = targetTemp
+        self.requestedCycles = requestedCycles
+        self.startedAt = startedAt
+        self.durationSeconds = None
+        self.currTemp = None
+        # one dict per reported cycle, see PidAutotuneTool._onSerialMatch
+        self.cycles = []
+        # latest gains, the final ones are reported in "#define" lines after the end of the autotune
+        self.kp = None
+        self.ki = None
+        self.kd = None
+        self.definedTerms = set()
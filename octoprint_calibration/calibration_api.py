@@ -1,15 +1,517 @@
 # coding=utf-8
 # pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
 
+import csv
+import datetime
+import decimal
+import io
+import json
+
 import octoprint.plugin
+from octoprint.filemanager.storage import StorageError
 import flask
+import peewee
+
+from octoprint_calibration.call_timer import timedCall
+from octoprint_calibration.database_manager import DatabaseManager
+from octoprint_calibration.models import CalibrationPrintModel
 
 #############################################################
 # Internal API for all Frontend communications
 #############################################################
 class CalibrationAPI(octoprint.plugin.BlueprintPlugin):
+    MAX_PAGE_SIZE = 200
+
+    # The POST routes change state, the frontend sends OctoPrint's CSRF header with every request (jQuery).
+    # Requests authenticated by API key (e.g. imports with curl) are not checked by OctoPrint.
+    # pylint: disable=no-self-use
+    def is_blueprint_csrf_protected(self):
+        return True
+
+    # Query parameters:
+    #   limit           - page size (default: setting 'entriesPerPageForTables', max MAX_PAGE_SIZE)
+    #   after           - cursor of the previous page ('nextCursor' of its response)
+    #   filamentName    - only calibrations of this filament
+    #   filamentType    - only calibrations of this filament type
+    #   createdFrom     - only calibrations created on or after this date (YYYY-MM-DD)
+    #   createdTo       - only calibrations created on or before this date (YYYY-MM-DD)
+    #   sortBy          - one of DatabaseManager.SORTABLE_ESTEPS_COLUMNS (default: created)
+    #   sortOrder       - asc or desc (default: desc)
+    #
+    # Responses are cached until the next write to the database and carry an ETag,
+    # a request with a matching If-None-Match header is answered with 304.
     @octoprint.plugin.BlueprintPlugin.route("/eStepCalibrations", methods=["GET"])
+    @timedCall("api.GET /eStepCalibrations")
     def getAllEStepCalibrations(self):
-        calibs = self._databaseManager.loadAllEStepCalibrations()
-        self._logger.info("calibs=%s", str(calibs))
-        return flask.jsonify(calibs)
+        args = flask.request.args
+        cacheKey = ("/eStepCalibrations", self._settings.get_int(["entriesPerPageForTables"])) + tuple(sorted(args.items(multi=True)))
+        dataVersion = self._databaseManager.getDataVersion()
+        cached = self._responseCache.get(cacheKey, dataVersion)
+        if cached is not None:
+            return self._makeCachedResponse(*cached)
+
+        try:
+            limit = int(args.get("limit", self._settings.get_int(["entriesPerPageForTables"])))
+        except ValueError:
+            return flask.Response(response="Given value '%s' for 'limit' is not an integer." % args.get("limit"), status=400)
+        if limit < 1 or limit > CalibrationAPI.MAX_PAGE_SIZE:
+            return flask.Response(response="Given limit %d is out of allowed range [1;%d]." % (limit, CalibrationAPI.MAX_PAGE_SIZE), status=400)
+
+        sortOrder = args.get("sortOrder", "desc")
+        if sortOrder not in ("asc", "desc"):
+            return flask.Response(response="Given sort order '%s' must be either 'asc' or 'desc'." % sortOrder, status=400)
+
+        try:
+            createdFrom = self._parseDateArg(args.get("createdFrom"))
+            createdTo = self._parseDateArg(args.get("createdTo"))
+            if createdTo is not None:
+                # the whole day is included
+                createdTo = createdTo + datetime.timedelta(days=1, microseconds=-1)
+
+            calibs, nextCursor = self._databaseManager.loadEStepCalibrationsPage(
+                limit,
+                after=args.get("after"),
+                filamentName=args.get("filamentName"),
+                filamentType=args.get("filamentType"),
+                createdFrom=createdFrom,
+                createdTo=createdTo,
+                sortBy=args.get("sortBy", "created"),
+                sortDescending=sortOrder == "desc")
+        except ValueError as e:
+            return flask.Response(response=str(e), status=400)
+
+        self._logger.debug("Loaded %d e steps calibrations, nextCursor=%s", len(calibs), nextCursor)
+        body = flask.json.dumps(dict(items=calibs, nextCursor=nextCursor)).encode("utf-8")
+        etag = self._responseCache.put(cacheKey, dataVersion, body)
+        return self._makeCachedResponse(etag, body)
+
+    # Statistics of all e steps calibrations per filament (name and type), see DatabaseManager.loadFilamentStatistics
+    @octoprint.plugin.BlueprintPlugin.route("/eStepCalibrations/statistics", methods=["GET"])
+    @timedCall("api.GET /eStepCalibrations/statistics")
+    def getEStepCalibrationStatistics(self):
+        cacheKey = ("/eStepCalibrations/statistics",)
+        dataVersion = self._databaseManager.getDataVersion()
+        cached = self._responseCache.get(cacheKey, dataVersion)
+        if cached is not None:
+            return self._makeCachedResponse(*cached)
+
+        body = flask.json.dumps(dict(filaments=self._databaseManager.loadFilamentStatistics())).encode("utf-8")
+        etag = self._responseCache.put(cacheKey, dataVersion, body)
+        return self._makeCachedResponse(etag, body)
+
+    # Trend of the new e steps over time, see DatabaseManager.loadEStepsTrend
+    # Query parameters:
+    #   bucket          - day, week or month (default: week)
+    #   filamentName    - only calibrations of this filament
+    #   filamentType    - only calibrations of this filament type
+    @octoprint.plugin.BlueprintPlugin.route("/eStepCalibrations/trend", methods=["GET"])
+    @timedCall("api.GET /eStepCalibrations/trend")
+    def getEStepCalibrationTrend(self):
+        args = flask.request.args
+        cacheKey = ("/eStepCalibrations/trend",) + tuple(sorted(args.items(multi=True)))
+        dataVersion = self._databaseManager.getDataVersion()
+        cached = self._responseCache.get(cacheKey, dataVersion)
+        if cached is not None:
+            return self._makeCachedResponse(*cached)
+
+        try:
+            trend = self._databaseManager.loadEStepsTrend(
+                args.get("bucket", "week"),
+                filamentName=args.get("filamentName"),
+                filamentType=args.get("filamentType"))
+        except ValueError as e:
+            return flask.Response(response=str(e), status=400)
+
+        body = flask.json.dumps(dict(buckets=trend)).encode("utf-8")
+        etag = self._responseCache.put(cacheKey, dataVersion, body)
+        return self._makeCachedResponse(etag, body)
+
+    # Durations of the phases of all calibration sessions (see DatabaseManager.loadPhaseMetrics) and,
+    # if the setting metrics.timeCalls is enabled, of the latest API and database calls (see CallTimer.snapshot).
+    # Query parameters:
+    #   toolIndex       - only sessions of this extruder
+    #   completedOnly   - true: only sessions which were saved (default: false)
+    @octoprint.plugin.BlueprintPlugin.route("/eStepCalibrations/metrics", methods=["GET"])
+    def getEStepCalibrationMetrics(self):
+        args = flask.request.args
+        toolIndex = args.get("toolIndex")
+        if toolIndex is not None:
+            try:
+                toolIndex = int(toolIndex)
+            except ValueError:
+                return flask.Response(response="Given value '%s' for 'toolIndex' is not an integer." % toolIndex, status=400)
+        completedOnly = args.get("completedOnly", "false").lower() in ("true", "1", "yes")
+
+        return flask.jsonify(dict(
+            phases=self._databaseManager.loadPhaseMetrics(toolIndex=toolIndex, completedOnly=completedOnly),
+            callTimingEnabled=self._callTimer.enabled,
+            calls=self._callTimer.snapshot()
+        ))
+
+    # Latest PID autotunes with their cycles, see DatabaseManager.loadPidAutotunes
+    # Query parameters:
+    #   limit           - number of autotunes (default: setting 'entriesPerPageForTables', max MAX_PAGE_SIZE)
+    #   heater          - only autotunes of this heater (tool0, tool1, ... or bed)
+    @octoprint.plugin.BlueprintPlugin.route("/pidAutotunes", methods=["GET"])
+    @timedCall("api.GET /pidAutotunes")
+    def getPidAutotunes(self):
+        args = flask.request.args
+        cacheKey = ("/pidAutotunes", self._settings.get_int(["entriesPerPageForTables"])) + tuple(sorted(args.items(multi=True)))
+        dataVersion = self._databaseManager.getDataVersion()
+        cached = self._responseCache.get(cacheKey, dataVersion)
+        if cached is not None:
+            return self._makeCachedResponse(*cached)
+
+        try:
+            limit = int(args.get("limit", self._settings.get_int(["entriesPerPageForTables"])))
+        except ValueError:
+            return flask.Response(response="Given value '%s' for 'limit' is not an integer." % args.get("limit"), status=400)
+        if limit < 1 or limit > CalibrationAPI.MAX_PAGE_SIZE:
+            return flask.Response(response="Given limit %d is out of allowed range [1;%d]." % (limit, CalibrationAPI.MAX_PAGE_SIZE), status=400)
+
+        body = flask.json.dumps(dict(items=self._databaseManager.loadPidAutotunes(limit, heater=args.get("heater")))).encode("utf-8")
+        etag = self._responseCache.put(cacheKey, dataVersion, body)
+        return self._makeCachedResponse(etag, body)
+
+    DEFAULT_TRACE_POINTS = 500
+    MAX_TRACE_POINTS = 5000
+
+    # Temperature samples and events of a calibration session (see DatabaseManager.loadSessionTrace), the session id
+    # is part of the tool state and of the stored calibration.
+    # Query parameters:
+    #   points          - maximum number of returned samples, the trace is downsampled on the server (default: DEFAULT_TRACE_POINTS)
+    @octoprint.plugin.BlueprintPlugin.route("/eStepCalibrations/sessions/<sessionId>/trace", methods=["GET"])
+    @timedCall("api.GET /eStepCalibrations/sessions/trace")
+    def getEStepCalibrationSessionTrace(self, sessionId):
+        args = flask.request.args
+        try:
+            points = int(args.get("points", CalibrationAPI.DEFAULT_TRACE_POINTS))
+        except ValueError:
+            return flask.Response(response="Given value '%s' for 'points' is not an integer." % args.get("points"), status=400)
+        if points < 3 or points > CalibrationAPI.MAX_TRACE_POINTS:
+            return flask.Response(response="Given points %d is out of allowed range [3;%d]." % (points, CalibrationAPI.MAX_TRACE_POINTS), status=400)
+
+        cacheKey = ("/eStepCalibrations/sessions/trace", sessionId, points)
+        dataVersion = self._databaseManager.getDataVersion()
+        cached = self._responseCache.get(cacheKey, dataVersion)
+        if cached is not None:
+            return self._makeCachedResponse(*cached)
+
+        trace = self._databaseManager.loadSessionTrace(sessionId, points)
+        if trace is None:
+            return flask.Response(response="No trace of session '%s' found." % sessionId, status=404)
+        body = flask.json.dumps(trace).encode("utf-8")
+        etag = self._responseCache.put(cacheKey, dataVersion, body)
+        return self._makeCachedResponse(etag, body)
+
+    # Passes of a calibration session (see DatabaseManager.loadSessionPasses), a single one unless it was iterative
+    @octoprint.plugin.BlueprintPlugin.route("/eStepCalibrations/sessions/<sessionId>/passes", methods=["GET"])
+    @timedCall("api.GET /eStepCalibrations/sessions/passes")
+    def getEStepCalibrationSessionPasses(self, sessionId):
+        cacheKey = ("/eStepCalibrations/sessions/passes", sessionId)
+        dataVersion = self._databaseManager.getDataVersion()
+        cached = self._responseCache.get(cacheKey, dataVersion)
+        if cached is not None:
+            return self._makeCachedResponse(*cached)
+
+        passes = self._databaseManager.loadSessionPasses(sessionId)
+        if not passes:
+            return flask.Response(response="No passes of session '%s' found." % sessionId, status=404)
+        body = flask.json.dumps(dict(items=passes)).encode("utf-8")
+        etag = self._responseCache.put(cacheKey, dataVersion, body)
+        return self._makeCachedResponse(etag, body)
+
+    # Earlier calibrations of a filament (see DatabaseManager.loadFilamentHistory), shown before a calibration is started
+    # Query parameters:
+    #   filamentName    - name of the filament
+    #   filamentType    - type of the filament
+    @octoprint.plugin.BlueprintPlugin.route("/eStepCalibrations/filamentHistory", methods=["GET"])
+    @timedCall("api.GET /eStepCalibrations/filamentHistory")
+    def getEStepCalibrationFilamentHistory(self):
+        args = flask.request.args
+        filamentName = args.get("filamentName")
+        filamentType = args.get("filamentType")
+        if not filamentName or not filamentType:
+            return flask.Response(response="Query parameters 'filamentName' and 'filamentType' are required.", status=400)
+
+        cacheKey = ("/eStepCalibrations/filamentHistory", filamentName, filamentType)
+        dataVersion = self._databaseManager.getDataVersion()
+        cached = self._responseCache.get(cacheKey, dataVersion)
+        if cached is not None:
+            return self._makeCachedResponse(*cached)
+
+        body = flask.json.dumps(dict(history=self._databaseManager.loadFilamentHistory(filamentName, filamentType))).encode("utf-8")
+        etag = self._responseCache.put(cacheKey, dataVersion, body)
+        return self._makeCachedResponse(etag, body)
+
+    # Monthly rollups of calibration sessions older than the retention period, see DatabaseManager.loadSessionRollups
+    @octoprint.plugin.BlueprintPlugin.route("/eStepCalibrations/rollups", methods=["GET"])
+    @timedCall("api.GET /eStepCalibrations/rollups")
+    def getEStepCalibrationRollups(self):
+        cacheKey = ("/eStepCalibrations/rollups",)
+        dataVersion = self._databaseManager.getDataVersion()
+        cached = self._responseCache.get(cacheKey, dataVersion)
+        if cached is not None:
+            return self._makeCachedResponse(*cached)
+
+        body = flask.json.dumps(dict(items=self._databaseManager.loadSessionRollups())).encode("utf-8")
+        etag = self._responseCache.put(cacheKey, dataVersion, body)
+        return self._makeCachedResponse(etag, body)
+
+    # Size and row counts of the database (see DatabaseManager.loadDatabaseStats) and the state of its
+    # maintenance (see DatabaseMaintenance.getStatus), shown in the settings. Not cached, the file size
+    # also changes without writes of the plugin (e.g. checkpoints of the write ahead log).
+    @octoprint.plugin.BlueprintPlugin.route("/database/stats", methods=["GET"])
+    @timedCall("api.GET /database/stats")
+    def getDatabaseStats(self):
+        stats = self._databaseManager.loadDatabaseStats()
+        stats["maintenance"] = self._databaseMaintenance.getStatus()
+        return flask.jsonify(stats)
+
+    # Starts the database maintenance now instead of waiting for its next scheduled run
+    @octoprint.plugin.BlueprintPlugin.route("/database/maintenance", methods=["POST"])
+    def runDatabaseMaintenance(self):
+        success, reason = self._databaseMaintenance.runNow()
+        if not success:
+            return flask.Response(response=reason, status=400)
+        return flask.jsonify(self._databaseMaintenance.getStatus())
+
+    # Print types of the calibration prints with the defaults of their parameters, see CalibrationGcodeGenerator.getPrintTypes
+    @octoprint.plugin.BlueprintPlugin.route("/calibrationPrints/types", methods=["GET"])
+    def getCalibrationPrintTypes(self):
+        return flask.jsonify(dict(printTypes=self._gcodeGenerator.getPrintTypes()))
+
+    # Latest calibration prints, see DatabaseManager.loadCalibrationPrints
+    # Query parameters:
+    #   limit           - number of prints (default: setting 'entriesPerPageForTables', max MAX_PAGE_SIZE)
+    #   printType       - only prints of this type
+    #   filamentName    - only prints of this filament
+    @octoprint.plugin.BlueprintPlugin.route("/calibrationPrints", methods=["GET"])
+    @timedCall("api.GET /calibrationPrints")
+    def getCalibrationPrints(self):
+        args = flask.request.args
+        cacheKey = ("/calibrationPrints", self._settings.get_int(["entriesPerPageForTables"])) + tuple(sorted(args.items(multi=True)))
+        dataVersion = self._databaseManager.getDataVersion()
+        cached = self._responseCache.get(cacheKey, dataVersion)
+        if cached is not None:
+            return self._makeCachedResponse(*cached)
+
+        try:
+            limit = int(args.get("limit", self._settings.get_int(["entriesPerPageForTables"])))
+        except ValueError:
+            return flask.Response(response="Given value '%s' for 'limit' is not an integer." % args.get("limit"), status=400)
+        if limit < 1 or limit > CalibrationAPI.MAX_PAGE_SIZE:
+            return flask.Response(response="Given limit %d is out of allowed range [1;%d]." % (limit, CalibrationAPI.MAX_PAGE_SIZE), status=400)
+
+        prints = self._databaseManager.loadCalibrationPrints(limit, printType=args.get("printType"), filamentName=args.get("filamentName"))
+        body = flask.json.dumps(dict(items=prints)).encode("utf-8")
+        etag = self._responseCache.put(cacheKey, dataVersion, body)
+        return self._makeCachedResponse(etag, body)
+
+    # Generates the G-code of a calibration print into the folder 'calibration' of the local file storage (or reuses
+    # the file generated before with the same parameters) and stores a calibration print record for the filament.
+    # Expects a JSON body with the keys printType, filamentName, filamentType and parameters (optional, missing
+    # parameters get their defaults, see /calibrationPrints/types). Returns the stored calibration print and
+    # whether its file was cached.
+    @octoprint.plugin.BlueprintPlugin.route("/calibrationPrints", methods=["POST"])
+    @timedCall("api.POST /calibrationPrints")
+    def createCalibrationPrint(self):
+        data = flask.request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return flask.Response(response="Expected a JSON object as request body.", status=400)
+        filamentName = str(data.get("filamentName") or "").strip()
+        filamentType = str(data.get("filamentType") or "").strip()
+        if not filamentName or not filamentType:
+            return flask.Response(response="Filament name and type must not be empty.", status=400)
+        parameters = data.get("parameters") or {}
+        if not isinstance(parameters, dict):
+            return flask.Response(response="Given parameters must be a JSON object.", status=400)
+
+        try:
+            printType = data.get("printType")
+            parameters = self._gcodeGenerator.normalizeParameters(printType, parameters, self.getPrinterVolume())
+            if parameters["toolIndex"] >= self.getExtruderCount():
+                raise ValueError("Given tool index %d is out of allowed range [0;%d)." % (parameters["toolIndex"], self.getExtruderCount()))
+        except ValueError as e:
+            return flask.Response(response=str(e), status=400)
+
+        try:
+            filePath, parametersHash, cached = self._gcodeGenerator.provideFile(printType, parameters)
+        except StorageError as e:
+            reason = "Could not store the calibration print: %s" % str(e)
+            self._logger.error(reason)
+            return flask.Response(response=reason, status=500)
+
+        calibrationPrintModel = CalibrationPrintModel()
+        calibrationPrintModel.printType = printType
+        calibrationPrintModel.parameters = json.dumps(parameters, sort_keys=True)
+        calibrationPrintModel.parametersHash = parametersHash
+        calibrationPrintModel.filePath = filePath
+        calibrationPrintModel.filamentName = filamentName
+        calibrationPrintModel.filamentType = filamentType
+        calibrationPrintModel.toolIndex = parameters["toolIndex"]
+        printId = self._databaseManager.insertCalibrationPrint(calibrationPrintModel).result()
+        if printId is None:
+            return flask.Response(response="Could not store the calibration print in the database.", status=500)
+        return flask.jsonify(dict(calibrationPrint=self._databaseManager.loadCalibrationPrint(printId), cached=cached))
+
+    # Stores the value measured on a calibration print and the setting recommended from it, see
+    # CalibrationGcodeGenerator.evaluateResult. Expects a JSON body with the keys value and note (optional).
+    # Returns the updated calibration print.
+    @octoprint.plugin.BlueprintPlugin.route("/calibrationPrints/<int:printId>/result", methods=["POST"])
+    @timedCall("api.POST /calibrationPrints/result")
+    def storeCalibrationPrintResult(self, printId):
+        data = flask.request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return flask.Response(response="Expected a JSON object as request body.", status=400)
+        calibrationPrint = self._databaseManager.loadCalibrationPrint(printId)
+        if calibrationPrint is None:
+            return flask.Response(response="No calibration print with id %d found." % printId, status=404)
+
+        try:
+            value = float(data.get("value"))
+        except (TypeError, ValueError):
+            return flask.Response(response="Given value '%s' is not a number." % data.get("value"), status=400)
+        try:
+            recommendedValue = self._gcodeGenerator.evaluateResult(calibrationPrint["printType"], calibrationPrint["parameters"], value)
+        except ValueError as e:
+            return flask.Response(response=str(e), status=400)
+
+        note = str(data.get("note") or "").strip() or None
+        self._databaseManager.storeCalibrationPrintResult(printId, value, recommendedValue, note).result()
+        return flask.jsonify(dict(calibrationPrint=self._databaseManager.loadCalibrationPrint(printId)))
+
+    EXPORT_FORMATS = dict(csv="text/csv", ndjson="application/x-ndjson")
+    IMPORT_BATCH_SIZE = 500
+    # upper limit for the body of an import request, see CalibrationPlugin.get_bodysize_limits
+    MAX_IMPORT_SIZE = 50 * 1024 * 1024
+
+    # Imports e steps calibrations from the request body, query parameter 'format' is csv (default) or ndjson.
+    # Expects the format written by the export, e.g.
+    #   curl -H "X-Api-Key: ..." --data-binary @eStepCalibrations.csv "http://octopi/plugin/calibration/eStepCalibrations/import?format=csv"
+    # Calibrations already contained in the database are skipped. Returns the number of inserted and skipped calibrations.
+    @octoprint.plugin.BlueprintPlugin.route("/eStepCalibrations/import", methods=["POST"])
+    @timedCall("api.POST /eStepCalibrations/import")
+    def importEStepCalibrations(self):
+        importFormat = flask.request.args.get("format", "csv")
+        if importFormat not in CalibrationAPI.EXPORT_FORMATS:
+            return flask.Response(response="Given format '%s' must be either 'csv' or 'ndjson'." % importFormat, status=400)
+
+        stream = io.TextIOWrapper(flask.request.stream, encoding="utf-8", newline="")
+        if importFormat == "csv":
+            rawRows = csv.DictReader(stream)
+            firstLineNumber = 2
+        else:
+            rawRows = (json.loads(line) for line in stream if line.strip())
+            firstLineNumber = 1
+
+        inserted = 0
+        skipped = 0
+        pendingBatch = None
+        batch = []
+        try:
+            try:
+                for lineNumber, rawRow in enumerate(rawRows, firstLineNumber):
+                    batch.append(self._parseImportRow(rawRow, lineNumber))
+                    if len(batch) < CalibrationAPI.IMPORT_BATCH_SIZE:
+                        continue
+                    # at most one batch is parsed while the previous one is written, keeps memory usage constant
+                    if pendingBatch is not None:
+                        inserted, skipped = self._addImportResult(pendingBatch, inserted, skipped)
+                    pendingBatch = self._databaseManager.importEStepCalibrations(batch)
+                    batch = []
+            except (ValueError, csv.Error) as e:
+                # batches before the erroneous one have been imported
+                if pendingBatch is not None:
+                    inserted, skipped = self._addImportResult(pendingBatch, inserted, skipped)
+                reason = "%s (%d calibrations imported before)" % (str(e), inserted)
+                self._logger.error(reason)
+                return flask.Response(response=reason, status=400)
+
+            if pendingBatch is not None:
+                inserted, skipped = self._addImportResult(pendingBatch, inserted, skipped)
+            if batch:
+                inserted, skipped = self._addImportResult(self._databaseManager.importEStepCalibrations(batch), inserted, skipped)
+        except peewee.DatabaseError as e:
+            # each batch is written in its own transaction, the failed one was rolled back
+            reason = "Could not store the imported calibrations: %s (%d calibrations imported before)" % (str(e), inserted)
+            self._logger.error(reason)
+            return flask.Response(response=reason, status=500)
+
+        self._logger.info("Imported %d e steps calibrations, skipped %d already existing ones.", inserted, skipped)
+        return flask.jsonify(dict(inserted=inserted, skipped=skipped))
+
+    ### Internal stuff
+    ###
+
+    # Yields all e steps calibrations in the given format (see EXPORT_FORMATS), one chunk per batch of rows.
+    # Columns are DatabaseManager.ESTEPS_EXPORT_COLUMNS, dates are written in ISO 8601 format.
+    # Served by Tornado, see CalibrationPlugin.get_server_routes.
+    def _generateEStepsExport(self, exportFormat):
+        if exportFormat == "csv":
+            yield ",".join(DatabaseManager.ESTEPS_EXPORT_COLUMNS) + "\r\n"
+        for batch in self._databaseManager.iterateEStepCalibrations():
+            chunk = io.StringIO()
+            if exportFormat == "csv":
+                writer = csv.writer(chunk)
+                for row in batch:
+                    writer.writerow(self._toExportValues(row))
+            else:
+                for row in batch:
+                    chunk.write(json.dumps(dict(zip(DatabaseManager.ESTEPS_EXPORT_COLUMNS, self._toExportValues(row)))))
+                    chunk.write("\n")
+            yield chunk.getvalue()
+
+    # pylint: disable=no-self-use
+    def _toExportValues(self, row):
+        created, filamentName, filamentType, hotendTemperature, oldESteps, newESteps, toolIndex = row
+        # names are written like the import reads them (see _parseImportRow)
+        return [created.isoformat(), filamentName.strip(), filamentType.strip(), float(hotendTemperature), float(oldESteps), float(newESteps), toolIndex]
+
+    # pylint: disable=no-self-use
+    def _addImportResult(self, future, inserted, skipped):
+        batchInserted, batchSkipped = future.result()
+        return inserted + batchInserted, skipped + batchSkipped
+
+    # pylint: disable=no-self-use
+    def _parseImportRow(self, rawRow, lineNumber):
+        if not isinstance(rawRow, dict):
+            raise ValueError("Line %d: expected an object with the keys %s." % (lineNumber, ", ".join(DatabaseManager.ESTEPS_EXPORT_COLUMNS)))
+        try:
+            row = dict(
+                created=datetime.datetime.fromisoformat(str(rawRow["created"])),
+                filamentName=str(rawRow["filamentName"]).strip(),
+                filamentType=str(rawRow["filamentType"]).strip(),
+                hotendTemperature=decimal.Decimal(str(rawRow["hotendTemperature"])),
+                oldESteps=decimal.Decimal(str(rawRow["oldESteps"])),
+                newESteps=decimal.Decimal(str(rawRow["newESteps"])),
+                # exports of older plugin versions have no tool index
+                toolIndex=int(rawRow.get("toolIndex") or 0)
+            )
+        except KeyError as e:
+            raise ValueError("Line %d: missing value for %s." % (lineNumber, str(e))) from e
+        except (ValueError, decimal.InvalidOperation) as e:
+            raise ValueError("Line %d: invalid value (%s)." % (lineNumber, str(e))) from e
+        if not row["filamentName"] or not row["filamentType"]:
+            raise ValueError("Line %d: filament name and type must not be empty." % lineNumber)
+        return row
+
+    # pylint: disable=no-self-use
+    def _makeCachedResponse(self, etag, body):
+        if flask.request.if_none_match.contains(etag):
+            response = flask.Response(status=304)
+        else:
+            response = flask.Response(response=body, status=200, mimetype="application/json")
+        response.set_etag(etag)
+        # the browser may store the response but has to revalidate it on every use
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    # pylint: disable=no-self-use
+    def _parseDateArg(self, value):
+        if not value:
+            return None
+        try:
+            return datetime.datetime.strptime(value, "%Y-%m-%d")
+        except ValueError as e:
+            raise ValueError("Given date '%s' is not in format YYYY-MM-DD." % value) from e
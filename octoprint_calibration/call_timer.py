@@ -0,0 +1,76 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import collections
+import functools
+import logging
+import threading
+import time
+
+# Durations of the latest calls per name (API handler, database method), disabled by default
+# (setting metrics.timeCalls), then timed methods only pay for one attribute lookup
+class CallTimer(object):
+    def __init__(self, parentLogger, enabled=False, maxSamples=1000):
+        self._logger = logging.getLogger(parentLogger.name + "." + self.__class__.__name__)
+        self.enabled = enabled
+        self._maxSamples = maxSamples
+        self._lock = threading.Lock()
+        # name -> deque of the latest durations in seconds
+        self._samples = {}
+        # name -> number of calls since start, including the ones dropped from the samples
+        self._counts = collections.Counter()
+
+    def record(self, name, seconds):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = collections.deque(maxlen=self._maxSamples)
+                self._samples[name] = samples
+            samples.append(seconds)
+            self._counts[name] += 1
+
+    # Returns dict name -> dict(count, samples, meanMs, p50Ms, p95Ms, p99Ms, maxMs), percentiles of the latest samples
+    def snapshot(self):
+        with self._lock:
+            samplesByName = {name: sorted(samples) for name, samples in self._samples.items()}
+            counts = dict(self._counts)
+        result = {}
+        for name, samples in samplesByName.items():
+            result[name] = dict(
+                count=counts[name],
+                samples=len(samples),
+                meanMs=sum(samples) / len(samples) * 1000.0,
+                p50Ms=percentile(samples, 0.5) * 1000.0,
+                p95Ms=percentile(samples, 0.95) * 1000.0,
+                p99Ms=percentile(samples, 0.99) * 1000.0,
+                maxMs=samples[-1] * 1000.0
+            )
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._samples = {}
+            self._counts = collections.Counter()
+
+# Nearest rank percentile of sorted values, fraction in [0;1]
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return None
+    index = min(len(sortedValues) - 1, max(0, int(round(fraction * (len(sortedValues) - 1)))))
+    return sortedValues[index]
+
+# Decorator for methods of classes with the attribute _callTimer (a CallTimer or None),
+# records the duration of every call under the given name if timing is enabled.
+def timedCall(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            callTimer = self._callTimer
+            if callTimer is None or not callTimer.enabled:
+                return fn(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                callTimer.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -0,0 +1,130 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import datetime
+import logging
+import threading
+import time
+
+# Periodic rollup of old sessions, cleanup of old PID autotune cycles and compaction of the database file.
+# Only runs while the printer is idle, in small steps on the database writer, and stops once it is busy.
+class DatabaseMaintenance(object):
+    # seconds after the start of OctoPrint until the first run and until a run skipped because of a busy printer is retried
+    FIRST_RUN_DELAY = 600
+    RETRY_DELAY = 900
+    # sessions rolled up and pages freed per step
+    SESSIONS_PER_STEP = 200
+    PAGES_PER_STEP = 1000
+
+    # isIdle: function returning True if the maintenance may run
+    # settings: plugin settings, see "maintenance" in CalibrationPlugin.get_settings_defaults
+    def __init__(self, parentLogger, databaseManager, isIdle, settings):
+        self._logger = logging.getLogger(parentLogger.name + "." + self.__class__.__name__)
+        self._databaseManager = databaseManager
+        self._isIdle = isIdle
+        self._settings = settings
+        self._lock = threading.Lock()
+        self._timer = None
+        self._running = False
+        self._stopped = False
+        # result of the last run (None if there was none yet), see getStatus
+        self._lastRun = None
+
+    def start(self):
+        self._schedule(DatabaseMaintenance.FIRST_RUN_DELAY)
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    # Starts a run in the background, returns (success, reason)
+    def runNow(self):
+        if not self._isIdle():
+            return False, "Database maintenance cannot run while the printer is printing or calibrating."
+        with self._lock:
+            if self._stopped:
+                return False, "Database maintenance is stopped, OctoPrint is shutting down."
+            if self._running:
+                return False, "Database maintenance is already running."
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(0, self._run)
+            self._timer.daemon = True
+            self._timer.start()
+        return True, ""
+
+    # dict with the keys running and lastRun (dict with the keys finished (ISO 8601), durationSeconds, completed,
+    # rolledUpSessions, deletedPidAutotuneCycles and freePages, None if there was no run yet)
+    def getStatus(self):
+        with self._lock:
+            return dict(running=self._running, lastRun=dict(self._lastRun) if self._lastRun is not None else None)
+
+    ##################
+    ### Internal stuff
+
+    def _schedule(self, delay):
+        with self._lock:
+            if self._stopped:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(delay, self._run)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _run(self):
+        with self._lock:
+            if self._running or self._stopped:
+                return
+            self._running = True
+        try:
+            if not self._isIdle():
+                self._logger.info("Printer is busy, database maintenance is postponed.")
+                self._schedule(DatabaseMaintenance.RETRY_DELAY)
+                return
+            completed = self._runSteps()
+            self._schedule(max(1, self._settings.get_int(["maintenance", "intervalHours"])) * 3600 if completed else DatabaseMaintenance.RETRY_DELAY)
+        except Exception as e:
+            self._logger.exception("Database maintenance failed: %s", str(e))
+            self._schedule(max(1, self._settings.get_int(["maintenance", "intervalHours"])) * 3600)
+        finally:
+            with self._lock:
+                self._running = False
+
+    # Returns True if all steps were done, False if the maintenance was interrupted because the printer got busy
+    def _runSteps(self):
+        startedAt = time.monotonic()
+        result = dict(rolledUpSessions=0, deletedPidAutotuneCycles=0, freePages=None)
+        completed = False
+        retentionDays = self._settings.get_int(["maintenance", "detailRetentionDays"])
+        # 0 keeps the detail forever
+        if retentionDays > 0:
+            cutoff = datetime.datetime.now() - datetime.timedelta(days=retentionDays)
+            while self._isIdle():
+                rolledUp = self._databaseManager.rollUpOldSessions(cutoff, DatabaseMaintenance.SESSIONS_PER_STEP).result()
+                result["rolledUpSessions"] += rolledUp
+                if rolledUp < DatabaseMaintenance.SESSIONS_PER_STEP:
+                    break
+            if self._isIdle():
+                result["deletedPidAutotuneCycles"] = self._databaseManager.deleteOldPidAutotuneCycles(cutoff).result()
+        while self._isIdle():
+            freePages = self._databaseManager.compact(DatabaseMaintenance.PAGES_PER_STEP).result()
+            # done once all free pages are returned (or no more can be returned)
+            if freePages == 0 or (result["freePages"] is not None and freePages >= result["freePages"]):
+                completed = True
+            result["freePages"] = freePages
+            if completed:
+                break
+        if completed:
+            # once per run, not per step
+            self._databaseManager.optimize().result()
+
+        result["completed"] = completed
+        result["durationSeconds"] = time.monotonic() - startedAt
+        result["finished"] = datetime.datetime.now().isoformat()
+        self._logger.info("Database maintenance %s: %s", "finished" if completed else "interrupted", str(result))
+        with self._lock:
+            self._lastRun = result
+        return completed
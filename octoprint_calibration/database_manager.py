@@ -1,79 +1,793 @@
 # coding=utf-8
 # pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
 
+import base64
+import datetime
 import decimal
+import json
 import logging
+import math
 import os
+import threading
 
 import peewee
 
+from octoprint_calibration.call_timer import timedCall
+from octoprint_calibration.executor import SerialExecutor
 import octoprint_calibration.models as models
+from octoprint_calibration.schema_migrations import SchemaMigrator
+from octoprint_calibration.session_trace import decodeEvents, decodeSamples, lttbIndices
 
 class DatabaseManager(object):
-    def __init__(self, parentLogger):
+    JOURNAL_MODES = ("wal", "delete", "truncate", "persist", "memory")
+    SYNCHRONOUS_MODES = ("off", "normal", "full", "extra")
+
+    # callTimer: optional CallTimer the durations of the database calls are recorded with
+    def __init__(self, parentLogger, callTimer=None):
         self._logger = logging.getLogger(parentLogger.name + "." + self.__class__.__name__)
+        self._callTimer = callTimer
 
         self._database = None
         self._databaseFileAbsPath = None
+        # all writes are done on this executor, callers never block on disk I/O
+        self._writeExecutor = None
+        # incremented after every write, used to invalidate cached responses
+        self._dataVersion = 0
+        # set once the schema is migrated (or the migration failed), see _setUpSchema
+        self._schemaReady = threading.Event()
+        self._schemaVersion = None
 
-    def initialize(self, databaseFileDirectory):
+    # databaseSettings is the "database" dict of the plugin settings, see CalibrationPlugin.get_settings_defaults.
+    # Does not touch the database file: the schema is migrated in the background (see _setUpSchema), so a large
+    # database on a slow SD card does not delay the start of OctoPrint.
+    def initialize(self, databaseFileDirectory, databaseSettings):
         self._databaseFileAbsPath = os.path.join(databaseFileDirectory, "calibration.db")
 
         self._logger.info("Database file absolute path: '%s'", self._databaseFileAbsPath)
 
-        self._database = peewee.SqliteDatabase(self._databaseFileAbsPath)
+        pragmas = self._buildPragmas(databaseSettings)
+        self._logger.info("Database pragmas: %s", str(pragmas))
+
+        # Connections are thread local in peewee: every thread opens its connection once
+        # (see _connect) and reuses it, the pragmas are applied to each new connection.
+        self._database = peewee.SqliteDatabase(self._databaseFileAbsPath, pragmas=pragmas, timeout=10, check_same_thread=False)
         # http://docs.peewee-orm.com/en/latest/peewee/database.html#setting-the-database-at-run-time
         self._database.bind(models.MODELS)
 
+        self._writeExecutor = SerialExecutor(self._logger, "CalibrationDatabaseWriter")
+
         # simpl impl for testing
-        #self._dropCreateTables()
-        self._createTablesIfNotExist()
+        #self._writeExecutor.submit(self._dropTables)
+        # queued writes are executed after the migration
+        self._writeExecutor.submit(self._setUpSchema)
 
-    def _dropCreateTables(self):
-        self._database.connect(reuse_if_open=True)
-        self._database.drop_tables(models.MODELS)
-        self._database.create_tables(models.MODELS)
+    def shutdown(self):
+        # pending writes are flushed before the connections are closed
+        self._writeExecutor.submit(self._database.close)
+        self._writeExecutor.shutdown(wait=True)
         self._database.close()
-        self._logger.info("Database tables created cleaning up existing ones.")
 
-    def _createTablesIfNotExist(self):
+    # Drops all tables, the following _setUpSchema creates them again
+    def _dropTables(self):
         self._database.connect(reuse_if_open=True)
-        self._database.create_tables(models.MODELS)
-        self._database.close()
+        self._database.drop_tables(models.MODELS)
+        self._logger.info("Database tables dropped.")
+
+    # Runs on the writer executor before any write, readers wait for it in _connect
+    def _setUpSchema(self):
+        try:
+            self._database.connect(reuse_if_open=True)
+            self._schemaVersion = SchemaMigrator(self._logger, self._database).migrate()
+        except Exception as e:
+            self._logger.exception("Could not migrate the database schema: %s", str(e))
+        finally:
+            self._schemaReady.set()
+
+    # Enqueues the insert, returns a concurrent.futures.Future of the new database id (None on error).
+    # phaseTimings are the rows of the calibration session's EStepsPhaseTimingModel, sessionTrace the row of its
+    # EStepsSessionTraceModel and passes the rows of its EStepsCalibrationPassModel, all are inserted in the same transaction.
+    def insertEstepsCalibration(self, eStepsCalibrationModel, phaseTimings=None, sessionTrace=None, passes=None):
+        return self._writeExecutor.submit(self._insertEstepsCalibration, eStepsCalibrationModel, phaseTimings, sessionTrace, passes)
 
-    def insertEstepsCalibration(self, eStepsCalibrationModel):
+    @timedCall("db.insertEstepsCalibration")
+    def _insertEstepsCalibration(self, eStepsCalibrationModel, phaseTimings, sessionTrace, passes):
+        self._connect()
         databaseId = None
         with self._database.atomic() as txn:
             try:
                 eStepsCalibrationModel.save()
+                self._updateFilamentSummary(eStepsCalibrationModel.__data__)
+                if phaseTimings:
+                    models.EStepsPhaseTimingModel.insert_many(phaseTimings).execute()
+                if sessionTrace:
+                    models.EStepsSessionTraceModel.insert(sessionTrace).execute()
+                if passes:
+                    models.EStepsCalibrationPassModel.insert_many(passes).execute()
                 databaseId = eStepsCalibrationModel.get_id()
             except Exception as e:
                 txn.rollback()
                 self._logger.exception("Could not insert E steps calibration into database: %s", str(e))
+        if databaseId is not None:
+            # only after the commit, otherwise readers could cache the old data under the new version
+            self._dataVersion += 1
+        return databaseId
+
+    # row is a dict of a newly inserted e steps calibration, must be called in the inserting transaction
+    def _updateFilamentSummary(self, row):
+        summary = models.EStepsFilamentSummaryModel
+        newESteps = float(row["newESteps"])
+        summary.insert(
+            filamentName=row["filamentName"],
+            filamentType=row["filamentType"],
+            count=0
+        ).on_conflict_ignore().execute()
+        summary.update(
+            count=summary.count + 1,
+            sumNewESteps=summary.sumNewESteps + newESteps,
+            sumSquaresNewESteps=summary.sumSquaresNewESteps + newESteps * newESteps,
+            sumDeltaESteps=summary.sumDeltaESteps + (newESteps - float(row["oldESteps"]))
+        ).where((summary.filamentName == row["filamentName"]) & (summary.filamentType == row["filamentType"])).execute()
+        # imported calibrations may be older than the latest one
+        summary.update(
+            latestNewESteps=row["newESteps"],
+            latestCreated=row["created"]
+        ).where((summary.filamentName == row["filamentName"]) & (summary.filamentType == row["filamentType"]) & \
+            (summary.latestCreated.is_null() | (summary.latestCreated <= row["created"]))).execute()
+
+    # Enqueues the insert of the phase timings (and the trace and passes, see insertEstepsCalibration) of a session
+    # which was not saved, returns a concurrent.futures.Future
+    def insertPhaseTimings(self, phaseTimings, sessionTrace=None, passes=None):
+        return self._writeExecutor.submit(self._insertPhaseTimings, phaseTimings, sessionTrace, passes)
+
+    @timedCall("db.insertPhaseTimings")
+    def _insertPhaseTimings(self, phaseTimings, sessionTrace, passes):
+        self._connect()
+        with self._database.atomic() as txn:
+            try:
+                if phaseTimings:
+                    models.EStepsPhaseTimingModel.insert_many(phaseTimings).execute()
+                if sessionTrace:
+                    models.EStepsSessionTraceModel.insert(sessionTrace).execute()
+                if passes:
+                    models.EStepsCalibrationPassModel.insert_many(passes).execute()
+            except Exception as e:
+                txn.rollback()
+                self._logger.exception("Could not insert phase timings into database: %s", str(e))
+                return
+        self._dataVersion += 1
+
+    # Enqueues the insert of a PID autotune result and its cycles (rows of PidAutotuneCycleModel) in one transaction,
+    # returns a concurrent.futures.Future of the new database id (None on error)
+    def insertPidAutotune(self, pidAutotuneModel, cycles):
+        return self._writeExecutor.submit(self._insertPidAutotune, pidAutotuneModel, cycles)
+
+    @timedCall("db.insertPidAutotune")
+    def _insertPidAutotune(self, pidAutotuneModel, cycles):
+        self._connect()
+        databaseId = None
+        with self._database.atomic() as txn:
+            try:
+                pidAutotuneModel.save()
+                if cycles:
+                    models.PidAutotuneCycleModel.insert_many(cycles).execute()
+                databaseId = pidAutotuneModel.get_id()
+            except Exception as e:
+                txn.rollback()
+                self._logger.exception("Could not insert PID autotune into database: %s", str(e))
+        if databaseId is not None:
+            self._dataVersion += 1
         return databaseId
 
-    def loadAllEStepCalibrations(self, loadData=True):
-        query = models.EStepsCalibrationModel.select().order_by(models.EStepsCalibrationModel.created.desc())
-        if loadData:
-            # conversion of result s.t. it can be directly be passed to flask.jsonify
-            result = []
-            for elem in query:
-                elemData = elem.__data__
-                newElemData = {}
-                for key in elemData.keys():
-                    value = elemData[key]
-                    #self._logger.info("Processing key=%s, value=%s", str(key), str(value))
-                    # flask.jsonify does not understand decimal.Decimal, therefore special handling is required
-                    if isinstance(value, decimal.Decimal):
-                        #self._logger.info("Value %s is float.", value)
-                        newElemData[key] = float(value)
-                    else:
-                        newElemData[key] = value
-                result.append(newElemData)
-            return result
+    # Enqueues marking the PID autotune of the session as applied, returns a concurrent.futures.Future
+    def markPidAutotuneApplied(self, sessionId):
+        return self._writeExecutor.submit(self._markPidAutotuneApplied, sessionId)
+
+    @timedCall("db.markPidAutotuneApplied")
+    def _markPidAutotuneApplied(self, sessionId):
+        self._connect()
+        model = models.PidAutotuneModel
+        try:
+            model.update(applied=True).where(model.sessionId == sessionId).execute()
+        except Exception as e:
+            self._logger.exception("Could not mark PID autotune as applied: %s", str(e))
+            return
+        self._dataVersion += 1
+
+    # Enqueues the insert of a calibration print (CalibrationPrintModel), returns a concurrent.futures.Future of the
+    # new database id (None on error)
+    def insertCalibrationPrint(self, calibrationPrintModel):
+        return self._writeExecutor.submit(self._insertCalibrationPrint, calibrationPrintModel)
+
+    @timedCall("db.insertCalibrationPrint")
+    def _insertCalibrationPrint(self, calibrationPrintModel):
+        self._connect()
+        try:
+            calibrationPrintModel.save()
+        except Exception as e:
+            self._logger.exception("Could not insert calibration print into database: %s", str(e))
+            return None
+        self._dataVersion += 1
+        return calibrationPrintModel.get_id()
+
+    # Enqueues marking the latest calibration print of the file (path in the local file storage) which was not
+    # printed yet as printed, returns a concurrent.futures.Future of True if there was one
+    def markCalibrationPrintPrinted(self, filePath):
+        return self._writeExecutor.submit(self._markCalibrationPrintPrinted, filePath)
+
+    @timedCall("db.markCalibrationPrintPrinted")
+    def _markCalibrationPrintPrinted(self, filePath):
+        self._connect()
+        model = models.CalibrationPrintModel
+        try:
+            latest = model.select(model.databaseId).where((model.filePath == filePath) & model.printed.is_null()) \
+                .order_by(model.created.desc(), model.databaseId.desc()).first()
+            if latest is None:
+                return False
+            model.update(printed=datetime.datetime.now()).where(model.databaseId == latest.databaseId).execute()
+        except Exception as e:
+            self._logger.exception("Could not mark calibration print as printed: %s", str(e))
+            return False
+        self._dataVersion += 1
+        return True
+
+    # Enqueues storing the result measured on a calibration print, returns a concurrent.futures.Future
+    # of True if the print exists
+    def storeCalibrationPrintResult(self, printId, resultValue, recommendedValue, resultNote):
+        return self._writeExecutor.submit(self._storeCalibrationPrintResult, printId, resultValue, recommendedValue, resultNote)
+
+    @timedCall("db.storeCalibrationPrintResult")
+    def _storeCalibrationPrintResult(self, printId, resultValue, recommendedValue, resultNote):
+        self._connect()
+        model = models.CalibrationPrintModel
+        try:
+            updated = model.update(resultValue=resultValue, recommendedValue=recommendedValue, resultNote=resultNote,
+                measured=datetime.datetime.now()).where(model.databaseId == printId).execute()
+        except Exception as e:
+            self._logger.exception("Could not store result of calibration print %s: %s", printId, str(e))
+            return False
+        if updated:
+            self._dataVersion += 1
+        return updated > 0
+
+    # Enqueues the rollup of at most batchSize sessions whose detail was stored before cutoff (datetime): they are
+    # counted in EStepsSessionRollupModel and their phase timings, traces and passes are deleted in one transaction.
+    # Sessions of unknown filament (aborted before traces stored it) are deleted without being counted.
+    # Returns a concurrent.futures.Future of the number of rolled up sessions (0 once there are none left).
+    def rollUpOldSessions(self, cutoff, batchSize):
+        return self._writeExecutor.submit(self._rollUpOldSessions, cutoff, batchSize)
+
+    @timedCall("db.rollUpOldSessions")
+    def _rollUpOldSessions(self, cutoff, batchSize):
+        self._connect()
+        timing = models.EStepsPhaseTimingModel
+        trace = models.EStepsSessionTraceModel
+        calibPass = models.EStepsCalibrationPassModel
+        sessions = list(timing.select(
+            timing.sessionId,
+            peewee.fn.MIN(timing.created).alias("started"),
+            peewee.fn.MAX(timing.completed).alias("completed"),
+            peewee.fn.SUM(timing.durationSeconds).alias("durationSeconds")
+        ).where(timing.created < cutoff).group_by(timing.sessionId).limit(batchSize).dicts())
+        if not sessions:
+            return 0
+        sessionIds = [session["sessionId"] for session in sessions]
+
+        # the filament of a session is stored with its trace and with its calibration if it was saved
+        filaments = {}
+        sampleCounts = {}
+        for sessionId, sampleCount, filamentName, filamentType in trace.select(trace.sessionId, trace.sampleCount, trace.filamentName, \
+                trace.filamentType).where(trace.sessionId.in_(sessionIds)).tuples():
+            sampleCounts[sessionId] = sampleCount
+            if filamentName and filamentType:
+                filaments[sessionId] = (filamentName, filamentType)
+        calibration = models.EStepsCalibrationModel
+        filaments.update((row.sessionId, (row.filamentName, row.filamentType)) for row in \
+            calibration.select(calibration.sessionId, calibration.filamentName, calibration.filamentType).where(calibration.sessionId.in_(sessionIds)))
+        passCounts = dict(calibPass.select(calibPass.sessionId, peewee.fn.COUNT(calibPass.databaseId)) \
+            .where(calibPass.sessionId.in_(sessionIds)).group_by(calibPass.sessionId).tuples())
+
+        # (month, filament name, filament type) -> counts to add
+        rollups = {}
+        for session in sessions:
+            sessionId = session["sessionId"]
+            if sessionId not in filaments:
+                continue
+            started = session["started"]
+            if isinstance(started, str):
+                started = datetime.datetime.fromisoformat(started)
+            key = (started.strftime("%Y-%m"),) + filaments[sessionId]
+            counts = rollups.setdefault(key, dict(sessionCount=0, completedCount=0, passCount=0, durationSeconds=0.0, sampleCount=0))
+            counts["sessionCount"] += 1
+            counts["completedCount"] += 1 if session["completed"] else 0
+            counts["passCount"] += passCounts.get(sessionId, 0)
+            counts["durationSeconds"] += session["durationSeconds"] or 0.0
+            counts["sampleCount"] += sampleCounts.get(sessionId, 0)
+
+        rollup = models.EStepsSessionRollupModel
+        # rolled back if anything fails, the error is passed on to the caller
+        with self._database.atomic():
+            for (month, filamentName, filamentType), counts in rollups.items():
+                rollup.insert(month=month, filamentName=filamentName, filamentType=filamentType).on_conflict_ignore().execute()
+                rollup.update(
+                    sessionCount=rollup.sessionCount + counts["sessionCount"],
+                    completedCount=rollup.completedCount + counts["completedCount"],
+                    passCount=rollup.passCount + counts["passCount"],
+                    durationSeconds=rollup.durationSeconds + counts["durationSeconds"],
+                    sampleCount=rollup.sampleCount + counts["sampleCount"]
+                ).where((rollup.month == month) & (rollup.filamentName == filamentName) & (rollup.filamentType == filamentType)).execute()
+            for model in (timing, trace, calibPass):
+                model.delete().where(model.sessionId.in_(sessionIds)).execute()
+        self._dataVersion += 1
+        return len(sessions)
+
+    # Enqueues deleting the cycles of PID autotunes made before cutoff (datetime), their results are kept.
+    # Returns a concurrent.futures.Future of the number of deleted cycles.
+    def deleteOldPidAutotuneCycles(self, cutoff):
+        return self._writeExecutor.submit(self._deleteOldPidAutotuneCycles, cutoff)
+
+    @timedCall("db.deleteOldPidAutotuneCycles")
+    def _deleteOldPidAutotuneCycles(self, cutoff):
+        self._connect()
+        cycle = models.PidAutotuneCycleModel
+        autotune = models.PidAutotuneModel
+        deleted = cycle.delete().where(cycle.sessionId.in_(autotune.select(autotune.sessionId).where(autotune.created < cutoff))).execute()
+        if deleted:
+            self._dataVersion += 1
+        return deleted
+
+    # Enqueues returning at most maxPages free pages of the database file to the file system. Databases created by
+    # older plugin versions have no incremental vacuum and are not compacted, converting them would rewrite the whole
+    # file (VACUUM) in one task of the writer. Returns a concurrent.futures.Future of the number of free pages left.
+    def compact(self, maxPages):
+        return self._writeExecutor.submit(self._compact, maxPages)
+
+    @timedCall("db.compact")
+    def _compact(self, maxPages):
+        self._connect()
+        # 2 = incremental, set on new databases by the pragmas (see _buildPragmas)
+        if self._database.execute_sql("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            self._database.execute_sql("PRAGMA incremental_vacuum(%d)" % int(maxPages)).fetchall()
+        return self._database.execute_sql("PRAGMA freelist_count").fetchone()[0]
+
+    # Enqueues updating the statistics of the query planner and truncating the write ahead log, done once after
+    # the database was compacted (see compact). Returns a concurrent.futures.Future.
+    def optimize(self):
+        return self._writeExecutor.submit(self._optimize)
+
+    @timedCall("db.optimize")
+    def _optimize(self):
+        self._connect()
+        # ANALYZE only samples this many rows per index, keeping it fast on large tables
+        self._database.execute_sql("PRAGMA analysis_limit = 1000")
+        self._database.execute_sql("ANALYZE")
+        # the freed pages were written to the write ahead log, truncating it shrinks the files on disk
+        self._database.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    def getDataVersion(self):
+        return self._dataVersion
+
+    # Schema version of the database, None until the schema is set up (or if that failed)
+    def getSchemaVersion(self):
+        return self._schemaVersion
+
+    # Columns written by exports and expected by imports (databaseId is local to each printer and therefore left out)
+    ESTEPS_EXPORT_COLUMNS = ("created", "filamentName", "filamentType", "hotendTemperature", "oldESteps", "newESteps", "toolIndex")
+
+    # Yields all e steps calibrations as lists of tuples (see ESTEPS_EXPORT_COLUMNS), batchSize rows at a time,
+    # keyset paginated on databaseId so no read transaction stays open between batches
+    def iterateEStepCalibrations(self, batchSize=500):
+        model = models.EStepsCalibrationModel
+        fields = [getattr(model, column) for column in DatabaseManager.ESTEPS_EXPORT_COLUMNS]
+        lastId = 0
+        while True:
+            self._connect()
+            batch = list(model.select(model.databaseId, *fields) \
+                .where(model.databaseId > lastId) \
+                .order_by(model.databaseId) \
+                .limit(batchSize) \
+                .tuples())
+            if not batch:
+                return
+            lastId = batch[-1][0]
+            yield [row[1:] for row in batch]
+            if len(batch) < batchSize:
+                return
+
+    # Enqueues the insert of one batch of imported calibrations (dicts with the keys of ESTEPS_EXPORT_COLUMNS).
+    # Calibrations already contained in the database (same created, filamentName and filamentType) are skipped,
+    # names are compared without leading and trailing whitespace like they are exported.
+    # Returns a concurrent.futures.Future of the tuple (insertedCount, skippedCount).
+    def importEStepCalibrations(self, rows):
+        return self._writeExecutor.submit(self._importEStepCalibrations, rows)
+
+    @timedCall("db.importEStepCalibrations")
+    def _importEStepCalibrations(self, rows):
+        self._connect()
+        model = models.EStepsCalibrationModel
+
+        existingKeys = set()
+        if rows:
+            # created is indexed, so only the few candidate rows are looked at
+            query = model.select(model.created, model.filamentName, model.filamentType) \
+                .where(model.created.in_([row["created"] for row in rows])) \
+                .tuples()
+            existingKeys = set((created, filamentName.strip(), filamentType.strip()) for created, filamentName, filamentType in query)
+
+        newRows = []
+        for row in rows:
+            key = (row["created"], row["filamentName"].strip(), row["filamentType"].strip())
+            if key in existingKeys:
+                continue
+            existingKeys.add(key)
+            newRows.append(row)
+
+        if newRows:
+            with self._database.atomic():
+                # keeps the number of bound variables per statement below SQLite's limit
+                for chunk in peewee.chunked(newRows, 100):
+                    model.insert_many(chunk).execute()
+                for row in newRows:
+                    self._updateFilamentSummary(row)
+            self._dataVersion += 1
+        return len(newRows), len(rows) - len(newRows)
+
+    # Statistics of the e steps calibrations per filament (name and type) as list of dicts,
+    # read from the incrementally maintained summary table
+    @timedCall("db.loadFilamentStatistics")
+    def loadFilamentStatistics(self):
+        self._connect()
+        summary = models.EStepsFilamentSummaryModel
+        result = []
+        for row in summary.select().where(summary.count > 0).order_by(summary.filamentName, summary.filamentType).dicts():
+            count = row["count"]
+            mean = row["sumNewESteps"] / count
+            stddev = None
+            if count > 1:
+                variance = (row["sumSquaresNewESteps"] - row["sumNewESteps"] * mean) / (count - 1)
+                # rounding errors may result in a slightly negative variance
+                stddev = math.sqrt(max(variance, 0.0))
+            result.append(dict(
+                filamentName=row["filamentName"],
+                filamentType=row["filamentType"],
+                count=count,
+                meanNewESteps=mean,
+                stddevNewESteps=stddev,
+                meanDeltaESteps=row["sumDeltaESteps"] / count,
+                latestNewESteps=float(row["latestNewESteps"]) if row["latestNewESteps"] is not None else None,
+                latestCreated=row["latestCreated"]
+            ))
+        return result
+
+    # Earlier calibrations of the filament as dict (count, latestNewESteps, latestCreated, medianNewESteps),
+    # None if the filament was not calibrated yet
+    @timedCall("db.loadFilamentHistory")
+    def loadFilamentHistory(self, filamentName, filamentType):
+        self._connect()
+        model = models.EStepsCalibrationModel
+        ofFilament = (model.filamentName == filamentName) & (model.filamentType == filamentType)
+        count = model.select().where(ofFilament).count()
+        if count == 0:
+            return None
+        latest = model.select(model.newESteps, model.created).where(ofFilament) \
+            .order_by(model.created.desc(), model.databaseId.desc()).first()
+        # the middle value, or the two middle values for an even count
+        middle = [float(newESteps) for (newESteps,) in model.select(model.newESteps).where(ofFilament) \
+            .order_by(model.newESteps).limit(2 - count % 2).offset((count - 1) // 2).tuples()]
+        return dict(
+            count=count,
+            latestNewESteps=float(latest.newESteps),
+            latestCreated=latest.created.isoformat(),
+            medianNewESteps=sum(middle) / len(middle)
+        )
+
+    # SQLite expressions mapping 'created' to the first day of its bucket
+    TREND_BUCKETS = dict(
+        day=lambda created: peewee.fn.date(created),
+        # Monday of the week
+        week=lambda created: peewee.fn.date(created, "-6 days", "weekday 1"),
+        month=lambda created: peewee.fn.strftime("%Y-%m-01", created)
+    )
+
+    # newESteps aggregated per 'day', 'week' or 'month' by SQLite, oldest bucket first.
+    # Raises ValueError for an unknown bucket.
+    @timedCall("db.loadEStepsTrend")
+    def loadEStepsTrend(self, bucket, filamentName=None, filamentType=None):
+        if bucket not in DatabaseManager.TREND_BUCKETS:
+            raise ValueError("Given bucket '%s' must be one of %s." % (bucket, ", ".join(DatabaseManager.TREND_BUCKETS)))
+
+        self._connect()
+        model = models.EStepsCalibrationModel
+        bucketStart = DatabaseManager.TREND_BUCKETS[bucket](model.created)
+        query = model.select(
+            bucketStart.alias("bucketStart"),
+            peewee.fn.COUNT(model.databaseId).alias("count"),
+            peewee.fn.AVG(model.newESteps).alias("meanNewESteps"),
+            peewee.fn.MIN(model.newESteps).alias("minNewESteps"),
+            peewee.fn.MAX(model.newESteps).alias("maxNewESteps"),
+            peewee.fn.AVG(model.newESteps - model.oldESteps).alias("meanDeltaESteps")
+        )
+        if filamentName:
+            query = query.where(model.filamentName == filamentName)
+        if filamentType:
+            query = query.where(model.filamentType == filamentType)
+        query = query.group_by(bucketStart).order_by(bucketStart)
+
+        # values are read as plain SQLite numbers, without the decimal conversion of the model fields
+        cursor = self._database.execute(query)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    # Columns the history view may be sorted by
+    SORTABLE_ESTEPS_COLUMNS = ("created", "filamentName", "filamentType", "hotendTemperature", "oldESteps", "newESteps", "toolIndex")
+
+    # One page of e steps calibrations, after is the cursor of the previous page (None for the first one),
+    # createdFrom and createdTo are inclusive. Returns (items, nextCursor), nextCursor is None on the last page.
+    # Raises ValueError for an invalid sort column or cursor.
+    @timedCall("db.loadEStepCalibrationsPage")
+    def loadEStepCalibrationsPage(self, limit, after=None, filamentName=None, filamentType=None,
+                                  createdFrom=None, createdTo=None, sortBy="created", sortDescending=True):
+        if sortBy not in DatabaseManager.SORTABLE_ESTEPS_COLUMNS:
+            raise ValueError("Cannot sort by '%s'." % sortBy)
+
+        self._connect()
+        model = models.EStepsCalibrationModel
+        sortField = getattr(model, sortBy)
+        query = model.select()
+
+        if filamentName:
+            query = query.where(model.filamentName == filamentName)
+        if filamentType:
+            query = query.where(model.filamentType == filamentType)
+        if createdFrom is not None:
+            query = query.where(model.created >= createdFrom)
+        if createdTo is not None:
+            query = query.where(model.created <= createdTo)
+
+        if after:
+            lastValue, lastId = self._decodeCursor(after, sortField)
+            # continue right after the last row of the previous page, databaseId breaks ties
+            if sortDescending:
+                query = query.where((sortField < lastValue) | ((sortField == lastValue) & (model.databaseId < lastId)))
+            else:
+                query = query.where((sortField > lastValue) | ((sortField == lastValue) & (model.databaseId > lastId)))
+
+        if sortDescending:
+            query = query.order_by(sortField.desc(), model.databaseId.desc())
         else:
+            query = query.order_by(sortField.asc(), model.databaseId.asc())
+
+        # fetch one additional row to find out if there is a next page
+        # rows are fetched as dicts directly, without materializing model instances
+        rows = list(query.limit(limit + 1).dicts())
+        nextCursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            lastRow = rows[-1]
+            nextCursor = self._encodeCursor(lastRow[sortBy], lastRow["databaseId"])
+
+        return [self._toJsonableDict(row) for row in rows], nextCursor
+
+    # Upper bounds (seconds) of the histogram buckets of the phase metrics, the last bucket is unbounded
+    PHASE_HISTOGRAM_BOUNDS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)
+    PHASE_PERCENTILES = (50, 90, 95, 99)
+
+    # Count, mean, max, percentiles (nearest rank) and histogram of the durations per e steps calibration phase,
+    # read with indexed queries, no durations are loaded into memory
+    @timedCall("db.loadPhaseMetrics")
+    def loadPhaseMetrics(self, toolIndex=None, completedOnly=False):
+        self._connect()
+        model = models.EStepsPhaseTimingModel
+
+        def filtered(query):
+            if toolIndex is not None:
+                query = query.where(model.toolIndex == toolIndex)
+            if completedOnly:
+                query = query.where(model.completed == True)
             return query
 
+        bucketIndex = peewee.Case(None,
+            [(model.durationSeconds <= bound, index) for index, bound in enumerate(DatabaseManager.PHASE_HISTOGRAM_BOUNDS)],
+            len(DatabaseManager.PHASE_HISTOGRAM_BOUNDS))
+        histograms = {}
+        for phase, bucket, count in filtered(model.select(model.phase, bucketIndex, peewee.fn.COUNT(model.databaseId))) \
+                .group_by(model.phase, bucketIndex).tuples():
+            histograms.setdefault(phase, {})[bucket] = count
+
+        result = []
+        aggregates = filtered(model.select(model.phase, peewee.fn.COUNT(model.databaseId), peewee.fn.AVG(model.durationSeconds), \
+            peewee.fn.MAX(model.durationSeconds))).group_by(model.phase).order_by(model.phase).tuples()
+        for phase, count, mean, maximum in aggregates:
+            metrics = dict(phase=phase, count=count, meanSeconds=mean, maxSeconds=maximum)
+            for percentile in DatabaseManager.PHASE_PERCENTILES:
+                offset = min(count - 1, int(round(percentile / 100.0 * (count - 1))))
+                metrics["p%dSeconds" % percentile] = filtered(model.select(model.durationSeconds).where(model.phase == phase)) \
+                    .order_by(model.durationSeconds).limit(1).offset(offset).scalar()
+            bounds = list(DatabaseManager.PHASE_HISTOGRAM_BOUNDS) + [None]
+            metrics["histogram"] = [dict(upperBoundSeconds=bound, count=histograms.get(phase, {}).get(index, 0)) \
+                for index, bound in enumerate(bounds)]
+            result.append(metrics)
+        return result
+
+    # Latest limit PID autotunes (newest first, optionally of one heater) as list of dicts with the columns
+    # of PidAutotuneModel and their cycles in the order they were reported
+    @timedCall("db.loadPidAutotunes")
+    def loadPidAutotunes(self, limit, heater=None):
+        self._connect()
+        model = models.PidAutotuneModel
+        query = model.select()
+        if heater:
+            query = query.where(model.heater == heater)
+        autotunes = list(query.order_by(model.created.desc(), model.databaseId.desc()).limit(limit).dicts())
+        if not autotunes:
+            return []
+
+        cycleModel = models.PidAutotuneCycleModel
+        cyclesBySession = {}
+        cycleQuery = cycleModel.select().where(cycleModel.sessionId.in_([autotune["sessionId"] for autotune in autotunes])) \
+            .order_by(cycleModel.sessionId, cycleModel.cycleIndex).dicts()
+        for cycle in cycleQuery:
+            sessionId = cycle.pop("sessionId")
+            for key in ("databaseId", "created"):
+                del cycle[key]
+            cyclesBySession.setdefault(sessionId, []).append(cycle)
+        for autotune in autotunes:
+            autotune["created"] = autotune["created"].isoformat()
+            autotune["cycles"] = cyclesBySession.get(autotune["sessionId"], [])
+        return autotunes
+
+    # Latest limit calibration prints (newest first, optionally of one print type and filament) as list of dicts
+    @timedCall("db.loadCalibrationPrints")
+    def loadCalibrationPrints(self, limit, printType=None, filamentName=None):
+        self._connect()
+        model = models.CalibrationPrintModel
+        query = model.select()
+        if printType:
+            query = query.where(model.printType == printType)
+        if filamentName:
+            query = query.where(model.filamentName == filamentName)
+        return [self._toCalibrationPrintDict(row) for row in query.order_by(model.created.desc(), model.databaseId.desc()).limit(limit).dicts()]
+
+    # Calibration print as dict like loadCalibrationPrints, None if it does not exist
+    @timedCall("db.loadCalibrationPrint")
+    def loadCalibrationPrint(self, printId):
+        self._connect()
+        model = models.CalibrationPrintModel
+        row = model.select().where(model.databaseId == printId).dicts().first()
+        return self._toCalibrationPrintDict(row) if row is not None else None
+
+    # Passes of the calibration session in the order they were measured, empty if there are none
+    @timedCall("db.loadSessionPasses")
+    def loadSessionPasses(self, sessionId):
+        self._connect()
+        model = models.EStepsCalibrationPassModel
+        passes = list(model.select().where(model.sessionId == sessionId).order_by(model.passIndex).dicts())
+        for calibPass in passes:
+            del calibPass["databaseId"]
+            calibPass["created"] = calibPass["created"].isoformat()
+        return passes
+
+    # Monthly rollups of old calibration sessions (newest month first), see rollUpOldSessions
+    @timedCall("db.loadSessionRollups")
+    def loadSessionRollups(self):
+        self._connect()
+        model = models.EStepsSessionRollupModel
+        rollups = list(model.select().order_by(model.month.desc(), model.filamentName, model.filamentType).dicts())
+        for rollup in rollups:
+            for key in ("databaseId", "created"):
+                del rollup[key]
+        return rollups
+
+    # File size (including the write ahead log), page counts, schema version and row count per table
+    @timedCall("db.loadDatabaseStats")
+    def loadDatabaseStats(self):
+        self._connect()
+        fileSizeBytes = 0
+        for suffix in ("", "-wal"):
+            path = self._databaseFileAbsPath + suffix
+            if os.path.exists(path):
+                fileSizeBytes += os.path.getsize(path)
+        pragma = lambda name: self._database.execute_sql("PRAGMA %s" % name).fetchone()[0]
+        return dict(
+            fileSizeBytes=fileSizeBytes,
+            pageSize=pragma("page_size"),
+            pageCount=pragma("page_count"),
+            freePages=pragma("freelist_count"),
+            schemaVersion=self._schemaVersion,
+            tables=[dict(name=model._meta.table_name, rowCount=model.select().count()) for model in models.MODELS]
+        )
+
+    # Trace of the calibration session, None if there is none. Samples are downsampled to at most
+    # maxPoints with LTTB on the actual temperature.
+    @timedCall("db.loadSessionTrace")
+    def loadSessionTrace(self, sessionId, maxPoints):
+        self._connect()
+        model = models.EStepsSessionTraceModel
+        trace = model.select().where(model.sessionId == sessionId).first()
+        if trace is None:
+            return None
+        samples = decodeSamples(trace.samples)
+        indices = lttbIndices(samples["time"], samples["actual"], maxPoints)
+        if len(indices) < trace.sampleCount:
+            samples = {name: [values[i] for i in indices] for name, values in samples.items()}
+        return dict(
+            sessionId=trace.sessionId,
+            toolIndex=trace.toolIndex,
+            completed=trace.completed,
+            started=trace.started.isoformat(),
+            sampleCount=trace.sampleCount,
+            samples=samples,
+            events=decodeEvents(trace.events)
+        )
+
+    ##################
+    ### Internal stuff
+
+    def _connect(self):
+        # the first calls after the start of OctoPrint might have to wait for the migration of the schema
+        self._schemaReady.wait()
+        # opens the connection of the calling thread once, later calls reuse it
+        self._database.connect(reuse_if_open=True)
+
+    # pylint: disable=no-self-use
+    def _buildPragmas(self, databaseSettings):
+        journalMode = str(databaseSettings.get("journalMode", "wal")).lower()
+        if journalMode not in DatabaseManager.JOURNAL_MODES:
+            self._logger.warning("Unknown journal mode '%s', using 'wal'.", journalMode)
+            journalMode = "wal"
+        synchronous = str(databaseSettings.get("synchronous", "normal")).lower()
+        if synchronous not in DatabaseManager.SYNCHRONOUS_MODES:
+            self._logger.warning("Unknown synchronous mode '%s', using 'normal'.", synchronous)
+            synchronous = "normal"
+        return dict(
+            # only takes effect for new databases and must be set before the journal mode (which writes the file header),
+            # existing databases keep their mode (see _compact)
+            auto_vacuum="incremental",
+            journal_mode=journalMode,
+            synchronous=synchronous,
+            # negative value: size in KiB instead of pages
+            cache_size=-int(databaseSettings.get("cacheSizeKiB", 2048)),
+            mmap_size=int(databaseSettings.get("mmapSizeMiB", 16)) * 1024 * 1024,
+            foreign_keys=1
+        )
+
+    # Names of all decimal columns of the e steps calibration model
+    _ESTEPS_DECIMAL_COLUMNS = tuple(field.name for field in models.EStepsCalibrationModel._meta.sorted_fields \
+        if isinstance(field, peewee.DecimalField))
+
+    # pylint: disable=no-self-use
+    def _toJsonableDict(self, row):
+        # flask.jsonify does not understand decimal.Decimal, therefore special handling is required
+        for key in DatabaseManager._ESTEPS_DECIMAL_COLUMNS:
+            value = row[key]
+            if value is not None:
+                row[key] = float(value)
+        return row
+
+    # pylint: disable=no-self-use
+    def _toCalibrationPrintDict(self, row):
+        row["parameters"] = json.loads(row["parameters"])
+        for key in ("created", "printed", "measured"):
+            if row[key] is not None:
+                row[key] = row[key].isoformat()
+        return row
 
+    # pylint: disable=no-self-use
+    def _encodeCursor(self, sortValue, databaseId):
+        if isinstance(sortValue, datetime.datetime):
+            sortValue = sortValue.isoformat()
+        elif isinstance(sortValue, decimal.Decimal):
+            sortValue = str(sortValue)
+        rawCursor = json.dumps([sortValue, databaseId]).encode("utf-8")
+        return base64.urlsafe_b64encode(rawCursor).decode("ascii")
 
-    
+    # pylint: disable=no-self-use
+    def _decodeCursor(self, cursor, sortField):
+        try:
+            sortValue, databaseId = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+            if isinstance(sortField, peewee.DateTimeField):
+                sortValue = datetime.datetime.fromisoformat(sortValue)
+            elif isinstance(sortField, peewee.DecimalField):
+                sortValue = decimal.Decimal(sortValue)
+            return sortValue, int(databaseId)
+        except Exception as e:
+            raise ValueError("Invalid cursor '%s'." % cursor) from e
@@ -0,0 +1,49 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import concurrent.futures
+import logging
+import queue
+import threading
+
+# Runs submitted functions one after another on a single worker thread, owns the state machine
+# of a calibration tool: its state is only mutated on this thread and callers never block
+class SerialExecutor(object):
+    _STOP = object()
+
+    def __init__(self, parentLogger, name):
+        self._logger = logging.getLogger(parentLogger.name + "." + self.__class__.__name__)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def isExecutorThread(self):
+        return threading.current_thread() is self._thread
+
+    def shutdown(self, wait=True):
+        self._queue.put(SerialExecutor._STOP)
+        if wait and not self.isExecutorThread():
+            self._thread.join()
+
+    ##################
+    ### Internal stuff
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is SerialExecutor._STOP:
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                # nobody might wait for the future, so make sure the error ends up in the log
+                self._logger.exception("Error while executing %s: %s", getattr(fn, "__name__", str(fn)), str(e))
+                future.set_exception(e)
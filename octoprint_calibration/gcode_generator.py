@@ -0,0 +1,413 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import threading
+
+from octoprint import UMASK
+from octoprint.filemanager import FileDestinations
+from octoprint.filemanager.util import AbstractFileWrapper
+from octoprint.util import atomic_write
+
+# G-code of calibration prints (temperature towers, flow cubes, retraction tests) from a few parameters,
+# streamed into the local file storage and reused for a print requested again with the same parameters
+class CalibrationGcodeGenerator(object):
+    # Increment whenever the generated G-code changes, files generated before are not reused then
+    GENERATOR_VERSION = 1
+    # folder of the generated files in the local file storage
+    FOLDER = "calibration"
+
+    # parameter name -> (type, default, minimum, maximum) of all print types, lengths in mm, speeds in mm/s.
+    # bedCenterX and bedCenterY default to the center of the bed of the printer profile.
+    COMMON_PARAMETERS = dict(
+        toolIndex=(int, 0, 0, 15),
+        bedTemperature=(int, 60, 0, 130),
+        filamentDiameter=(float, 1.75, 1.0, 3.0),
+        lineWidth=(float, 0.45, 0.1, 2.0),
+        layerHeight=(float, 0.2, 0.05, 1.0),
+        printSpeed=(float, 40.0, 5.0, 300.0),
+        travelSpeed=(float, 150.0, 10.0, 500.0),
+        # percent, the fan is switched on after the first layer
+        fanSpeed=(int, 100, 0, 100),
+        bedCenterX=(float, None, -1000.0, 1000.0),
+        bedCenterY=(float, None, -1000.0, 1000.0)
+    )
+
+    # print type -> additional parameters and the result measured on the print: its name, unit and the setting
+    # recommended from it (see evaluateResult)
+    PRINT_TYPES = dict(
+        # hollow square tower, the hotend temperature changes every segment from startTemperature to endTemperature,
+        # the result is the temperature of the best looking segment
+        temperatureTower=dict(
+            parameters=dict(
+                startTemperature=(int, 230, 150, 320),
+                endTemperature=(int, 190, 150, 320),
+                temperatureStep=(int, 5, 1, 50),
+                segmentHeight=(float, 8.0, 2.0, 50.0),
+                size=(float, 20.0, 5.0, 100.0),
+                walls=(int, 2, 1, 10)
+            ),
+            result=dict(name="temperature", unit="°C", recommends="hotendTemperature")
+        ),
+        # square with a single wall printed with extrusionMultiplier, the result is the measured wall thickness
+        flowCube=dict(
+            parameters=dict(
+                hotendTemperature=(int, 210, 150, 320),
+                extrusionMultiplier=(float, 1.0, 0.5, 1.5),
+                height=(float, 15.0, 2.0, 100.0),
+                size=(float, 20.0, 5.0, 100.0)
+            ),
+            result=dict(name="wallThickness", unit="mm", recommends="extrusionMultiplier")
+        ),
+        # two towers printed alternately, the retraction distance increases every segment from startRetraction to
+        # endRetraction, the result is the distance of the segment with the least stringing
+        retractionTest=dict(
+            parameters=dict(
+                hotendTemperature=(int, 210, 150, 320),
+                startRetraction=(float, 0.5, 0.0, 15.0),
+                endRetraction=(float, 4.0, 0.0, 15.0),
+                retractionStep=(float, 0.5, 0.1, 5.0),
+                retractionSpeed=(float, 35.0, 5.0, 150.0),
+                segmentHeight=(float, 5.0, 1.0, 50.0),
+                size=(float, 8.0, 3.0, 30.0),
+                towerDistance=(float, 40.0, 10.0, 150.0)
+            ),
+            result=dict(name="retractionDistance", unit="mm", recommends="retractionDistance")
+        )
+    )
+
+    # length of the prime line in front of the print and its distance to the print
+    PRIME_LINE_LENGTH = 60.0
+    PRIME_LINE_DISTANCE = 5.0
+
+    # fileManager: OctoPrint's FileManager
+    def __init__(self, parentLogger, fileManager):
+        self._logger = logging.getLogger(parentLogger.name + "." + self.__class__.__name__)
+        self._fileManager = fileManager
+        # two requests for the same file must not generate it at the same time
+        self._lock = threading.Lock()
+
+    # dict print type -> dict with the keys parameters (name -> default value) and result (see PRINT_TYPES)
+    def getPrintTypes(self):
+        printTypes = {}
+        for printType, spec in CalibrationGcodeGenerator.PRINT_TYPES.items():
+            parameterSpecs = dict(CalibrationGcodeGenerator.COMMON_PARAMETERS, **spec["parameters"])
+            printTypes[printType] = dict(
+                parameters={name: default for name, (_, default, _, _) in parameterSpecs.items()},
+                result=dict(spec["result"])
+            )
+        return printTypes
+
+    # Returns all parameters of the print type (defaults for the missing ones) converted to their types.
+    # printerVolume: "volume" of the printer profile, the print has to fit on its bed.
+    # Raises ValueError for an unknown print type or parameter and for values out of range.
+    def normalizeParameters(self, printType, parameters, printerVolume):
+        if printType not in CalibrationGcodeGenerator.PRINT_TYPES:
+            raise ValueError("Given print type '%s' must be one of %s." % (printType, ", ".join(sorted(CalibrationGcodeGenerator.PRINT_TYPES))))
+        parameterSpecs = dict(CalibrationGcodeGenerator.COMMON_PARAMETERS, **CalibrationGcodeGenerator.PRINT_TYPES[printType]["parameters"])
+        unknown = set(parameters) - set(parameterSpecs)
+        if unknown:
+            raise ValueError("Unknown parameters %s for print type '%s'." % (", ".join(sorted(unknown)), printType))
+
+        minX, maxX, minY, maxY = self._getBedBounds(printerVolume)
+        defaults = dict(bedCenterX=(minX + maxX) / 2.0, bedCenterY=(minY + maxY) / 2.0)
+        normalized = {}
+        for name, (valueType, default, minimum, maximum) in parameterSpecs.items():
+            value = parameters.get(name)
+            if value is None:
+                value = defaults[name] if default is None else default
+            try:
+                number = float(value)
+            except (TypeError, ValueError) as e:
+                raise ValueError("Given value '%s' for '%s' is not a number." % (value, name)) from e
+            if valueType is int and not number.is_integer():
+                raise ValueError("Given value '%s' for '%s' is not an integer." % (value, name))
+            value = valueType(number)
+            if math.isnan(value) or value < minimum or value > maximum:
+                raise ValueError("Given %s %s is out of allowed range [%s;%s]." % (name, value, minimum, maximum))
+            normalized[name] = value
+
+        halfWidth, halfDepth, height = self._getExtent(printType, normalized)
+        if height > float(printerVolume["height"]):
+            raise ValueError("The print is %.1f mm high, the printer only %s mm." % (height, printerVolume["height"]))
+        if normalized["bedCenterX"] - halfWidth < minX or normalized["bedCenterX"] + halfWidth > maxX or \
+                normalized["bedCenterY"] - halfDepth < minY or normalized["bedCenterY"] + halfDepth > maxY:
+            raise ValueError("The print (%.1f x %.1f mm around %.1f/%.1f) does not fit on the bed." % \
+                (2 * halfWidth, 2 * halfDepth, normalized["bedCenterX"], normalized["bedCenterY"]))
+        return normalized
+
+    # Hash of the print type and its normalized parameters, identifies the generated file
+    # pylint: disable=no-self-use
+    def getParametersHash(self, printType, parameters):
+        key = json.dumps(dict(printType=printType, generatorVersion=CalibrationGcodeGenerator.GENERATOR_VERSION, parameters=parameters), sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    # Generates the file of the print into the local file storage unless it was generated before.
+    # Returns (path in the local storage, parameters hash, True if the file was cached).
+    # Raises the StorageError of the file manager if the file could not be stored.
+    def provideFile(self, printType, parameters):
+        parametersHash = self.getParametersHash(printType, parameters)
+        path = "%s/%s_%s.gcode" % (CalibrationGcodeGenerator.FOLDER, printType, parametersHash[:16])
+        with self._lock:
+            if self._fileManager.file_exists(FileDestinations.LOCAL, path):
+                self._logger.debug("Reusing calibration print %s.", path)
+                return path, parametersHash, True
+
+            wrapper = GcodeStreamWrapper(path.split("/")[-1], self.generateLines(printType, parameters))
+            path = self._fileManager.add_file(FileDestinations.LOCAL, path, wrapper, allow_overwrite=True)
+            self._fileManager.set_additional_metadata(FileDestinations.LOCAL, path, "calibration",
+                dict(printType=printType, parametersHash=parametersHash, generatorVersion=CalibrationGcodeGenerator.GENERATOR_VERSION),
+                overwrite=True)
+        self._logger.info("Generated calibration print %s with %s.", path, str(parameters))
+        return path, parametersHash, False
+
+    # Setting recommended from the value measured on a print with the given (normalized) parameters, see PRINT_TYPES.
+    # Raises ValueError if the value cannot have been measured on the print.
+    # pylint: disable=no-self-use
+    def evaluateResult(self, printType, parameters, value):
+        if math.isnan(value):
+            raise ValueError("Given value is not a number.")
+        if printType == "temperatureTower":
+            lowest = min(parameters["startTemperature"], parameters["endTemperature"])
+            highest = max(parameters["startTemperature"], parameters["endTemperature"])
+            if value < lowest or value > highest:
+                raise ValueError("Given temperature %s is out of the printed range [%d;%d]." % (value, lowest, highest))
+            return value
+        if printType == "flowCube":
+            # the wall is lineWidth thick if the extrusion multiplier is right
+            if value <= 0 or value > 5 * parameters["lineWidth"]:
+                raise ValueError("Given wall thickness %s is out of allowed range (0;%.2f]." % (value, 5 * parameters["lineWidth"]))
+            return round(parameters["extrusionMultiplier"] * parameters["lineWidth"] / value, 3)
+        if printType == "retractionTest":
+            if value < parameters["startRetraction"] or value > parameters["endRetraction"]:
+                raise ValueError("Given retraction distance %s is out of the printed range [%s;%s]." % \
+                    (value, parameters["startRetraction"], parameters["endRetraction"]))
+            return value
+        raise ValueError("Given print type '%s' must be one of %s." % (printType, ", ".join(sorted(CalibrationGcodeGenerator.PRINT_TYPES))))
+
+    # Generator of the G-code lines (without line endings) of the print
+    def generateLines(self, printType, parameters):
+        p = parameters
+        hotendTemperature = p["startTemperature"] if printType == "temperatureTower" else p["hotendTemperature"]
+        yield "; %s generated by the OctoPrint Calibration Plugin (generator version %d)" % (printType, CalibrationGcodeGenerator.GENERATOR_VERSION)
+        yield "; parameters: %s" % json.dumps(p, sort_keys=True)
+        if p["bedTemperature"] > 0:
+            yield "M140 S%d" % p["bedTemperature"]
+        yield "M104 T%d S%d" % (p["toolIndex"], hotendTemperature)
+        yield "G28"
+        if p["bedTemperature"] > 0:
+            yield "M190 S%d" % p["bedTemperature"]
+        yield "M109 T%d S%d" % (p["toolIndex"], hotendTemperature)
+        yield "T%d" % p["toolIndex"]
+        yield "G90"
+        # relative extrusion, every move extrudes the filament for its own length
+        yield "M83"
+        yield "M107"
+
+        _, halfDepth, _ = self._getExtent(printType, p)
+        primeY = p["bedCenterY"] - halfDepth + p["lineWidth"]
+        primeLength = CalibrationGcodeGenerator.PRIME_LINE_LENGTH
+        yield "; prime line"
+        yield "G0 Z5 F600"
+        yield "G0 X%.3f Y%.3f F%d" % (p["bedCenterX"] - primeLength / 2, primeY, p["travelSpeed"] * 60)
+        yield "G0 Z%.3f F600" % p["layerHeight"]
+        yield "G1 X%.3f Y%.3f E%.5f F%d" % (p["bedCenterX"] + primeLength / 2, primeY, primeLength * self._getExtrusionPerMm(p) * 1.5, p["printSpeed"] * 30)
+
+        if printType == "temperatureTower":
+            body = self._generateTemperatureTower(p)
+        elif printType == "flowCube":
+            body = self._generateFlowCube(p)
+        else:
+            body = self._generateRetractionTest(p)
+        for line in body:
+            yield line
+
+        yield "; end"
+        yield "G1 E-2 F2100"
+        yield "G91"
+        yield "G0 Z10 F600"
+        yield "G90"
+        yield "M104 T%d S0" % p["toolIndex"]
+        yield "M140 S0"
+        yield "M107"
+        yield "M84"
+
+    ##################
+    ### Internal stuff
+
+    def _generateTemperatureTower(self, p):
+        step = p["temperatureStep"] if p["endTemperature"] >= p["startTemperature"] else -p["temperatureStep"]
+        layersPerSegment = self._getLayersPerSegment(p)
+        ePerMm = self._getExtrusionPerMm(p)
+        layerIndex = 0
+        for segment in range(self._getSegmentCount("temperatureTower", p)):
+            temperature = p["startTemperature"] + segment * step
+            yield "; segment %d: %d C" % (segment, temperature)
+            if segment > 0:
+                yield "M104 T%d S%d" % (p["toolIndex"], temperature)
+            for _ in range(layersPerSegment):
+                for line in self._startLayer(p, layerIndex):
+                    yield line
+                for line in self._square(p, p["bedCenterX"], p["bedCenterY"], p["size"], p["walls"], ePerMm, layerIndex):
+                    yield line
+                layerIndex += 1
+
+    def _generateFlowCube(self, p):
+        ePerMm = self._getExtrusionPerMm(p) * p["extrusionMultiplier"]
+        for layerIndex in range(max(1, int(round(p["height"] / p["layerHeight"])))):
+            for line in self._startLayer(p, layerIndex):
+                yield line
+            for line in self._square(p, p["bedCenterX"], p["bedCenterY"], p["size"], 1, ePerMm, layerIndex):
+                yield line
+
+    def _generateRetractionTest(self, p):
+        layersPerSegment = self._getLayersPerSegment(p)
+        ePerMm = self._getExtrusionPerMm(p)
+        towerXs = (p["bedCenterX"] - p["towerDistance"] / 2, p["bedCenterX"] + p["towerDistance"] / 2)
+        retractionFeedrate = p["retractionSpeed"] * 60
+        # the filament is retracted by this length, 0 after the prime line
+        retracted = 0.0
+        layerIndex = 0
+        for segment in range(self._getSegmentCount("retractionTest", p)):
+            retraction = round(p["startRetraction"] + segment * p["retractionStep"], 3)
+            yield "; segment %d: retraction %.3f mm" % (segment, retraction)
+            for _ in range(layersPerSegment):
+                for line in self._startLayer(p, layerIndex):
+                    yield line
+                for towerX in towerXs:
+                    square = self._square(p, towerX, p["bedCenterY"], p["size"], 1, ePerMm, layerIndex)
+                    # travel to the tower with retracted filament
+                    yield next(square)
+                    if retracted > 0:
+                        yield "G1 E%.5f F%d" % (retracted, retractionFeedrate)
+                    for line in square:
+                        yield line
+                    yield "G1 E%.5f F%d" % (-retraction, retractionFeedrate)
+                    retracted = retraction
+                layerIndex += 1
+
+    # Lines starting a layer: moves to its height and switches the fan on after the first layer
+    def _startLayer(self, p, layerIndex):
+        yield "; layer %d" % layerIndex
+        yield "G0 Z%.3f F600" % ((layerIndex + 1) * p["layerHeight"])
+        if layerIndex == 1 and p["fanSpeed"] > 0:
+            yield "M106 S%d" % round(p["fanSpeed"] * 255 / 100.0)
+
+    # Lines of the perimeters (walls) of a square (outer edge size) from the outside in, the first line
+    # is the travel to its start. The first layer is printed at half speed.
+    # pylint: disable=no-self-use
+    def _square(self, p, centerX, centerY, size, walls, ePerMm, layerIndex):
+        feedrate = p["printSpeed"] * 60 * (0.5 if layerIndex == 0 else 1.0)
+        for wall in range(walls):
+            half = (size - p["lineWidth"]) / 2 - wall * p["lineWidth"]
+            corners = ((centerX - half, centerY - half), (centerX + half, centerY - half), (centerX + half, centerY + half), (centerX - half, centerY + half))
+            yield "G0 X%.3f Y%.3f F%d" % (corners[0][0], corners[0][1], p["travelSpeed"] * 60)
+            for x, y in corners[1:] + corners[:1]:
+                yield "G1 X%.3f Y%.3f E%.5f F%d" % (x, y, 2 * half * ePerMm, feedrate)
+
+    # mm of filament per mm of a line
+    # pylint: disable=no-self-use
+    def _getExtrusionPerMm(self, p):
+        return p["lineWidth"] * p["layerHeight"] / (math.pi * (p["filamentDiameter"] / 2) ** 2)
+
+    # pylint: disable=no-self-use
+    def _getLayersPerSegment(self, p):
+        return max(1, int(round(p["segmentHeight"] / p["layerHeight"])))
+
+    # pylint: disable=no-self-use
+    def _getSegmentCount(self, printType, p):
+        if printType == "temperatureTower":
+            return abs(p["endTemperature"] - p["startTemperature"]) // p["temperatureStep"] + 1
+        # a small epsilon, so e.g. (4.0 - 0.5) / 0.5 does not end up just below 7
+        return int(math.floor((p["endRetraction"] - p["startRetraction"]) / p["retractionStep"] + 1e-6)) + 1
+
+    # (half width, half depth, height) of the print including its prime line around (bedCenterX, bedCenterY).
+    # Raises ValueError for parameters which do not describe a printable object.
+    def _getExtent(self, printType, p):
+        if printType == "temperatureTower":
+            if p["size"] <= 2 * p["walls"] * p["lineWidth"]:
+                raise ValueError("Given size %s is too small for %d walls." % (p["size"], p["walls"]))
+            halfWidth = halfDepth = p["size"] / 2
+            height = self._getSegmentCount(printType, p) * self._getLayersPerSegment(p) * p["layerHeight"]
+        elif printType == "flowCube":
+            halfWidth = halfDepth = p["size"] / 2
+            height = p["height"]
+        else:
+            if p["endRetraction"] < p["startRetraction"]:
+                raise ValueError("Given endRetraction %s must not be below startRetraction %s." % (p["endRetraction"], p["startRetraction"]))
+            if p["towerDistance"] <= p["size"]:
+                raise ValueError("Given towerDistance %s must be larger than the size %s of the towers." % (p["towerDistance"], p["size"]))
+            halfWidth = (p["towerDistance"] + p["size"]) / 2
+            halfDepth = p["size"] / 2
+            height = self._getSegmentCount(printType, p) * self._getLayersPerSegment(p) * p["layerHeight"]
+        return max(halfWidth, CalibrationGcodeGenerator.PRIME_LINE_LENGTH / 2), \
+            halfDepth + CalibrationGcodeGenerator.PRIME_LINE_DISTANCE + p["lineWidth"], height
+
+    # (minX, maxX, minY, maxY) of the bed, circular beds are approximated by their bounding box
+    # pylint: disable=no-self-use
+    def _getBedBounds(self, printerVolume):
+        width = float(printerVolume["width"])
+        depth = float(printerVolume["depth"])
+        if printerVolume.get("origin") == "center":
+            return -width / 2, width / 2, -depth / 2, depth / 2
+        return 0.0, width, 0.0, depth
+
+
+# File wrapper for FileManager.add_file writing the lines of a generator in chunks of about
+# CHUNK_SIZE bytes, the lines can only be consumed once
+class GcodeStreamWrapper(AbstractFileWrapper):
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, filename, lines):
+        AbstractFileWrapper.__init__(self, filename)
+        self._lines = lines
+
+    def save(self, path, permissions=None):
+        with atomic_write(path, mode="wb") as dest:
+            for chunk in self._chunks():
+                dest.write(chunk)
+        if permissions is None:
+            permissions = self.DEFAULT_PERMISSIONS & ~UMASK
+        os.chmod(path, permissions)
+
+    def stream(self):
+        return io.BufferedReader(_ChunkReader(self._chunks()))
+
+    def _chunks(self):
+        lines = []
+        size = 0
+        for line in self._lines:
+            lines.append(line)
+            size += len(line) + 1
+            if size >= GcodeStreamWrapper.CHUNK_SIZE:
+                yield ("\n".join(lines) + "\n").encode("utf-8")
+                lines = []
+                size = 0
+        if lines:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+# Raw stream reading the chunks (bytes) of an iterator, see GcodeStreamWrapper.stream
+class _ChunkReader(io.RawIOBase):
+    def __init__(self, chunks):
+        io.RawIOBase.__init__(self)
+        self._chunks = chunks
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = chunk
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
@@ -16,10 +16,171 @@ class BaseModel(peewee.Model):
         table_function = makeTableName
 
 class EStepsCalibrationModel(BaseModel):
-    filamentName = peewee.CharField()
-    filamentType = peewee.CharField()
+    filamentName = peewee.CharField(index=True)
+    filamentType = peewee.CharField(index=True)
     hotendTemperature = peewee.DecimalField()
     oldESteps = peewee.DecimalField()
     newESteps = peewee.DecimalField()
+    # index of the calibrated extruder (the SQL default is required to add the column to existing tables)
+    toolIndex = peewee.IntegerField(default=0, constraints=[peewee.SQL("DEFAULT 0")])
+    # calibration session the calibration was made in, see EStepsPhaseTimingModel (None for older and imported calibrations)
+    sessionId = peewee.CharField(null=True, index=True)
+    # passes measured for newESteps (see EStepsCalibrationPassModel) and the half width of its 95 % confidence
+    # interval (None for a single pass)
+    passCount = peewee.IntegerField(default=1, constraints=[peewee.SQL("DEFAULT 1")])
+    confidenceHalfWidth = peewee.FloatField(null=True)
+    # mm extruded for the calibration, less than 100 for a quick verification
+    extrusionLength = peewee.IntegerField(default=100, constraints=[peewee.SQL("DEFAULT 100")])
+
+    class Meta:
+        indexes = (
+            # keyset pagination of the history view sorts by (created, databaseId)
+            (('created', 'databaseId'), False),
+            # history of a filament, see DatabaseManager.loadFilamentHistory
+            (('filamentName', 'filamentType', 'created'), False),
+        )
+
+# Per filament aggregates of EStepsCalibrationModel, updated incrementally with every inserted calibration
+class EStepsFilamentSummaryModel(BaseModel):
+    filamentName = peewee.CharField()
+    filamentType = peewee.CharField()
+    count = peewee.IntegerField(default=0)
+    sumNewESteps = peewee.FloatField(default=0.0)
+    sumSquaresNewESteps = peewee.FloatField(default=0.0)
+    # sum of (newESteps - oldESteps)
+    sumDeltaESteps = peewee.FloatField(default=0.0)
+    latestNewESteps = peewee.DecimalField(null=True)
+    latestCreated = peewee.DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (('filamentName', 'filamentType'), True),
+        )
+
+# Time spent in one phase (state) of an e steps calibration session, one row per phase and session.
+# Sessions aborted before saving (e.g. preheat timeout, disconnect) are stored as well, with completed = False.
+class EStepsPhaseTimingModel(BaseModel):
+    sessionId = peewee.CharField(index=True)
+    toolIndex = peewee.IntegerField(default=0)
+    phase = peewee.CharField()
+    durationSeconds = peewee.FloatField()
+    completed = peewee.BooleanField(default=False)
+
+    class Meta:
+        indexes = (
+            # percentiles per phase are read in order of the duration
+            (('phase', 'durationSeconds'), False),
+            # the maintenance selects the sessions to roll up by their age
+            (('created',), False),
+        )
+
+# Temperature samples and events of an e steps calibration session (completed or aborted), encoded by
+# SessionTraceRecorder: samples and events are stored as one compressed blob each instead of one row per sample.
+class EStepsSessionTraceModel(BaseModel):
+    sessionId = peewee.CharField(unique=True)
+    toolIndex = peewee.IntegerField(default=0)
+    completed = peewee.BooleanField(default=False)
+    # wall clock time the session was started, the times of samples and events are relative to it
+    started = peewee.DateTimeField()
+    sampleCount = peewee.IntegerField()
+    eventCount = peewee.IntegerField()
+    samples = peewee.BlobField()
+    events = peewee.BlobField()
+    # filament of the session, also known for aborted sessions which stored no calibration (empty for older traces)
+    filamentName = peewee.CharField(default="", constraints=[peewee.SQL("DEFAULT ''")])
+    filamentType = peewee.CharField(default="", constraints=[peewee.SQL("DEFAULT ''")])
+
+# One extrusion and measurement of an e steps calibration session. An iterative calibration applies the estimated
+# e steps and measures again, all its passes are stored under the session id (of completed and aborted sessions).
+class EStepsCalibrationPassModel(BaseModel):
+    sessionId = peewee.CharField(index=True)
+    toolIndex = peewee.IntegerField(default=0)
+    passIndex = peewee.IntegerField()
+    # e steps applied during the extrusion, remaining length of the 120 mm mark and the e steps estimated from it
+    appliedESteps = peewee.FloatField()
+    measuredLength = peewee.FloatField()
+    estimatedESteps = peewee.FloatField()
+    # |estimatedESteps - appliedESteps| / appliedESteps
+    relativeChange = peewee.FloatField()
+
+# Monthly per filament rollup of e steps calibration sessions whose detail (phase timings, trace and passes) was
+# deleted by the database maintenance after the retention period. Filament name and type are empty for sessions
+# which were aborted before saving.
+class EStepsSessionRollupModel(BaseModel):
+    # "YYYY-MM" of the start of the sessions
+    month = peewee.CharField()
+    filamentName = peewee.CharField()
+    filamentType = peewee.CharField()
+    sessionCount = peewee.IntegerField(default=0)
+    completedCount = peewee.IntegerField(default=0)
+    passCount = peewee.IntegerField(default=0)
+    # sum of the durations of all phases of the sessions
+    durationSeconds = peewee.FloatField(default=0.0)
+    sampleCount = peewee.IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('month', 'filamentName', 'filamentType'), True),
+        )
+
+# Result of a PID autotune (M303), stored as soon as the firmware reported the final gains
+class PidAutotuneModel(BaseModel):
+    sessionId = peewee.CharField(unique=True)
+    # "tool0", "tool1", ... or "bed"
+    heater = peewee.CharField(index=True)
+    targetTemperature = peewee.IntegerField()
+    # number of cycles requested (C parameter of M303)
+    requestedCycles = peewee.IntegerField()
+    kp = peewee.FloatField()
+    ki = peewee.FloatField()
+    kd = peewee.FloatField()
+    # ultimate gain and period of the last cycle, None if the firmware did not report them
+    ku = peewee.FloatField(null=True)
+    tu = peewee.FloatField(null=True)
+    durationSeconds = peewee.FloatField(null=True)
+    # True once the gains were sent to the printer (M301/M304 and M500)
+    applied = peewee.BooleanField(default=False)
+
+# One heating cycle of a PID autotune as reported by the firmware, gains are None for the first cycles
+class PidAutotuneCycleModel(BaseModel):
+    sessionId = peewee.CharField(index=True)
+    cycleIndex = peewee.IntegerField()
+    bias = peewee.IntegerField()
+    d = peewee.IntegerField()
+    minTemperature = peewee.FloatField()
+    maxTemperature = peewee.FloatField()
+    ku = peewee.FloatField(null=True)
+    tu = peewee.FloatField(null=True)
+    kp = peewee.FloatField(null=True)
+    ki = peewee.FloatField(null=True)
+    kd = peewee.FloatField(null=True)
+
+# Calibration print (temperature tower, flow cube or retraction test) generated for a filament by
+# CalibrationGcodeGenerator, linked to the generated file and, once measured, to its result
+class CalibrationPrintModel(BaseModel):
+    # see CalibrationGcodeGenerator.PRINT_TYPES
+    printType = peewee.CharField(index=True)
+    # normalized parameters as JSON and their hash (identifies the generated file)
+    parameters = peewee.TextField()
+    parametersHash = peewee.CharField(index=True)
+    # path of the generated file in OctoPrint's local file storage
+    filePath = peewee.CharField(index=True)
+    filamentName = peewee.CharField()
+    filamentType = peewee.CharField()
+    toolIndex = peewee.IntegerField(default=0)
+    # end of the print of the file (PrintDone event), None until then
+    printed = peewee.DateTimeField(null=True)
+    # value measured on the print, the setting recommended from it (see CalibrationGcodeGenerator.evaluateResult),
+    # a note of the user and when the result was stored, None until then
+    resultValue = peewee.FloatField(null=True)
+    recommendedValue = peewee.FloatField(null=True)
+    resultNote = peewee.TextField(null=True)
+    measured = peewee.DateTimeField(null=True)
+
+# Versions of the schema migrations applied to the database, see SchemaMigrator
+class SchemaVersionModel(BaseModel):
+    version = peewee.IntegerField(unique=True)
+    description = peewee.CharField()
 
-MODELS = [EStepsCalibrationModel]
+MODELS = [SchemaVersionModel, EStepsCalibrationModel, EStepsFilamentSummaryModel, EStepsPhaseTimingModel, EStepsSessionTraceModel,
+          EStepsCalibrationPassModel, EStepsSessionRollupModel, PidAutotuneModel, PidAutotuneCycleModel, CalibrationPrintModel]
@@ -0,0 +1,116 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import collections
+import math
+
+# Estimates when a heating hotend reaches its target from a rolling window of temperature samples. Heating
+# is modelled as first order system dT/dt = k * (settleTemperature - T), the rates between samples are
+# fitted against the temperature by least squares, which gives k and the settle temperature.
+class PreheatEstimator(object):
+    # samples older than this are dropped from the window (seconds)
+    WINDOW_SECONDS = 60.0
+    MAX_SAMPLES = 64
+    # the current rate of change is fitted from the samples of this many last seconds
+    RATE_WINDOW_SECONDS = 8.0
+    # temperature is considered stable if all samples of the last STABLE_WINDOW_SECONDS (at least
+    # MIN_STABLE_SPAN apart) are within the tolerance and it changes slower than STABLE_RATE (degrees per second)
+    STABLE_WINDOW_SECONDS = 5.0
+    MIN_STABLE_SPAN = 1.5
+    STABLE_RATE = 0.25
+    # the first order model is only fitted with at least this many samples, fewer are too noisy
+    MIN_FIT_SAMPLES = 8
+
+    def __init__(self):
+        # (time in seconds, temperature)
+        self._samples = collections.deque(maxlen=PreheatEstimator.MAX_SAMPLES)
+
+    def addSample(self, sampledAt, temperature):
+        if self._samples and sampledAt <= self._samples[-1][0]:
+            return
+        self._samples.append((sampledAt, temperature))
+        while self._samples and sampledAt - self._samples[0][0] > PreheatEstimator.WINDOW_SECONDS:
+            self._samples.popleft()
+
+    # Rate of change (degrees per second) of the latest samples, None if there are not enough samples
+    def currentRate(self, windowSeconds=RATE_WINDOW_SECONDS):
+        recent = self._recentSamples(windowSeconds)
+        if len(recent) < 2:
+            return None
+        slope, _ = _fitLine([sampledAt for sampledAt, _ in recent], [temperature for _, temperature in recent])
+        return slope
+
+    # True if the temperature is within tolerance of the target and does not change (much) anymore
+    def isStable(self, target, tolerance):
+        recent = self._recentSamples(PreheatEstimator.STABLE_WINDOW_SECONDS)
+        if len(recent) < 2 or recent[-1][0] - recent[0][0] < PreheatEstimator.MIN_STABLE_SPAN:
+            return False
+        # an overshoot or oscillation must have settled within the tolerance
+        if any(abs(temperature - target) > tolerance for _, temperature in recent):
+            return False
+        rate = self.currentRate(PreheatEstimator.STABLE_WINDOW_SECONDS)
+        return rate is not None and abs(rate) <= PreheatEstimator.STABLE_RATE
+
+    # Returns a dict with etaSeconds (0 if within tolerance, None if unknown or never), rate (degrees per second),
+    # settleTemperature (None without a fit) and stable
+    def estimate(self, target, tolerance):
+        result = dict(etaSeconds=None, rate=self.currentRate(), settleTemperature=None, stable=self.isStable(target, tolerance))
+        if not self._samples:
+            return result
+        current = self._samples[-1][1]
+        if abs(current - target) <= tolerance:
+            result["etaSeconds"] = 0.0
+            return result
+
+        threshold = target - tolerance if current < target else target + tolerance
+        k, settleTemperature = self._fitFirstOrder()
+        if k is not None and k > 0:
+            result["settleTemperature"] = settleTemperature
+            remainingFraction = (settleTemperature - threshold) / (settleTemperature - current)
+            if 0 < remainingFraction < 1:
+                result["etaSeconds"] = -math.log(remainingFraction) / k
+            # otherwise the hotend settles before it reaches the threshold, e.g. because of a too weak heater
+            return result
+
+        # no usable fit (e.g. too few samples or linear heating), extrapolate the current rate
+        rate = result["rate"]
+        if rate is not None and rate * (threshold - current) > 0:
+            result["etaSeconds"] = (threshold - current) / rate
+        return result
+
+    ##################
+    ### Internal stuff
+
+    def _recentSamples(self, windowSeconds):
+        if not self._samples:
+            return []
+        latest = self._samples[-1][0]
+        return [sample for sample in self._samples if latest - sample[0] <= windowSeconds]
+
+    # Returns (k, settleTemperature) of dT/dt = k * (settleTemperature - T), (None, None) if there is no usable fit
+    def _fitFirstOrder(self):
+        if len(self._samples) < PreheatEstimator.MIN_FIT_SAMPLES:
+            return None, None
+        temperatures = []
+        rates = []
+        samples = list(self._samples)
+        for (t0, temp0), (t1, temp1) in zip(samples, samples[1:]):
+            temperatures.append((temp0 + temp1) / 2.0)
+            rates.append((temp1 - temp0) / (t1 - t0))
+        # rate = a + b * T with b = -k and a = k * settleTemperature
+        b, a = _fitLine(temperatures, rates)
+        if b is None or b >= 0:
+            return None, None
+        return -b, a / -b
+
+
+# Least squares fit of y = slope * x + intercept, returns (slope, intercept) or (None, None) if x does not vary
+def _fitLine(xs, ys):
+    n = len(xs)
+    meanX = sum(xs) / n
+    meanY = sum(ys) / n
+    sxx = sum((x - meanX) ** 2 for x in xs)
+    if sxx <= 1e-12:
+        return None, None
+    sxy = sum((x - meanX) * (y - meanY) for x, y in zip(xs, ys))
+    slope = sxy / sxx
+    return slope, meanY - slope * meanX
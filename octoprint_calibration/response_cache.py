@@ -0,0 +1,39 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import collections
+import hashlib
+import threading
+
+# LRU cache of serialized responses and their ETags, entries built from an older data version
+# (see DatabaseManager.getDataVersion) are treated as missing
+class ResponseCache(object):
+    def __init__(self, maxEntries=64):
+        self._maxEntries = maxEntries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns a tuple (etag, body) or None if there is no entry for this key and data version
+    def get(self, key, dataVersion):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != dataVersion:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    # Stores the serialized body and returns its ETag
+    def put(self, key, dataVersion, body):
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            self._entries[key] = (dataVersion, etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxEntries:
+                self._entries.popitem(last=False)
+        return etag
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,212 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import logging
+import time
+
+import peewee
+
+import octoprint_calibration.models as models
+
+# Brings the database to the latest schema version, every migration runs in its own transaction together
+# with recording its version. Migrations are written out as SQL and only create what is missing, so they
+# also run on databases created before the schema was versioned (version 0). Columns are added before
+# the indexes over them: SQLite takes the quoted name of a missing column for a string literal.
+class SchemaMigrator(object):
+    # (version, description, name of the migration method). Released migrations are never changed,
+    # every schema change is added as a new migration.
+    MIGRATIONS = (
+        (1, "e steps calibrations", "_migrateEStepsCalibrations"),
+        (2, "e steps filament summaries", "_migrateFilamentSummaries"),
+        (3, "phase timings and session traces", "_migratePhaseTimingsAndTraces"),
+        (4, "PID autotunes", "_migratePidAutotunes"),
+        (5, "passes of iterative e steps calibrations", "_migrateCalibrationPasses"),
+        (6, "session rollups", "_migrateSessionRollups"),
+        (7, "quick verification and filament history", "_migrateFilamentHistory"),
+        (8, "calibration prints", "_migrateCalibrationPrints"),
+        (9, "filament of session traces", "_migrateSessionTraceFilament"),
+    )
+    LATEST_VERSION = MIGRATIONS[-1][0]
+
+    # database: connected peewee database the models are bound to
+    def __init__(self, parentLogger, database):
+        self._logger = logging.getLogger(parentLogger.name + "." + self.__class__.__name__)
+        self._database = database
+
+    # Version of the database, 0 if no migration was applied yet
+    def getVersion(self):
+        return models.SchemaVersionModel.select(peewee.fn.MAX(models.SchemaVersionModel.version)).scalar() or 0
+
+    # Applies all pending migrations, returns the version of the database afterwards
+    def migrate(self):
+        self._createTable("calib_schemaversionmodel",
+            '"databaseId" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, "version" INTEGER NOT NULL, "description" VARCHAR(255) NOT NULL')
+        self._createIndex("calib_schemaversionmodel", "schemaversionmodel_version", ("version",), unique=True)
+        version = self.getVersion()
+        if version > SchemaMigrator.LATEST_VERSION:
+            # e.g. after a downgrade of the plugin, the newer schema is left untouched
+            self._logger.warning("Database schema version %d is newer than the supported version %d.", version, SchemaMigrator.LATEST_VERSION)
+            return version
+        for migrationVersion, description, methodName in SchemaMigrator.MIGRATIONS:
+            if migrationVersion <= version:
+                continue
+            self._logger.info("Migrating database schema to version %d (%s).", migrationVersion, description)
+            startedAt = time.monotonic()
+            with self._database.atomic():
+                getattr(self, methodName)()
+                models.SchemaVersionModel.create(version=migrationVersion, description=description)
+            self._logger.info("Migrated database schema to version %d in %.2f s.", migrationVersion, time.monotonic() - startedAt)
+            version = migrationVersion
+        return version
+
+    ##################
+    ### Migrations
+
+    def _migrateEStepsCalibrations(self):
+        table = "calib_estepscalibrationmodel"
+        self._createTable(table,
+            '"databaseId" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, "filamentName" VARCHAR(255) NOT NULL, '
+            '"filamentType" VARCHAR(255) NOT NULL, "hotendTemperature" DECIMAL(10, 5) NOT NULL, "oldESteps" DECIMAL(10, 5) NOT NULL, '
+            '"newESteps" DECIMAL(10, 5) NOT NULL')
+        # added after the first release (multiple extruders, phase timings)
+        self._addMissingColumns(table, (
+            ("toolIndex", "INTEGER NOT NULL DEFAULT 0"),
+            ("sessionId", "VARCHAR(255)")
+        ))
+        self._createIndex(table, "estepscalibrationmodel_filamentName", ("filamentName",))
+        self._createIndex(table, "estepscalibrationmodel_filamentType", ("filamentType",))
+        self._createIndex(table, "estepscalibrationmodel_sessionId", ("sessionId",))
+        self._createIndex(table, "estepscalibrationmodel_created_databaseId", ("created", "databaseId"))
+
+    def _migrateFilamentSummaries(self):
+        table = "calib_estepsfilamentsummarymodel"
+        self._createTable(table,
+            '"databaseId" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, "filamentName" VARCHAR(255) NOT NULL, '
+            '"filamentType" VARCHAR(255) NOT NULL, "count" INTEGER NOT NULL, "sumNewESteps" REAL NOT NULL, "sumSquaresNewESteps" REAL NOT NULL, '
+            '"sumDeltaESteps" REAL NOT NULL, "latestNewESteps" DECIMAL(10, 5), "latestCreated" DATETIME')
+        self._createIndex(table, "estepsfilamentsummarymodel_filamentName_filamentType", ("filamentName", "filamentType"), unique=True)
+        if not models.EStepsFilamentSummaryModel.select().exists() and models.EStepsCalibrationModel.select().exists():
+            self._rebuildFilamentSummaries()
+
+    def _migratePhaseTimingsAndTraces(self):
+        self._createTable("calib_estepsphasetimingmodel",
+            '"databaseId" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, "sessionId" VARCHAR(255) NOT NULL, '
+            '"toolIndex" INTEGER NOT NULL, "phase" VARCHAR(255) NOT NULL, "durationSeconds" REAL NOT NULL, "completed" INTEGER NOT NULL')
+        self._createIndex("calib_estepsphasetimingmodel", "estepsphasetimingmodel_sessionId", ("sessionId",))
+        self._createIndex("calib_estepsphasetimingmodel", "estepsphasetimingmodel_phase_durationSeconds", ("phase", "durationSeconds"))
+        self._createTable("calib_estepssessiontracemodel",
+            '"databaseId" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, "sessionId" VARCHAR(255) NOT NULL, '
+            '"toolIndex" INTEGER NOT NULL, "completed" INTEGER NOT NULL, "started" DATETIME NOT NULL, "sampleCount" INTEGER NOT NULL, '
+            '"eventCount" INTEGER NOT NULL, "samples" BLOB NOT NULL, "events" BLOB NOT NULL')
+        self._createIndex("calib_estepssessiontracemodel", "estepssessiontracemodel_sessionId", ("sessionId",), unique=True)
+
+    def _migratePidAutotunes(self):
+        self._createTable("calib_pidautotunemodel",
+            '"databaseId" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, "sessionId" VARCHAR(255) NOT NULL, '
+            '"heater" VARCHAR(255) NOT NULL, "targetTemperature" INTEGER NOT NULL, "requestedCycles" INTEGER NOT NULL, "kp" REAL NOT NULL, '
+            '"ki" REAL NOT NULL, "kd" REAL NOT NULL, "ku" REAL, "tu" REAL, "durationSeconds" REAL, "applied" INTEGER NOT NULL')
+        self._createIndex("calib_pidautotunemodel", "pidautotunemodel_sessionId", ("sessionId",), unique=True)
+        self._createIndex("calib_pidautotunemodel", "pidautotunemodel_heater", ("heater",))
+        self._createTable("calib_pidautotunecyclemodel",
+            '"databaseId" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, "sessionId" VARCHAR(255) NOT NULL, '
+            '"cycleIndex" INTEGER NOT NULL, "bias" INTEGER NOT NULL, "d" INTEGER NOT NULL, "minTemperature" REAL NOT NULL, '
+            '"maxTemperature" REAL NOT NULL, "ku" REAL, "tu" REAL, "kp" REAL, "ki" REAL, "kd" REAL')
+        self._createIndex("calib_pidautotunecyclemodel", "pidautotunecyclemodel_sessionId", ("sessionId",))
+
+    def _migrateCalibrationPasses(self):
+        self._addMissingColumns("calib_estepscalibrationmodel", (
+            ("passCount", "INTEGER NOT NULL DEFAULT 1"),
+            ("confidenceHalfWidth", "REAL")
+        ))
+        self._createTable("calib_estepscalibrationpassmodel",
+            '"databaseId" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, "sessionId" VARCHAR(255) NOT NULL, '
+            '"toolIndex" INTEGER NOT NULL, "passIndex" INTEGER NOT NULL, "appliedESteps" REAL NOT NULL, "measuredLength" REAL NOT NULL, '
+            '"estimatedESteps" REAL NOT NULL, "relativeChange" REAL NOT NULL')
+        self._createIndex("calib_estepscalibrationpassmodel", "estepscalibrationpassmodel_sessionId", ("sessionId",))
+
+    def _migrateSessionRollups(self):
+        self._createTable("calib_estepssessionrollupmodel",
+            '"databaseId" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, "month" VARCHAR(255) NOT NULL, '
+            '"filamentName" VARCHAR(255) NOT NULL, "filamentType" VARCHAR(255) NOT NULL, "sessionCount" INTEGER NOT NULL, '
+            '"completedCount" INTEGER NOT NULL, "passCount" INTEGER NOT NULL, "durationSeconds" REAL NOT NULL, "sampleCount" INTEGER NOT NULL')
+        self._createIndex("calib_estepssessionrollupmodel", "estepssessionrollupmodel_month_filamentName_filamentType",
+            ("month", "filamentName", "filamentType"), unique=True)
+        # the maintenance selects the sessions to roll up by their age
+        self._createIndex("calib_estepsphasetimingmodel", "estepsphasetimingmodel_created", ("created",))
+
+    def _migrateFilamentHistory(self):
+        table = "calib_estepscalibrationmodel"
+        self._addMissingColumns(table, (("extrusionLength", "INTEGER NOT NULL DEFAULT 100"),))
+        self._createIndex(table, "estepscalibrationmodel_filamentName_filamentType_created", ("filamentName", "filamentType", "created"))
+
+    def _migrateCalibrationPrints(self):
+        table = "calib_calibrationprintmodel"
+        self._createTable(table,
+            '"databaseId" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, "printType" VARCHAR(255) NOT NULL, '
+            '"parameters" TEXT NOT NULL, "parametersHash" VARCHAR(255) NOT NULL, "filePath" VARCHAR(255) NOT NULL, '
+            '"filamentName" VARCHAR(255) NOT NULL, "filamentType" VARCHAR(255) NOT NULL, "toolIndex" INTEGER NOT NULL, '
+            '"printed" DATETIME, "resultValue" REAL, "recommendedValue" REAL, "resultNote" TEXT, "measured" DATETIME')
+        self._createIndex(table, "calibrationprintmodel_printType", ("printType",))
+        self._createIndex(table, "calibrationprintmodel_parametersHash", ("parametersHash",))
+        self._createIndex(table, "calibrationprintmodel_filePath", ("filePath",))
+
+    def _migrateSessionTraceFilament(self):
+        self._addMissingColumns("calib_estepssessiontracemodel", (
+            ("filamentName", "VARCHAR(255) NOT NULL DEFAULT ''"),
+            ("filamentType", "VARCHAR(255) NOT NULL DEFAULT ''"),
+        ))
+
+    ##################
+    ### Internal stuff
+
+    # Creates the table unless it exists, columns: SQL column definitions
+    def _createTable(self, tableName, columns):
+        self._database.execute_sql('CREATE TABLE IF NOT EXISTS "%s" (%s)' % (tableName, columns))
+
+    # Creates the index unless it exists, the indexed columns must exist
+    def _createIndex(self, tableName, indexName, columnNames, unique=False):
+        self._database.execute_sql('CREATE %sINDEX IF NOT EXISTS "%s" ON "%s" (%s)' % \
+            ("UNIQUE " if unique else "", indexName, tableName, ", ".join('"%s"' % name for name in columnNames)))
+
+    # Adds the columns ((name, SQL definition) tuples) to the table unless they exist.
+    # The definitions must have a default (or be nullable) for this to work.
+    def _addMissingColumns(self, tableName, columns):
+        existingColumns = set(column.name for column in self._database.get_columns(tableName))
+        for columnName, definition in columns:
+            if columnName in existingColumns:
+                continue
+            self._logger.info("Adding column %s to table %s.", columnName, tableName)
+            self._database.execute_sql('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (tableName, columnName, definition))
+
+    # Computes all filament summaries from the stored calibrations in one statement
+    def _rebuildFilamentSummaries(self):
+        model = models.EStepsCalibrationModel
+        summary = models.EStepsFilamentSummaryModel
+        latest = model.alias()
+        latestNewESteps = latest.select(latest.newESteps) \
+            .where((latest.filamentName == model.filamentName) & (latest.filamentType == model.filamentType)) \
+            .order_by(latest.created.desc()) \
+            .limit(1)
+        query = model.select(
+            model.filamentName,
+            model.filamentType,
+            peewee.fn.COUNT(model.databaseId),
+            peewee.fn.SUM(model.newESteps),
+            peewee.fn.SUM(model.newESteps * model.newESteps),
+            peewee.fn.SUM(model.newESteps - model.oldESteps),
+            latestNewESteps,
+            peewee.fn.MAX(model.created),
+            peewee.fn.MIN(model.created)
+        ).group_by(model.filamentName, model.filamentType)
+        summary.delete().execute()
+        summary.insert_from(query, [
+            summary.filamentName,
+            summary.filamentType,
+            summary.count,
+            summary.sumNewESteps,
+            summary.sumSquaresNewESteps,
+            summary.sumDeltaESteps,
+            summary.latestNewESteps,
+            summary.latestCreated,
+            summary.created
+        ]).execute()
+        self._logger.info("Rebuilt e steps filament summaries.")
@@ -0,0 +1,118 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import array
+import datetime
+import json
+import sys
+import zlib
+
+# Temperature samples and events (state switches, commands, answers, errors) of one calibration session.
+# Samples are kept as fixed point integers in a flat array, stored delta encoded and compressed (see encodeSamples).
+class SessionTraceRecorder(object):
+    # columns of a sample and the factor they are scaled with before being rounded to integers,
+    # i.e. times in milliseconds since the start of the session and temperatures in 1/100 degrees
+    CHANNELS = ("time", "actual", "target", "pwm")
+    SCALES = (1000, 100, 100, 1)
+    # heater power is not reported by every firmware
+    UNKNOWN_PWM = -1
+
+    # upper limits per session, further samples and events are dropped
+    MAX_SAMPLES = 20000
+    MAX_EVENTS = 1000
+
+    # startedAt: clock time (seconds) the session was started, all times are relative to it
+    def __init__(self, startedAt):
+        self.startedAt = startedAt
+        # wall clock time the session was started, stored with the trace
+        self.started = datetime.datetime.now()
+        self._samples = array.array("i")
+        # [milliseconds since start, text]
+        self._events = []
+        self.droppedSamples = 0
+
+    def getSampleCount(self):
+        return len(self._samples) // len(SessionTraceRecorder.CHANNELS)
+
+    def getEventCount(self):
+        return len(self._events)
+
+    def addSample(self, sampledAt, actual, target, pwm=None):
+        if self.getSampleCount() >= SessionTraceRecorder.MAX_SAMPLES:
+            self.droppedSamples += 1
+            return
+        values = (sampledAt - self.startedAt, actual, target or 0.0, SessionTraceRecorder.UNKNOWN_PWM if pwm is None else pwm)
+        self._samples.extend(int(round(value * scale)) for value, scale in zip(values, SessionTraceRecorder.SCALES))
+
+    def addEvent(self, at, text):
+        if len(self._events) >= SessionTraceRecorder.MAX_EVENTS:
+            return
+        self._events.append([int(round((at - self.startedAt) * 1000)), text])
+
+    # Returns the blobs stored in EStepsSessionTraceModel
+    def encode(self):
+        return encodeSamples(self._samples), zlib.compress(json.dumps(self._events).encode("utf-8"))
+
+
+# Every value is replaced by its difference to the value of the same channel in the previous sample
+# (times and temperatures change slowly, so mostly small numbers remain), the little endian 32 bit
+# integers are compressed with zlib.
+def encodeSamples(samples):
+    channelCount = len(SessionTraceRecorder.CHANNELS)
+    deltas = array.array("i", samples[:channelCount])
+    deltas.extend(samples[i] - samples[i - channelCount] for i in range(channelCount, len(samples)))
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return zlib.compress(deltas.tobytes())
+
+# Returns a dict channel name -> list of the values of all samples (in units, i.e. not scaled)
+def decodeSamples(blob):
+    channelCount = len(SessionTraceRecorder.CHANNELS)
+    values = array.array("i")
+    values.frombytes(zlib.decompress(blob))
+    if sys.byteorder == "big":
+        values.byteswap()
+    # prefix sums per channel undo the delta encoding
+    for i in range(channelCount, len(values)):
+        values[i] += values[i - channelCount]
+    return {name: [value / float(scale) for value in values[channelIndex::channelCount]] \
+        for channelIndex, (name, scale) in enumerate(zip(SessionTraceRecorder.CHANNELS, SessionTraceRecorder.SCALES))}
+
+# Returns a list of [seconds since start, text]
+def decodeEvents(blob):
+    return [[at / 1000.0, text] for at, text in json.loads(zlib.decompress(blob).decode("utf-8"))]
+
+# Largest Triangle Three Buckets downsampling (Steinarsson 2013): indices of at most threshold points of (xs, ys)
+# that keep the visual shape of the curve. The first and last point are always kept, of the points in between one
+# per bucket is chosen, the one spanning the largest triangle with the previously chosen point and the average of the next bucket.
+def lttbIndices(xs, ys, threshold):
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    indices = [0]
+    bucketSize = (n - 2) / float(threshold - 2)
+    previous = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * bucketSize) + 1
+        end = int((bucket + 1) * bucketSize) + 1
+        nextStart = end
+        nextEnd = min(int((bucket + 2) * bucketSize) + 1, n)
+        if nextStart >= nextEnd:
+            # last bucket, the last point is the next one
+            nextStart, nextEnd = n - 1, n
+        averageX = sum(xs[nextStart:nextEnd]) / float(nextEnd - nextStart)
+        averageY = sum(ys[nextStart:nextEnd]) / float(nextEnd - nextStart)
+
+        previousX = xs[previous]
+        previousY = ys[previous]
+        chosen = start
+        maxArea = -1.0
+        for i in range(start, end):
+            # twice the triangle's area, the factor does not matter for the comparison
+            area = abs((previousX - averageX) * (ys[i] - previousY) - (previousX - xs[i]) * (averageY - previousY))
+            if area > maxArea:
+                maxArea = area
+                chosen = i
+        indices.append(chosen)
+        previous = chosen
+    indices.append(n - 1)
+    return indices
@@ -47,10 +47,32 @@ $(function() {
             );
         };
 
-        self.makeGetRequestToEndPoint = function(endPoint, responseHandler, errorHandler) {
+        self.makeGetRequestToEndPoint = function(endPoint, responseHandler, errorHandler, queryParams) {
             $.ajax({
                 url: self.baseUrl + "plugin/" + self.pluginId + endPoint,
-                type: "get"
+                type: "get",
+                data: queryParams
+            })
+            .done(
+                function( data ){
+                    responseHandler(data);
+                })
+            .fail(
+                function (data) {
+                    console.error("Error: " + JSON.stringify(data));
+                    errorHandler(data);
+                }
+            );
+        }
+
+        // postData (optional) is sent as JSON body
+        self.makePostRequestToEndPoint = function(endPoint, responseHandler, errorHandler, postData) {
+            $.ajax({
+                url: self.baseUrl + "plugin/" + self.pluginId + endPoint,
+                type: "post",
+                dataType: "json",
+                contentType: postData === undefined ? undefined : 'application/json',
+                data: postData === undefined ? undefined : JSON.stringify(postData)
             })
             .done(
                 function( data ){
@@ -67,9 +89,10 @@ $(function() {
 
     // https://jsfiddle.net/AnkUser/975ncawv/149/
     // https://stackoverflow.com/questions/51638095/knockout-table-paging
-    function EStepsCalibrationModel(creationDate, filamentName, filamentType, hotendTemp, oldEsteps, newESteps) {
+    function EStepsCalibrationModel(creationDate, filamentName, filamentType, hotendTemp, oldEsteps, newESteps, toolIndex) {
         var self = this;
         self.creationDate = ko.observable(creationDate);
+        self.toolIndex = ko.observable(toolIndex);
         self.filamentName = ko.observable(filamentName);
         self.filamentType = ko.observable(filamentType);
         self.hotendTemp = ko.observable(hotendTemp);
@@ -79,60 +102,125 @@ $(function() {
     EStepsCalibrationModel.fromRawDataPoint = function(dto) {
         // names must be a direct match as how they are returned by the backend
         // see models.py
-        return new EStepsCalibrationModel(dto.created, dto.filamentName, dto.filamentType, dto.hotendTemperature, dto.oldESteps, dto.newESteps);
+        return new EStepsCalibrationModel(dto.created, dto.filamentName, dto.filamentType, dto.hotendTemperature, dto.oldESteps, dto.newESteps, dto.toolIndex);
     }
 
-    function ShowEStepsCalibrationsView(entriesPerPage) {
+    // Paging, filtering and sorting is done by the backend (keyset pagination),
+    // only the currently shown page is held in the browser.
+    function ShowEStepsCalibrationsView(apiClient, entriesPerPage, errorHandler) {
         var self = this;
 
-        // Start of logic for Paging    
-  
+        self.apiClient = apiClient;
+        self.nbPerPage = entriesPerPage;
+        self.errorHandler = errorHandler;
+
         self.items = ko.observableArray();
-        this.all =  self.items;
+        this.paginated = self.items;
 
-        self.pageNumber = ko.observable(0);
-        self.nbPerPage = entriesPerPage;
-    
-        this.totalPages = ko.computed(function() {
-            var div = Math.floor(self.all().length / self.nbPerPage);
-            div += self.all().length % self.nbPerPage > 0 ? 1 : 0;
-            return div - 1;
-        });
+        // Filters and sorting
+        self.filamentNameFilter = ko.observable("");
+        self.filamentTypeFilter = ko.observable("");
+        self.createdFromFilter = ko.observable("");
+        self.createdToFilter = ko.observable("");
+        self.sortColumns = ko.observableArray([
+            {name: "Creation Date", value: "created"},
+            {name: "Filament Name", value: "filamentName"},
+            {name: "Filament Type", value: "filamentType"},
+            {name: "Hotend Temperature", value: "hotendTemperature"},
+            {name: "Old E Steps", value: "oldESteps"},
+            {name: "New E Steps", value: "newESteps"},
+            {name: "Tool", value: "toolIndex"}
+        ]);
+        self.sortBy = ko.observable("created");
+        self.sortOrder = ko.observable("desc");
+
+        // Start of logic for Paging
+
+        // cursors of all pages shown so far, cursor of the first page is null
+        self.cursors = ko.observableArray([null]);
+        self.nextCursor = ko.observable(null);
 
-        this.paginated = ko.computed(function() {            
-            var first = self.pageNumber() * self.nbPerPage;
-            console.log("paginated called. first=" + first);
-            console.log("self.all=" + JSON.stringify(self.all));
-            console.log("self.items=" + JSON.stringify(self.items));
-            //return self.all.slice(first, first + self.nbPerPage);
-            return self.items.slice(first, first + self.nbPerPage);
+        self.pageNumber = ko.computed(function() {
+            return self.cursors().length - 1;
         });
-    
+
         this.hasPrevious = ko.computed(function() {
             return self.pageNumber() !== 0;
         });
-  
+
         this.hasNext = ko.computed(function() {
-            return self.pageNumber() !== self.totalPages();
+            return self.nextCursor() !== null;
         });
-  
+
         this.next = function() {
-            if(self.pageNumber() < self.totalPages()) {
-                self.pageNumber(self.pageNumber() + 1);
+            if (self.hasNext()) {
+                var cursor = self.nextCursor();
+                self.loadPage(cursor, function() {
+                    self.cursors.push(cursor);
+                });
             }
         }
-  
+
         this.previous = function() {
-            if(self.pageNumber() != 0) {
-                self.pageNumber(self.pageNumber() - 1);
+            if (self.hasPrevious()) {
+                var cursor = self.cursors()[self.cursors().length - 2];
+                self.loadPage(cursor, function() {
+                    self.cursors.pop();
+                });
             }
-        }  
-
+        }
 
         // End of Logic for Paging
 
+        self.queryParams = function(cursor) {
+            var params = {
+                limit: self.nbPerPage,
+                sortBy: self.sortBy(),
+                sortOrder: self.sortOrder()
+            };
+            if (cursor !== null) {
+                params.after = cursor;
+            }
+            if (self.filamentNameFilter()) {
+                params.filamentName = self.filamentNameFilter();
+            }
+            if (self.filamentTypeFilter()) {
+                params.filamentType = self.filamentTypeFilter();
+            }
+            if (self.createdFromFilter()) {
+                params.createdFrom = self.createdFromFilter();
+            }
+            if (self.createdToFilter()) {
+                params.createdTo = self.createdToFilter();
+            }
+            return params;
+        };
+
+        self.loadPage = function(cursor, onLoaded) {
+            self.apiClient.makeGetRequestToEndPoint("/eStepCalibrations",
+                function(data) {
+                    self.loadData(data);
+                    if (onLoaded !== undefined) {
+                        onLoaded();
+                    }
+                },
+                self.errorHandler,
+                self.queryParams(cursor));
+        };
+
+        // (Re)loads the first page, e.g. after filters or sorting were changed
+        self.reload = function(onLoaded) {
+            self.loadPage(null, function() {
+                self.cursors([null]);
+                if (onLoaded !== undefined) {
+                    onLoaded();
+                }
+            });
+        };
+
         self.loadData = function(rawData) {
-            self.items(rawData.map(EStepsCalibrationModel.fromRawDataPoint))
+            self.items(rawData.items.map(EStepsCalibrationModel.fromRawDataPoint));
+            self.nextCursor(rawData.nextCursor);
         }
 
         self.select = function(item) {
@@ -165,11 +253,14 @@ $(function() {
         self.apiClient = apiClient;
         self.parent = parent;       // the creator of this class (e.g. CalibrationViewModel)
 
-        var startExtrudingCmd = {
-            "command": "startExtruding",
-        };
-        var saveNewEstepsCmd = {
-            "command": "saveNewESteps"
+        // Every extruder has its own calibration session in the backend, this view shows the one
+        // of the selected extruder. All commands are sent with the selected extruder as "tool".
+        self.extruderCount = ko.observable(1);
+        self.toolIndex = ko.observable(0);
+
+        self.makeToolCommand = function(command) {
+            command["tool"] = self.toolIndex();
+            return command;
         };
 
         self.onBeforeBinding = function() {
@@ -177,6 +268,11 @@ $(function() {
             // Currently he must reload the site s.t. the new settings take effect (I don't know how to implement that)
             self.stepModels()[0].model().hotendTemperature(self.parent.settings.settings.plugins.calibration.hotendTemp());
             self.stepModels()[6].model().initialize(self.parent.settings.settings.plugins.calibration.entriesPerPageForTables());
+
+            // earlier calibrations are looked up whenever another filament is entered
+            var newCalibrationModel = self.stepModels()[0].model();
+            newCalibrationModel.filamentName.subscribe(newCalibrationModel.loadHistory);
+            newCalibrationModel.selectedFilamentType.subscribe(newCalibrationModel.loadHistory);
         };
 
         /*
@@ -191,16 +287,86 @@ $(function() {
         */
         self.getToolState = function(handleToolState) {
             self.apiClient.makeGetRequest(function (data) {
-                console.log("GET call done:" + JSON.stringify(data));
-        
-                handleToolState(data["eStepsToolState"], data["currTemp"]);
+                // states of all tools by tool name
+                self.extruderCount(data.eSteps.extruderCount);
+                self.toolStates = data.eSteps.tools;
+                handleToolState(data.eSteps);
             });
         };
 
+        // Tool states (per extruder index) as last reported by the backend. State changes are pushed by
+        // the backend via plugin messages, polling the GET endpoint is only done as a fallback.
+        var FALLBACK_POLL_INTERVAL = 15000;
+        self.toolStates = {};
+        self.stateHandler = null;
+        self.stateHandlerGeneration = 0;
+
+        self.currentToolState = function() {
+            return self.toolStates[String(self.toolIndex())] || {};
+        };
+
+        self.onPluginMessage = function(message) {
+            if (message.tool !== "eSteps") {
+                return;
+            }
+            var isSelectedTool = message.toolIndex === undefined || message.toolIndex === null || message.toolIndex === self.toolIndex();
+            if (message.type === "stateUpdate") {
+                var key = String(message.toolIndex);
+                self.toolStates[key] = $.extend(self.toolStates[key] || {}, message.data);
+                if (isSelectedTool) {
+                    self.handleToolState();
+                }
+            } else if (message.type === "error" && isSelectedTool) {
+                self.stopWaitingForToolState();
+                self.parent.reportError(message.message);
+            }
+        };
+
+        self.handleToolState = function() {
+            if (self.stateHandler !== null) {
+                self.stateHandler(self.currentToolState());
+            }
+        };
+
+        self.stopWaitingForToolState = function() {
+            self.stateHandlerGeneration++;
+            self.stateHandler = null;
+        };
+
+        // Calls handler(toolState) on every tool state change until it returns true
+        self.waitForToolState = function(handler) {
+            var generation = ++self.stateHandlerGeneration;
+            self.stateHandler = function(toolState) {
+                if (handler(toolState) && generation === self.stateHandlerGeneration) {
+                    self.stateHandler = null;
+                }
+            };
+
+            var poll = function() {
+                if (generation !== self.stateHandlerGeneration || self.stateHandler === null) {
+                    return;
+                }
+                self.getToolState(function(data) {
+                    self.handleToolState();
+                    setTimeout(poll, FALLBACK_POLL_INTERVAL);
+                });
+            };
+            // initial poll to be in sync with the backend
+            poll();
+        };
+
         self.defaultErrorHandler = function(response) {
             self.parent.reportError(response["responseText"]);
         }
 
+        // Ends the session of the selected extruder, the backend turns off its hotend
+        self.cancelCalibration = function() {
+            self.apiClient.makePostRequest(self.makeToolCommand({"command": "cancelESteps"}), function(data) {
+                self.stopWaitingForToolState();
+                self.parent.goToStartPage();
+            }, self.defaultErrorHandler);
+        };
+
         self.stepModels = ko.observableArray([
             new Step(0, "NewEStepCalibration", "eSteps_newEStepCalibrationTmpl", {
                 filamentName: ko.observable(),
@@ -213,35 +379,65 @@ $(function() {
                 ]),
                 selectedFilamentType: ko.observable(),
                 hotendTemperature: ko.observable(),
+                tools: ko.computed(function() {
+                    var tools = [];
+                    for (var i = 0; i < self.extruderCount(); i++) {
+                        tools.push({name: "Extruder " + i, value: i});
+                    }
+                    return tools;
+                }),
+                showToolSelection: ko.computed(function() {
+                    return self.extruderCount() > 1;
+                }),
+                selectedTool: ko.observable(0),
+                // several passes with the estimated e steps applied, until the estimate converges
+                iterative: ko.observable(false),
+                // earlier calibrations of the entered filament (null if none), a quick verification needs them
+                history: ko.observable(null),
+                quickVerify: ko.observable(false),
+                loadHistory: function() {
+                    var innerSelf = self.stepModels()[0].model();
+                    var filamentType = innerSelf.selectedFilamentType();
+                    if (!innerSelf.filamentName() || !filamentType) {
+                        innerSelf.history(null);
+                        return;
+                    }
+                    self.apiClient.makeGetRequestToEndPoint("/eStepCalibrations/filamentHistory", function(data) {
+                        innerSelf.history(data.history);
+                        if (data.history === null) {
+                            innerSelf.quickVerify(false);
+                        }
+                    }, self.defaultErrorHandler, {filamentName: innerSelf.filamentName(), filamentType: filamentType.name});
+                },
                 startEStepsCalibration: 
                     function() {
                         var innerSelf = this;
 
-                        var calibrateEStepsCmd = {
+                        self.toolIndex(innerSelf.selectedTool() || 0);
+                        var calibrateEStepsCmd = self.makeToolCommand({
                             "command": "calibrateESteps",
                             "filamentName": innerSelf.filamentName(),
                             "filamentType": innerSelf.selectedFilamentType(),
-                            "hotendTemp": innerSelf.hotendTemperature()
-                        };
+                            "hotendTemp": innerSelf.hotendTemperature(),
+                            "iterative": innerSelf.iterative(),
+                            "quickVerify": innerSelf.quickVerify()
+                        });
+                        self.stepModels()[2].model().passNumber(1);
                         
                         self.apiClient.makePostRequest(calibrateEStepsCmd, function(data) {
-                            console.log("Call done:" + JSON.stringify(data));
-
-                            var timeoutHandler = function() {
-                                self.getToolState(function(state, currTemp) {
-                                    if (state == 4) {
-                                        // only advance to next step when state == WAITING_FOR_EXTRUDE_START (4)
-                                        self.parent.setCurrentStep(self.stepModels()[2]);
-                                    }
-                                    else {
-                                        waitingForTempStep = self.stepModels()[1];
-                                        waitingForTempStep.model().currTemperature(currTemp);
-                                        self.parent.setCurrentStep(waitingForTempStep);
-                                        setTimeout(timeoutHandler, 3000);
-                                    }
-                                });
-                            };
-                            timeoutHandler();
+                            self.waitForToolState(function(toolState) {
+                                if (toolState["eStepsToolState"] == 4) {
+                                    // only advance to next step when state == WAITING_FOR_EXTRUDE_START (4)
+                                    self.stepModels()[2].model().updateFromToolState(toolState);
+                                    self.parent.setCurrentStep(self.stepModels()[2]);
+                                    return true;
+                                }
+                                waitingForTempStep = self.stepModels()[1];
+                                waitingForTempStep.model().currTemperature(toolState["currTemp"]);
+                                waitingForTempStep.model().preheatEta(toolState["preheatEta"]);
+                                self.parent.setCurrentStep(waitingForTempStep);
+                                return false;
+                            });
                         }, self.defaultErrorHandler);
                     },
                 backToStartPage:
@@ -250,71 +446,150 @@ $(function() {
                     }
             }),
             new Step(1, "WaitingForExtruderTemp", "eSteps_waitingForExtruderTemp", {     
-                currTemperature: ko.observable()           
+                currTemperature: ko.observable(),
+                cancelCalibration: self.cancelCalibration,
+                // seconds as string, empty if the backend cannot estimate it (yet)
+                preheatEta: ko.observable(""),
+                preheatEtaText: function() {
+                    var eta = parseInt(this.preheatEta(), 10);
+                    if (isNaN(eta)) {
+                        return "estimating ...";
+                    }
+                    if (eta < 60) {
+                        return eta + " s";
+                    }
+                    return Math.floor(eta / 60) + " min " + (eta % 60) + " s";
+                }
             }),
             new Step(2, "StartExtruding", "eSteps_startExtrudingTmpl", {
+                // pass of an iterative calibration and the e steps applied for it
+                passNumber: ko.observable(1),
+                maxPasses: ko.observable(""),
+                appliedEsteps: ko.observable(""),
+                // 100 mm (20 mm for a quick verification) are extruded, the mark is 20 mm above
+                extrusionLength: ko.observable("100"),
+                markLength: ko.observable("120"),
+                historyCount: ko.observable("0"),
+                historyLatestEsteps: ko.observable(""),
+                historyMedianEsteps: ko.observable(""),
+                cancelCalibration: self.cancelCalibration,
+                updateFromToolState: function(toolState) {
+                    var innerSelf = self.stepModels()[2].model();
+                    innerSelf.extrusionLength(toolState["extrusionLength"] || "100");
+                    innerSelf.markLength(toolState["markLength"] || "120");
+                    innerSelf.historyCount(toolState["historyCount"] || "0");
+                    innerSelf.historyLatestEsteps(toolState["historyLatestEsteps"] || "");
+                    innerSelf.historyMedianEsteps(toolState["historyMedianEsteps"] || "");
+                },
                 startExtruding: 
                     function() {
-                        console.log("startExtruding called");                        
-            
-                        self.apiClient.makePostRequest(startExtrudingCmd, function(data) {
-                            console.log("Call done:" + JSON.stringify(data)); 
-                        }, self.defaultErrorHandler);
-
-                        var timeoutHandler = function() {
-                            self.getToolState(function(state) {
-                                if (state == 6) {
+                        self.apiClient.makePostRequest(self.makeToolCommand({"command": "startExtruding"}), function(data) {
+                            var waitingForExtrudeStep = self.stepModels()[3];
+                            self.waitForToolState(function(toolState) {
+                                if (toolState["eStepsToolState"] == 6) {
                                     // only advance to next step when state == WAITING_FOR_MEASUREMENT_INPUT (6)
+                                    waitingForExtrudeStep.model().stopProgress();
                                     self.parent.setCurrentStep(self.stepModels()[4]);
+                                    return true;
                                 }
-                                else {
-                                    self.parent.setCurrentStep(self.stepModels()[3]);
-                                    setTimeout(timeoutHandler, 3000);
+                                // another extruder may be extruding, only one extrudes at a time
+                                waitingForExtrudeStep.model().extrusionQueued(toolState["extrusionQueued"] == "True");
+                                if (toolState["eStepsToolState"] == 5) {
+                                    waitingForExtrudeStep.model().startProgress(toolState["extrusionElapsed"], toolState["extrusionDuration"]);
                                 }
+                                self.parent.setCurrentStep(waitingForExtrudeStep);
+                                return false;
                             });
-                        };
-                        timeoutHandler();
+                        }, self.defaultErrorHandler);
                     }
             }),
             new Step(3, "WaitingForExtrudeFinished", "eSteps_waitingForExtrudeFinishedTmpl", {
+                extrusionQueued: ko.observable(false),
+                // estimated from the feed rate, the backend only reports the start and the end of the extrusion
+                progressPercent: ko.observable(0),
+                remainingSeconds: ko.observable(null),
+                progressTimer: null,
+                startProgress: function(elapsed, duration) {
+                    var innerSelf = self.stepModels()[3].model();
+                    elapsed = parseFloat(elapsed);
+                    duration = parseFloat(duration);
+                    if (isNaN(elapsed) || isNaN(duration) || duration <= 0) {
+                        return;
+                    }
+                    var startedAt = Date.now() - elapsed * 1000;
+                    var update = function() {
+                        var elapsedSeconds = (Date.now() - startedAt) / 1000;
+                        // stays below 100 % until the printer reports the end of the extrusion
+                        innerSelf.progressPercent(Math.min(99, Math.floor(elapsedSeconds / duration * 100)));
+                        innerSelf.remainingSeconds(Math.max(0, Math.ceil(duration - elapsedSeconds)));
+                    };
+                    innerSelf.stopProgress();
+                    update();
+                    innerSelf.progressTimer = setInterval(update, 1000);
+                },
+                stopProgress: function() {
+                    var innerSelf = self.stepModels()[3].model();
+                    if (innerSelf.progressTimer !== null) {
+                        clearInterval(innerSelf.progressTimer);
+                        innerSelf.progressTimer = null;
+                    }
+                    innerSelf.progressPercent(0);
+                    innerSelf.remainingSeconds(null);
+                }
             }),
             new Step(4, "EStepsResult", "eSteps_resultCalcTmpl", {
                 measuredFilamentLength: ko.observable(20),
+                cancelCalibration: self.cancelCalibration,
                 submitMeasuredFilamentLength: 
                     function() {
-                        console.log("submitMeasuredFilamentLength called");
-
                         var innerSelf = this;
 
-                        var eStepsMeasuredCmd = {
+                        var eStepsMeasuredCmd = self.makeToolCommand({
                             "command": "eStepsMeasured",
                             "measurement": innerSelf.measuredFilamentLength()
-                        };
-            
-                        console.log("Sending request: " + JSON.stringify(eStepsMeasuredCmd));
+                        });
             
                         self.apiClient.makePostRequest(eStepsMeasuredCmd, function(data) {
-                            console.log("Call done:" + JSON.stringify(data));
-            
-                            self.apiClient.makeGetRequest(function (data) {
-                                console.log("GET call done:" + JSON.stringify(data));
-            
-                                if (data["newEstepsValid"] == "True") {
-                                    innerSelf.oldEsteps(data["oldEsteps"]);
-                                    innerSelf.newEsteps(data["newEsteps"]);
+                            // keeps updating the shown values, the measurement may be submitted again
+                            self.waitForToolState(function(toolState) {
+                                var passes = toolState["passes"] || [];
+                                if (toolState["eStepsToolState"] == 4) {
+                                    // iterative calibration did not converge yet, the next pass starts with WAITING_FOR_EXTRUDE_START (4)
+                                    var startExtrudingStep = self.stepModels()[2];
+                                    startExtrudingStep.model().passNumber(passes.length + 1);
+                                    startExtrudingStep.model().maxPasses(toolState["maxPasses"]);
+                                    startExtrudingStep.model().appliedEsteps(toolState["appliedEsteps"]);
+                                    self.parent.setCurrentStep(startExtrudingStep);
+                                    return true;
                                 }
+                                if (toolState["newEstepsValid"] == "True") {
+                                    innerSelf.oldEsteps(toolState["oldEsteps"]);
+                                    innerSelf.newEsteps(toolState["newEsteps"]);
+                                    innerSelf.confidenceHalfWidth(toolState["confidenceHalfWidth"] || "");
+                                    innerSelf.converged(toolState["converged"] == "True");
+                                    innerSelf.passes(passes);
+                                    innerSelf.quickVerify(toolState["quickVerify"] == "True");
+                                    innerSelf.verified(toolState["verified"] == "True");
+                                }
+                                return false;
                             });
                         }, self.defaultErrorHandler);
                     },
                 oldEsteps: ko.observable(),
                 newEsteps: ko.observable(),
+                // iterative calibration: half width of the 95 % confidence interval of newEsteps and all passes
+                confidenceHalfWidth: ko.observable(""),
+                converged: ko.observable(false),
+                passes: ko.observableArray([]),
+                quickVerify: ko.observable(false),
+                verified: ko.observable(false),
+                formatPercent: function(value) {
+                    return (value * 100).toFixed(2) + " %";
+                },
                 saveNewEsteps: 
                     function() {
-                        console.log("saveNewEsteps called");
-            
-                        self.apiClient.makePostRequest(saveNewEstepsCmd, function(data) {
-                            console.log("Call done:" + JSON.stringify(data));
-
+                        self.apiClient.makePostRequest(self.makeToolCommand({"command": "saveNewESteps"}), function(data) {
+                            self.stopWaitingForToolState();
                             self.parent.setCurrentStep(self.stepModels()[5]);
                         }, self.defaultErrorHandler);
                     }
@@ -329,99 +604,467 @@ $(function() {
                 eStepsCalibrationView: undefined,
                 initialize: function(entriesPerPage) {
                     var innerSelf = this;
-                    //var entriesPerPage = 20;
-                    innerSelf.eStepsCalibrationView = new ShowEStepsCalibrationsView(entriesPerPage);
+                    innerSelf.eStepsCalibrationView = new ShowEStepsCalibrationsView(self.apiClient, entriesPerPage, self.defaultErrorHandler);
                 },
-                loadData: function(rawData) {
+                applyFilters: function() {
                     var innerSelf = this;
-                    console.log("Loading data: " + JSON.stringify(rawData))
-                    innerSelf.eStepsCalibrationView.loadData(rawData);
+                    innerSelf.eStepsCalibrationView.reload();
+                },
+                exportUrl: function(format) {
+                    return self.apiClient.baseUrl + "plugin/" + self.apiClient.pluginId + "/eStepCalibrations/export." + format;
                 },
                 backToStartPage: function() {
                     self.parent.goToStartPage();
                 }           
+            }),
+            // special step for the e steps statistics view, aggregates are computed by the backend
+            new Step(7, "EStepsStatisticsView", "eSteps_statisticsTmpl", {
+                filaments: ko.observableArray(),
+                selectedFilament: ko.observable(null),
+                buckets: ko.observableArray([
+                    {name: "Day", value: "day"},
+                    {name: "Week", value: "week"},
+                    {name: "Month", value: "month"}
+                ]),
+                selectedBucket: ko.observable("week"),
+                formatNumber: function(value) {
+                    return (value === null || value === undefined) ? "-" : value.toFixed(2);
+                },
+                selectFilament: function(filament) {
+                    var innerSelf = self.stepModels()[7].model();
+                    innerSelf.selectedFilament(filament);
+                    innerSelf.loadTrend();
+                },
+                loadTrend: function() {
+                    var innerSelf = self.stepModels()[7].model();
+                    var filament = innerSelf.selectedFilament();
+                    if (filament === null) {
+                        return;
+                    }
+                    self.apiClient.makeGetRequestToEndPoint("/eStepCalibrations/trend",
+                        function(data) {
+                            var meanSeries = data.buckets.map(function(bucket) {
+                                return [Date.parse(bucket.bucketStart), bucket.meanNewESteps];
+                            });
+                            var rangeSeries = data.buckets.map(function(bucket) {
+                                return [Date.parse(bucket.bucketStart), bucket.maxNewESteps, bucket.minNewESteps];
+                            });
+                            $.plot($("#calibration_eStepsTrendGraph"), [
+                                {label: "Min/Max", data: rangeSeries, lines: {show: true, lineWidth: 0, fill: 0.2}, color: "#999999"},
+                                {label: "Mean new e steps", data: meanSeries, lines: {show: true}, points: {show: true}}
+                            ], {
+                                xaxis: {mode: "time"},
+                                legend: {position: "nw"}
+                            });
+                        },
+                        self.defaultErrorHandler,
+                        {
+                            bucket: innerSelf.selectedBucket(),
+                            filamentName: filament.filamentName,
+                            filamentType: filament.filamentType
+                        });
+                },
+                backToStartPage: function() {
+                    self.parent.goToStartPage();
+                }
             })
         ]);
 
         self.firstStep = function() {
+            // updates the extruder count for the tool selection
+            self.getToolState(function(data) {});
             return self.stepModels()[0];
         }
 
         
-        self.showEStepsCalibrations = function(setCurrentStep) {
-            // load data from backend 
-            /*
-            // - for testing use dummy data
-            var dummyData = [
-                {
-                    creationDate: "2021-01-01 12:24:25",
-                    filamentName: "TestFilament1", 
-                    filamentType: "PLA", 
-                    hotendTemp: 210, 
-                    oldEsteps: 90.0, 
-                    newESteps: 91.5
+        self.showEStepsStatistics = function(setCurrentStep) {
+            self.apiClient.makeGetRequestToEndPoint("/eStepCalibrations/statistics",
+                function(data) {
+                    var statisticsStep = self.stepModels()[7];
+                    statisticsStep.model().filaments(data.filaments);
+                    statisticsStep.model().selectedFilament(null);
+                    setCurrentStep(statisticsStep);
                 },
-                {
-                    creationDate: "2021-02-01 12:24:25",
-                    filamentName: "TestFilament2", 
-                    filamentType: "PETG", 
-                    hotendTemp: 230, 
-                    oldEsteps: 91, 
-                    newESteps: 92.33
+                self.defaultErrorHandler);
+        }
+
+        self.showEStepsCalibrations = function(setCurrentStep) {
+            // load first page from backend
+            var showCalibStep = self.stepModels()[6];
+            showCalibStep.model().eStepsCalibrationView.reload(function() {
+                setCurrentStep(showCalibStep);
+            });
+        }
+    }
+
+    function PidAutotuneTool(apiClient, parent) {
+        var self = this;
+
+        self.apiClient = apiClient;
+        self.parent = parent;       // the creator of this class (e.g. CalibrationViewModel)
+
+        self.extruderCount = ko.observable(1);
+
+        self.onBeforeBinding = function() {
+            var settings = self.parent.settings.settings.plugins.calibration;
+            self.stepModels()[0].model().hotendTemperature(settings.hotendTemp());
+            self.stepModels()[0].model().bedTemperature(settings.pidAutotuneBedTemp());
+            self.stepModels()[0].model().cycles(settings.pidAutotuneCycles());
+            self.stepModels()[3].model().entriesPerPage = settings.entriesPerPageForTables();
+        };
+
+        /*
+            class State(Enum):
+                IDLE = 1
+                RUNNING = 2
+                WAITING_FOR_RESULT = 3
+                WAITING_FOR_USER_CONFIRM = 4
+        */
+        // Tool state as last reported by the backend, changes are pushed via plugin messages,
+        // polling the GET endpoint is only done as a fallback (like for the e steps calibration)
+        var FALLBACK_POLL_INTERVAL = 15000;
+        self.toolState = {};
+        self.stateHandler = null;
+        self.stateHandlerGeneration = 0;
+
+        self.getToolState = function(handleToolState) {
+            self.apiClient.makeGetRequest(function (data) {
+                // the extruder count is part of the e steps tool's state
+                self.extruderCount(data.eSteps.extruderCount);
+                self.toolState = data.pidAutotune;
+                handleToolState(data.pidAutotune);
+            });
+        };
+
+        self.onPluginMessage = function(message) {
+            if (message.tool !== "pidAutotune") {
+                return;
+            }
+            if (message.type === "stateUpdate") {
+                self.toolState = $.extend(self.toolState, message.data);
+                if (self.stateHandler !== null) {
+                    self.stateHandler(self.toolState);
+                }
+            } else if (message.type === "error" && self.stateHandler !== null) {
+                self.stopWaitingForToolState();
+                self.parent.reportError(message.message);
+            }
+        };
+
+        self.stopWaitingForToolState = function() {
+            self.stateHandlerGeneration++;
+            self.stateHandler = null;
+        };
+
+        // Calls handler(toolState) on every tool state change until it returns true
+        self.waitForToolState = function(handler) {
+            var generation = ++self.stateHandlerGeneration;
+            self.stateHandler = function(toolState) {
+                if (handler(toolState) && generation === self.stateHandlerGeneration) {
+                    self.stateHandler = null;
+                }
+            };
+
+            var poll = function() {
+                if (generation !== self.stateHandlerGeneration || self.stateHandler === null) {
+                    return;
+                }
+                self.getToolState(function(data) {
+                    if (self.stateHandler !== null) {
+                        self.stateHandler(self.toolState);
+                    }
+                    setTimeout(poll, FALLBACK_POLL_INTERVAL);
+                });
+            };
+            // initial poll to be in sync with the backend
+            poll();
+        };
+
+        self.defaultErrorHandler = function(response) {
+            self.parent.reportError(response["responseText"]);
+        }
+
+        self.formatNumber = function(value) {
+            return (value === null || value === undefined) ? "-" : value.toFixed(2);
+        };
+
+        self.stepModels = ko.observableArray([
+            new Step(0, "NewPidAutotune", "pid_newAutotuneTmpl", {
+                heaters: ko.computed(function() {
+                    var heaters = [];
+                    for (var i = 0; i < self.extruderCount(); i++) {
+                        heaters.push({name: "Hotend " + i, value: "tool" + i});
+                    }
+                    heaters.push({name: "Bed", value: "bed"});
+                    return heaters;
+                }),
+                selectedHeater: ko.observable("tool0"),
+                hotendTemperature: ko.observable(),
+                bedTemperature: ko.observable(),
+                cycles: ko.observable(),
+                targetTemperature: function() {
+                    var innerSelf = self.stepModels()[0].model();
+                    return innerSelf.selectedHeater() === "bed" ? innerSelf.bedTemperature : innerSelf.hotendTemperature;
                 },
-                {
-                    creationDate: "2021-03-01 12:24:25",
-                    filamentName: "TestFilament3", 
-                    filamentType: "ABS", 
-                    hotendTemp: 250, 
-                    oldEsteps: 92, 
-                    newESteps: 91.3
+                startPidAutotune: function() {
+                    var innerSelf = self.stepModels()[0].model();
+                    var startCmd = {
+                        "command": "startPidAutotune",
+                        "heater": innerSelf.selectedHeater(),
+                        "targetTemp": innerSelf.targetTemperature()(),
+                        "cycles": innerSelf.cycles()
+                    };
+
+                    self.apiClient.makePostRequest(startCmd, function(data) {
+                        var runningStep = self.stepModels()[1];
+                        runningStep.model().cycles([]);
+                        self.waitForToolState(function(toolState) {
+                            if (toolState["pidToolState"] == 4) {
+                                // only advance to the result when state == WAITING_FOR_USER_CONFIRM (4)
+                                var resultStep = self.stepModels()[2];
+                                resultStep.model().kp(toolState["kp"]);
+                                resultStep.model().ki(toolState["ki"]);
+                                resultStep.model().kd(toolState["kd"]);
+                                self.parent.setCurrentStep(resultStep);
+                                return true;
+                            }
+                            runningStep.model().currTemperature(toolState["currTemp"]);
+                            runningStep.model().requestedCycles(toolState["requestedCycles"]);
+                            runningStep.model().cycles(toolState["cycles"] || []);
+                            self.parent.setCurrentStep(runningStep);
+                            return false;
+                        });
+                    }, self.defaultErrorHandler);
                 },
-                {
-                    creationDate: "2021-04-01 12:24:25",
-                    filamentName: "TestFilament4", 
-                    filamentType: "TPU", 
-                    hotendTemp: 230, 
-                    oldEsteps: 90.0, 
-                    newESteps: 95
+                backToStartPage: function() {
+                    self.parent.goToStartPage();
+                }
+            }),
+            new Step(1, "PidAutotuneRunning", "pid_runningTmpl", {
+                currTemperature: ko.observable(),
+                requestedCycles: ko.observable(),
+                // cycles reported by the firmware so far, see PidAutotuneTool._onSerialMatch
+                cycles: ko.observableArray(),
+                formatNumber: self.formatNumber
+            }),
+            new Step(2, "PidAutotuneResult", "pid_resultTmpl", {
+                kp: ko.observable(),
+                ki: ko.observable(),
+                kd: ko.observable(),
+                applyPidAutotune: function() {
+                    self.apiClient.makePostRequest({"command": "applyPidAutotune"}, function(data) {
+                        self.parent.goToStartPage();
+                    }, self.defaultErrorHandler);
                 },
-                {
-                    creationDate: "2021-04-02 12:24:25",
-                    filamentName: "TestFilament5", 
-                    filamentType: "PLA", 
-                    hotendTemp: 200, 
-                    oldEsteps: 91, 
-                    newESteps: 90.5
+                discardPidAutotune: function() {
+                    self.apiClient.makePostRequest({"command": "discardPidAutotune"}, function(data) {
+                        self.parent.goToStartPage();
+                    }, self.defaultErrorHandler);
+                }
+            }),
+            // special step for the view of the latest autotunes
+            new Step(3, "ShowPidAutotunesView", "pid_showAutotunesTmpl", {
+                entriesPerPage: 20,
+                items: ko.observableArray(),
+                selected: ko.observable(null),
+                formatNumber: self.formatNumber,
+                select: function(item) {
+                    var innerSelf = self.stepModels()[3].model();
+                    innerSelf.selected(item === innerSelf.selected() ? null : item);
                 },
-                {
-                    creationDate: "2021-04-03 12:24:25",
-                    filamentName: "TestFilament6", 
-                    filamentType: "PETG", 
-                    hotendTemp: 230, 
-                    oldEsteps: 90.5, 
-                    newESteps: 93
+                backToStartPage: function() {
+                    self.parent.goToStartPage();
                 }
-            ];
-            */
-            self.apiClient.makeGetRequestToEndPoint("/eStepCalibrations", 
-                function (data) {
-                    // and call <Step>.loadData(loadedDataInDto)
-                    showCalibStep = self.stepModels()[6];
-                    showCalibStep.model().loadData(data);
-                    setCurrentStep(showCalibStep);
-                }, 
-            self.defaultErrorHandler);
-
-            /*
-            // and call <Step>.loadData(loadedDataInDto)
-            showCalibStep = self.stepModels()[6];
-            showCalibStep.model().loadData(dummyData);
-
-            return showCalibStep;
-            */
+            })
+        ]);
+
+        self.firstStep = function() {
+            // updates the extruder count for the heater selection
+            self.getToolState(function(data) {});
+            return self.stepModels()[0];
+        }
+
+        self.showPidAutotunes = function(setCurrentStep) {
+            var showStep = self.stepModels()[3];
+            self.apiClient.makeGetRequestToEndPoint("/pidAutotunes",
+                function(data) {
+                    showStep.model().items(data.items);
+                    showStep.model().selected(null);
+                    setCurrentStep(showStep);
+                },
+                self.defaultErrorHandler,
+                {limit: showStep.model().entriesPerPage});
         }
     }
 
+    // Calibration prints (temperature towers, flow cubes, retraction tests) generated by the backend
+    // into the folder "calibration" of the local files, and the results measured on them
+    function CalibrationPrintTool(apiClient, parent) {
+        var self = this;
+
+        self.apiClient = apiClient;
+        self.parent = parent;       // the creator of this class (e.g. CalibrationViewModel)
+
+        // print type -> {parameters: {name: default}, result: {name, unit, recommends}}, see /calibrationPrints/types
+        self.printTypes = ko.observable({});
+
+        self.onBeforeBinding = function() {
+            self.stepModels()[2].model().entriesPerPage = self.parent.settings.settings.plugins.calibration.entriesPerPageForTables();
+            var newPrintModel = self.stepModels()[0].model();
+            newPrintModel.selectedPrintType.subscribe(newPrintModel.resetParameters);
+        };
+
+        self.defaultErrorHandler = function(response) {
+            self.parent.reportError(response["responseText"]);
+        };
+
+        self.formatNumber = function(value) {
+            return (value === null || value === undefined) ? "-" : value.toFixed(2);
+        };
+
+        self.showPrint = function(calibrationPrint, cached) {
+            var printStep = self.stepModels()[1];
+            printStep.model().calibrationPrint(calibrationPrint);
+            printStep.model().cached(cached);
+            printStep.model().resultValue(calibrationPrint.resultValue);
+            printStep.model().resultNote(calibrationPrint.resultNote);
+            printStep.model().message("");
+            self.parent.setCurrentStep(printStep);
+        };
+
+        self.stepModels = ko.observableArray([
+            new Step(0, "NewCalibrationPrint", "prints_newPrintTmpl", {
+                printTypeNames: ko.pureComputed(function() {
+                    return Object.keys(self.printTypes()).sort();
+                }),
+                selectedPrintType: ko.observable(),
+                filamentName: ko.observable(),
+                filamentTypes: ko.observableArray(["PLA", "PETG", "ABS", "Nylon", "PC"]),
+                selectedFilamentType: ko.observable(),
+                // [{name, value}] of the selected print type, initialized with the defaults
+                parameters: ko.observableArray(),
+                resetParameters: function() {
+                    var innerSelf = self.stepModels()[0].model();
+                    var printType = self.printTypes()[innerSelf.selectedPrintType()];
+                    var parameters = [];
+                    if (printType !== undefined) {
+                        Object.keys(printType.parameters).sort().forEach(function(name) {
+                            parameters.push({name: name, value: ko.observable(printType.parameters[name])});
+                        });
+                    }
+                    innerSelf.parameters(parameters);
+                },
+                generatePrint: function() {
+                    var innerSelf = self.stepModels()[0].model();
+                    var parameters = {};
+                    innerSelf.parameters().forEach(function(parameter) {
+                        // empty values get the default of the backend (e.g. the center of the bed)
+                        if (parameter.value() !== null && parameter.value() !== "") {
+                            parameters[parameter.name] = parameter.value();
+                        }
+                    });
+                    self.apiClient.makePostRequestToEndPoint("/calibrationPrints", function(data) {
+                        self.showPrint(data.calibrationPrint, data.cached);
+                    }, self.defaultErrorHandler, {
+                        printType: innerSelf.selectedPrintType(),
+                        filamentName: innerSelf.filamentName(),
+                        filamentType: innerSelf.selectedFilamentType(),
+                        parameters: parameters
+                    });
+                },
+                backToStartPage: function() {
+                    self.parent.goToStartPage();
+                }
+            }),
+            new Step(1, "CalibrationPrint", "prints_printTmpl", {
+                calibrationPrint: ko.observable(null),
+                cached: ko.observable(false),
+                resultValue: ko.observable(),
+                resultNote: ko.observable(),
+                message: ko.observable(""),
+                // name and unit of the value measured on the print, see CalibrationGcodeGenerator.PRINT_TYPES
+                resultName: function() {
+                    var calibrationPrint = self.stepModels()[1].model().calibrationPrint();
+                    if (calibrationPrint === null || self.printTypes()[calibrationPrint.printType] === undefined) {
+                        return "";
+                    }
+                    var result = self.printTypes()[calibrationPrint.printType].result;
+                    return result.name + " (" + result.unit + ")";
+                },
+                recommendsName: function() {
+                    var calibrationPrint = self.stepModels()[1].model().calibrationPrint();
+                    if (calibrationPrint === null || self.printTypes()[calibrationPrint.printType] === undefined) {
+                        return "";
+                    }
+                    return self.printTypes()[calibrationPrint.printType].result.recommends;
+                },
+                formatNumber: self.formatNumber,
+                startPrint: function() {
+                    var innerSelf = self.stepModels()[1].model();
+                    OctoPrint.files.select("local", innerSelf.calibrationPrint().filePath, true)
+                        .done(function() {
+                            innerSelf.message("Print started, enter the result once it is finished.");
+                        })
+                        .fail(function(response) {
+                            innerSelf.message("Could not start the print: " + response.responseText);
+                        });
+                },
+                storeResult: function() {
+                    var innerSelf = self.stepModels()[1].model();
+                    self.apiClient.makePostRequestToEndPoint("/calibrationPrints/" + innerSelf.calibrationPrint().databaseId + "/result", function(data) {
+                        innerSelf.calibrationPrint(data.calibrationPrint);
+                        innerSelf.message("Result stored.");
+                    }, function(response) {
+                        innerSelf.message(response["responseText"]);
+                    }, {value: innerSelf.resultValue(), note: innerSelf.resultNote()});
+                },
+                backToStartPage: function() {
+                    self.parent.goToStartPage();
+                }
+            }),
+            // special step for the view of the latest calibration prints
+            new Step(2, "ShowCalibrationPrintsView", "prints_showPrintsTmpl", {
+                entriesPerPage: 20,
+                items: ko.observableArray(),
+                formatNumber: self.formatNumber,
+                select: function(item) {
+                    self.showPrint(item, true);
+                },
+                backToStartPage: function() {
+                    self.parent.goToStartPage();
+                }
+            })
+        ]);
+
+        self.loadPrintTypes = function(handler) {
+            self.apiClient.makeGetRequestToEndPoint("/calibrationPrints/types", function(data) {
+                self.printTypes(data.printTypes);
+                handler();
+            }, self.defaultErrorHandler);
+        };
+
+        self.newCalibrationPrint = function(setCurrentStep) {
+            self.loadPrintTypes(function() {
+                var newPrintStep = self.stepModels()[0];
+                newPrintStep.model().resetParameters();
+                setCurrentStep(newPrintStep);
+            });
+        };
+
+        self.showCalibrationPrints = function(setCurrentStep) {
+            var showStep = self.stepModels()[2];
+            self.loadPrintTypes(function() {
+                self.apiClient.makeGetRequestToEndPoint("/calibrationPrints",
+                    function(data) {
+                        showStep.model().items(data.items);
+                        setCurrentStep(showStep);
+                    },
+                    self.defaultErrorHandler,
+                    {limit: showStep.model().entriesPerPage});
+            });
+        };
+    }
+
     function CalibrationViewModel(parameters) {
         var self = this;
 
@@ -436,6 +1079,8 @@ $(function() {
         
         self.apiClient = new APIClient(PLUGIN_ID, API_BASEURL, BASEURL);
         self.eStepsCalibrationTool = new EStepsCalibrationTool(self.apiClient, self);
+        self.pidAutotuneTool = new PidAutotuneTool(self.apiClient, self);
+        self.calibrationPrintTool = new CalibrationPrintTool(self.apiClient, self);
 
         self.stepModels = ko.observableArray([
             new Step(0,  "StartPage", "calibPlugin_startPageTmpl", {
@@ -447,6 +1092,26 @@ $(function() {
                     function() {
                         //self.currentStep(self.eStepsCalibrationTool.showEStepsCalibrations());
                         self.eStepsCalibrationTool.showEStepsCalibrations(self.setCurrentStep);
+                    },
+                showEStepsStatistics:
+                    function() {
+                        self.eStepsCalibrationTool.showEStepsStatistics(self.setCurrentStep);
+                    },
+                newPidAutotune:
+                    function() {
+                        self.currentStep(self.pidAutotuneTool.firstStep());
+                    },
+                showPidAutotunes:
+                    function() {
+                        self.pidAutotuneTool.showPidAutotunes(self.setCurrentStep);
+                    },
+                newCalibrationPrint:
+                    function() {
+                        self.calibrationPrintTool.newCalibrationPrint(self.setCurrentStep);
+                    },
+                showCalibrationPrints:
+                    function() {
+                        self.calibrationPrintTool.showCalibrationPrints(self.setCurrentStep);
                     }
             }),
             new Step(1, "ErrorPage", "calibPlugin_errorPageTmpl", {
@@ -483,9 +1148,81 @@ $(function() {
         // the SettingsViewModel been properly populated.
         self.onBeforeBinding = function() {
             self.eStepsCalibrationTool.onBeforeBinding();
+            self.pidAutotuneTool.onBeforeBinding();
+            self.calibrationPrintTool.onBeforeBinding();
+        }
+
+        self.onDataUpdaterPluginMessage = function(plugin, data) {
+            if (plugin !== PLUGIN_ID) {
+                return;
+            }
+            self.eStepsCalibrationTool.onPluginMessage(data);
+            self.pidAutotuneTool.onPluginMessage(data);
         }
     }
 
+    // Settings dialog of the plugin, shows the size of the database and the state of its maintenance
+    function CalibrationSettingsViewModel(parameters) {
+        var self = this;
+
+        self.settings = parameters[0];
+        self.apiClient = new APIClient("calibration", API_BASEURL, BASEURL);
+
+        self.databaseStats = ko.observable(null);
+        self.maintenanceMessage = ko.observable("");
+
+        self.fileSizeText = ko.pureComputed(function() {
+            var stats = self.databaseStats();
+            if (stats === null) {
+                return "";
+            }
+            return (stats.fileSizeBytes / (1024 * 1024)).toFixed(2) + " MiB (" + stats.freePages + " of " + stats.pageCount + " pages free)";
+        });
+
+        self.lastMaintenanceText = ko.pureComputed(function() {
+            var stats = self.databaseStats();
+            if (stats === null) {
+                return "";
+            }
+            if (stats.maintenance.running) {
+                return "running ...";
+            }
+            var lastRun = stats.maintenance.lastRun;
+            if (lastRun === null) {
+                return "not run since the start of OctoPrint";
+            }
+            return lastRun.finished + (lastRun.completed ? "" : " (interrupted)") + ": " + lastRun.rolledUpSessions + " sessions rolled up";
+        });
+
+        self.refreshDatabaseStats = function() {
+            self.apiClient.makeGetRequestToEndPoint("/database/stats", function(data) {
+                self.databaseStats(data);
+            }, function(response) {
+                self.maintenanceMessage(response["responseText"]);
+            });
+        };
+
+        self.runMaintenance = function() {
+            self.apiClient.makePostRequestToEndPoint("/database/maintenance", function(data) {
+                self.maintenanceMessage("Maintenance started.");
+                self.refreshDatabaseStats();
+            }, function(response) {
+                self.maintenanceMessage(response["responseText"]);
+            });
+        };
+
+        self.onSettingsShown = function() {
+            self.maintenanceMessage("");
+            self.refreshDatabaseStats();
+        };
+    }
+
+    OCTOPRINT_VIEWMODELS.push({
+        construct: CalibrationSettingsViewModel,
+        dependencies: [ "settingsViewModel" ],
+        elements: [ "#settings_plugin_calibration" ]
+    });
+
     /* view model class, parameters for constructor, container to bind to
      * Please see http://docs.octoprint.org/en/master/plugins/viewmodels.html#registering-custom-viewmodels for more details
      * and a full list of the available options.
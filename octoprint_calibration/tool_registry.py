@@ -0,0 +1,100 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import logging
+import threading
+
+# All calibration tools, dispatches the API commands and routes received lines and temperatures to the
+# tools subscribed to them. A tool has a unique NAME, START_COMMANDS (procedures which must not run at the
+# same time as one of another tool) and the methods of EStepsCalibrationTool used here.
+class ToolRegistry(object):
+    def __init__(self, parentLogger):
+        self._logger = logging.getLogger(parentLogger.name + "." + self.__class__.__name__)
+        self._lock = threading.Lock()
+        # name -> tool, in the order of registration
+        self._tools = {}
+        # API command -> tool
+        self._commandTable = {}
+        self._apiCommands = {}
+        # tools subscribed to received lines and temperatures
+        self._lineSubscribers = set()
+        self._temperatureSubscribers = set()
+        # handlers of the subscribed tools, read on the comm thread for every received line (therefore
+        # immutable tuples, replaced as a whole on subscription changes)
+        self.lineHandlers = ()
+        self.temperatureHandlers = ()
+
+    def register(self, tool):
+        if tool.NAME in self._tools:
+            raise ValueError("Tool '%s' is already registered." % tool.NAME)
+        apiCommands = tool.getApiCommands()
+        for command in apiCommands:
+            if command in self._commandTable:
+                raise ValueError("API command '%s' of tool '%s' is already handled by tool '%s'." % \
+                    (command, tool.NAME, self._commandTable[command].NAME))
+        self._tools[tool.NAME] = tool
+        for command in apiCommands:
+            self._commandTable[command] = tool
+        self._apiCommands.update(apiCommands)
+        tool.setSubscriptionListener(self._onSubscriptionChanged)
+
+    # API commands of all tools with their mandatory parameters (SimpleApiPlugin.get_api_commands)
+    def getApiCommands(self):
+        return self._apiCommands
+
+    # Returns (success, reason) like the handleApiCommand of the tools
+    def handleApiCommand(self, command, data):
+        tool = self._commandTable.get(command)
+        if tool is None:
+            reason = "Unknown command '%s'." % command
+            self._logger.error(reason)
+            return False, reason
+        if command in tool.START_COMMANDS:
+            # e.g. the firmware processes no other commands during a PID autotune
+            busyTool = next((other for other in self._tools.values() if other is not tool and other.isBusy()), None)
+            if busyTool is not None:
+                reason = "Cannot start '%s' while tool '%s' is busy." % (command, busyTool.NAME)
+                self._logger.error(reason)
+                return False, reason
+        return tool.handleApiCommand(command, data)
+
+    # True while a procedure of any tool is running
+    def isBusy(self):
+        return any(tool.isBusy() for tool in self._tools.values())
+
+    # dict tool name -> state of the tool
+    def getToolStates(self):
+        return {name: tool.getToolState() for name, tool in self._tools.items()}
+
+    def handlePrinterDisconnected(self):
+        for tool in self._tools.values():
+            tool.handlePrinterDisconnected()
+
+    def shutdown(self):
+        for tool in self._tools.values():
+            tool.shutdown()
+
+    ##################
+    ### Internal stuff
+
+    # Called by the tools (on their executors) whenever they start or stop waiting for received lines or temperatures
+    def _onSubscriptionChanged(self, tool, lines, temperatures):
+        with self._lock:
+            changed = self._updateSubscribers(self._lineSubscribers, tool, lines)
+            changed = self._updateSubscribers(self._temperatureSubscribers, tool, temperatures) or changed
+            if not changed:
+                return
+            # in the order of registration, so the tools get the lines in a deterministic order
+            self.lineHandlers = tuple(other.handleGcodeReceived for other in self._tools.values() if other in self._lineSubscribers)
+            self.temperatureHandlers = tuple(other.handleTemperaturesReceived for other in self._tools.values() \
+                if other in self._temperatureSubscribers)
+        self._logger.debug("Tool '%s' subscribed to lines: %s, temperatures: %s", tool.NAME, lines, temperatures)
+
+    # pylint: disable=no-self-use
+    def _updateSubscribers(self, subscribers, tool, subscribed):
+        if subscribed == (tool in subscribers):
+            return False
+        if subscribed:
+            subscribers.add(tool)
+        else:
+            subscribers.discard(tool)
+        return True
@@ -0,0 +1,118 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import logging
+import unittest
+from unittest import mock
+
+from octoprint_calibration.calib_tools import PidAutotuneRun, PidAutotuneTool, _meanConfidenceInterval
+
+# Marlin's output of "M303 E0 S200 C3"
+MARLIN_AUTOTUNE = """PID Autotune start
+ bias: 92 d: 92 min: 196.56 max: 203.75
+ bias: 105 d: 105 min: 196.88 max: 203.91 Ku: 38.05 Tu: 19.42
+ Classic PID
+ Kp: 22.83 Ki: 2.35 Kd: 55.42
+ bias: 104 d: 104 min: 196.94 max: 203.75 Ku: 38.91 Tu: 19.41
+ Classic PID
+ Kp: 23.35 Ki: 2.41 Kd: 56.64
+PID Autotune finished! Put the last Kp, Ki and Kd constants from below into Configuration.h
+#define DEFAULT_Kp 23.35
+#define DEFAULT_Ki 2.41
+#define DEFAULT_Kd 56.64
+ok"""
+
+# The lines are parsed on the calling thread instead of the executor
+class PidAutotuneParserTest(unittest.TestCase):
+    def setUp(self):
+        self.plugin = mock.Mock()
+        self.databaseManager = mock.Mock()
+        self.printer = mock.Mock()
+        self.tool = PidAutotuneTool(logging.getLogger("test"), clock=lambda: 100.0)
+        self.tool._calibPluginInstance = self.plugin
+        self.tool._databaseManager = self.databaseManager
+        self.tool._printer = self.printer
+        self.tool._run = PidAutotuneRun("session", "tool0", 200, 3, 40.0)
+        self.tool._switchState(PidAutotuneTool.State.RUNNING)
+
+    def _receive(self, lines):
+        for line in lines.splitlines():
+            matcher = self.tool.serialMatcher
+            if matcher is None:
+                continue
+            match = matcher.search(line)
+            if match is not None:
+                self.tool._onSerialMatch(match)
+
+    def _getPushedErrors(self):
+        return [call.args[0]["message"] for call in self.plugin.sendPluginMessage.call_args_list if call.args[0]["type"] == "error"]
+
+    def testMarlinAutotune(self):
+        self._receive(MARLIN_AUTOTUNE)
+
+        self.assertEqual(self.tool._state, PidAutotuneTool.State.WAITING_FOR_USER_CONFIRM)
+        self.assertIsNone(self.tool.serialMatcher)
+        run = self.tool._run
+        self.assertEqual((run.kp, run.ki, run.kd), (23.35, 2.41, 56.64))
+        self.assertEqual(run.durationSeconds, 60.0)
+        self.assertEqual(len(run.cycles), 3)
+        self.assertEqual(run.cycles[0], dict(bias=92, d=92, minTemperature=196.56, maxTemperature=203.75, ku=None, tu=None, kp=None, ki=None, kd=None))
+        self.assertEqual(run.cycles[2], dict(bias=104, d=104, minTemperature=196.94, maxTemperature=203.75, ku=38.91, tu=19.41, kp=23.35, ki=2.41, kd=56.64))
+
+        pidAutotuneModel, cycleRows = self.databaseManager.insertPidAutotune.call_args.args
+        self.assertEqual((pidAutotuneModel.heater, pidAutotuneModel.ku, pidAutotuneModel.tu), ("tool0", 38.91, 19.41))
+        self.assertEqual([row["cycleIndex"] for row in cycleRows], [0, 1, 2])
+        self.assertEqual(self._getPushedErrors(), [])
+
+    def testFinalGainsOverrideTheLastCycle(self):
+        self._receive(MARLIN_AUTOTUNE.replace("#define DEFAULT_Kd 56.64", "#define DEFAULT_Kd 60.00"))
+        self.assertEqual(self.tool._run.kd, 60.0)
+
+    def testBedGainsWithoutDefineLines(self):
+        self.tool._run.heater = "bed"
+        self._receive("\n".join(line for line in MARLIN_AUTOTUNE.splitlines() if not line.startswith("#define")))
+        self.assertEqual(self.tool._state, PidAutotuneTool.State.WAITING_FOR_USER_CONFIRM)
+        self.assertEqual((self.tool._run.kp, self.tool._run.ki, self.tool._run.kd), (23.35, 2.41, 56.64))
+
+    def testBedDefineLines(self):
+        self._receive("PID Autotune finished!\n#define DEFAULT_bedKp 180.3\n#define DEFAULT_bedKi 32.1\n#define DEFAULT_bedKd 675.0")
+        self.assertEqual((self.tool._run.kp, self.tool._run.ki, self.tool._run.kd), (180.3, 32.1, 675.0))
+
+    def testOkWhileRunningIsIgnored(self):
+        self._receive(" bias: 92 d: 92 min: 196.56 max: 203.75\nok\nok T:200.1 /200.0 B:60.0 /60.0")
+        self.assertEqual(self.tool._state, PidAutotuneTool.State.RUNNING)
+        self.assertEqual(len(self.tool._run.cycles), 1)
+
+    def testFailure(self):
+        self._receive(" bias: 92 d: 92 min: 196.56 max: 203.75\nPID Autotune failed! Temperature too high")
+        self.assertEqual(self.tool._state, PidAutotuneTool.State.IDLE)
+        self.printer.set_temperature.assert_called_once_with("tool0", 0)
+        self.assertEqual(self._getPushedErrors(), ["PID autotune of tool0 failed: Temperature too high"])
+        self.databaseManager.insertPidAutotune.assert_not_called()
+
+    def testFinishedWithoutGainsFails(self):
+        self._receive("PID Autotune finished!\nok")
+        self.assertEqual(self.tool._state, PidAutotuneTool.State.IDLE)
+        self.assertEqual(self._getPushedErrors(), ["PID autotune of tool0 finished without reporting gains."])
+
+
+class MeanConfidenceIntervalTest(unittest.TestCase):
+    def testSingleValue(self):
+        self.assertEqual(_meanConfidenceInterval([93.5]), (93.5, None))
+
+    def testEqualValues(self):
+        self.assertEqual(_meanConfidenceInterval([93.5, 93.5, 93.5]), (93.5, 0.0))
+
+    def testStudentT(self):
+        # standard deviation 1, t quantile of 2 degrees of freedom
+        mean, halfWidth = _meanConfidenceInterval([92.0, 93.0, 94.0])
+        self.assertAlmostEqual(mean, 93.0)
+        self.assertAlmostEqual(halfWidth, 4.303 / 3 ** 0.5)
+
+    def testNormalQuantileForManyValues(self):
+        mean, halfWidth = _meanConfidenceInterval([92.0, 94.0] * 10)
+        self.assertAlmostEqual(mean, 93.0)
+        self.assertAlmostEqual(halfWidth, 1.96 * (20 / 19.0) ** 0.5 / 20 ** 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import base64
+import datetime
+import decimal
+import logging
+import shutil
+import tempfile
+import unittest
+
+import octoprint_calibration.models as models
+from octoprint_calibration.database_manager import DatabaseManager
+
+class LoadEStepCalibrationsPageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.databaseManager = DatabaseManager(logging.getLogger("test"))
+        self.databaseManager.initialize(self.directory, {})
+
+    def tearDown(self):
+        self.databaseManager.shutdown()
+        shutil.rmtree(self.directory)
+
+    # rowCount calibrations one hour apart, the new e steps only take three values (ties when sorted by them)
+    def _insertCalibrations(self, rowCount):
+        rows = [dict(
+            created=datetime.datetime(2024, 1, 1) + datetime.timedelta(hours=i),
+            filamentName="Filament %d" % (i % 2),
+            filamentType="PLA" if i % 3 else "PETG",
+            hotendTemperature=decimal.Decimal(210),
+            oldESteps=decimal.Decimal("93.00"),
+            newESteps=decimal.Decimal("94.50") + i % 3,
+            toolIndex=0
+        ) for i in range(rowCount)]
+        self.assertEqual(self.databaseManager.importEStepCalibrations(rows).result(), (rowCount, 0))
+
+    def _loadAllPages(self, limit, **kwargs):
+        items = []
+        after = None
+        while True:
+            page, after = self.databaseManager.loadEStepCalibrationsPage(limit, after=after, **kwargs)
+            self.assertLessEqual(len(page), limit)
+            items.extend(page)
+            if after is None:
+                return items
+
+    def testCursorRoundTrip(self):
+        model = models.EStepsCalibrationModel
+        for sortField, sortValue in (
+                (model.created, datetime.datetime(2024, 5, 17, 13, 45, 30, 123456)),
+                (model.newESteps, decimal.Decimal("93.12")),
+                (model.filamentName, "PLA, \"Grün\""),
+                (model.toolIndex, 2)):
+            cursor = self.databaseManager._encodeCursor(sortValue, 42)
+            self.assertEqual(self.databaseManager._decodeCursor(cursor, sortField), (sortValue, 42))
+
+    def testInvalidCursorIsRejected(self):
+        model = models.EStepsCalibrationModel
+        for cursor in ("not a cursor", base64.urlsafe_b64encode(b"[1]").decode("ascii"), \
+                self.databaseManager._encodeCursor("yesterday", 1)):
+            with self.assertRaises(ValueError):
+                self.databaseManager._decodeCursor(cursor, model.created)
+        with self.assertRaises(ValueError):
+            self.databaseManager.loadEStepCalibrationsPage(10, after="not a cursor")
+
+    def testInvalidSortColumnIsRejected(self):
+        with self.assertRaises(ValueError):
+            self.databaseManager.loadEStepCalibrationsPage(10, sortBy="databaseId")
+
+    def testPagesContainEveryRowOnceInOrder(self):
+        self._insertCalibrations(25)
+        for sortDescending in (True, False):
+            items = self._loadAllPages(4, sortBy="newESteps", sortDescending=sortDescending)
+            # rows with the same e steps are ordered by their id
+            keys = [(item["newESteps"], item["databaseId"]) for item in items]
+            self.assertEqual(keys, sorted(keys, reverse=sortDescending))
+            self.assertEqual(len(set(item["databaseId"] for item in items)), 25)
+
+    def testLastPageHasNoCursor(self):
+        self._insertCalibrations(6)
+        page, after = self.databaseManager.loadEStepCalibrationsPage(3)
+        self.assertIsNotNone(after)
+        page, after = self.databaseManager.loadEStepCalibrationsPage(3, after=after)
+        self.assertEqual(len(page), 3)
+        self.assertIsNone(after)
+
+    def testFiltersApplyToAllPages(self):
+        self._insertCalibrations(30)
+        createdFrom = datetime.datetime(2024, 1, 1, 5)
+        createdTo = datetime.datetime(2024, 1, 1, 20)
+        items = self._loadAllPages(2, filamentName="Filament 1", filamentType="PLA", createdFrom=createdFrom, \
+            createdTo=createdTo, sortBy="created", sortDescending=False)
+
+        expected = [i for i in range(30) if i % 2 == 1 and i % 3 and 5 <= i <= 20]
+        self.assertEqual([item["created"] for item in items], \
+            [datetime.datetime(2024, 1, 1) + datetime.timedelta(hours=i) for i in expected])
+        self.assertTrue(all(item["filamentName"] == "Filament 1" and item["filamentType"] == "PLA" for item in items))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import logging
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from octoprint_calibration.gcode_generator import CalibrationGcodeGenerator, GcodeStreamWrapper
+
+PRINTER_VOLUME = dict(width=220, depth=220, height=250, origin="lowerleft")
+
+class CalibrationGcodeGeneratorTest(unittest.TestCase):
+    def setUp(self):
+        self.generator = CalibrationGcodeGenerator(logging.getLogger("test"), mock.Mock())
+
+    def testDefaults(self):
+        for printType, spec in self.generator.getPrintTypes().items():
+            parameters = self.generator.normalizeParameters(printType, {}, PRINTER_VOLUME)
+            self.assertEqual(sorted(parameters), sorted(spec["parameters"]))
+            self.assertEqual((parameters["bedCenterX"], parameters["bedCenterY"]), (110.0, 110.0))
+
+    def testValuesAreConverted(self):
+        parameters = self.generator.normalizeParameters("temperatureTower", dict(startTemperature="220", layerHeight="0.3", walls=3.0), PRINTER_VOLUME)
+        self.assertEqual((parameters["startTemperature"], parameters["layerHeight"], parameters["walls"]), (220, 0.3, 3))
+        self.assertIsInstance(parameters["walls"], int)
+
+    def testInvalidParametersAreRejected(self):
+        for printType, parameters in (
+                ("benchy", {}),
+                ("flowCube", dict(startTemperature=220)),
+                ("flowCube", dict(hotendTemperature="hot")),
+                ("flowCube", dict(hotendTemperature=210.5)),
+                ("flowCube", dict(extrusionMultiplier=2.0)),
+                ("flowCube", dict(layerHeight=float("nan"))),
+                ("temperatureTower", dict(size=5.0, walls=10)),
+                ("retractionTest", dict(startRetraction=4.0, endRetraction=1.0)),
+                ("retractionTest", dict(size=30.0, towerDistance=20.0))):
+            with self.assertRaises(ValueError):
+                self.generator.normalizeParameters(printType, parameters, PRINTER_VOLUME)
+
+    def testPrintMustFitOnTheBed(self):
+        # the prime line is 60 mm long
+        self.generator.normalizeParameters("flowCube", dict(bedCenterX=30.0, bedCenterY=20.0), PRINTER_VOLUME)
+        for parameters in (dict(bedCenterX=29.0), dict(bedCenterX=191.0), dict(bedCenterY=5.0), dict(bedCenterY=210.0)):
+            with self.assertRaises(ValueError):
+                self.generator.normalizeParameters("flowCube", parameters, PRINTER_VOLUME)
+        with self.assertRaises(ValueError):
+            self.generator.normalizeParameters("flowCube", dict(height=60.0), dict(PRINTER_VOLUME, height=50))
+        # 9 segments of 8 mm
+        with self.assertRaises(ValueError):
+            self.generator.normalizeParameters("temperatureTower", {}, dict(PRINTER_VOLUME, height=70))
+
+    def testCenterOrigin(self):
+        volume = dict(width=200, depth=200, height=200, origin="center")
+        parameters = self.generator.normalizeParameters("flowCube", {}, volume)
+        self.assertEqual((parameters["bedCenterX"], parameters["bedCenterY"]), (0.0, 0.0))
+        with self.assertRaises(ValueError):
+            self.generator.normalizeParameters("flowCube", dict(bedCenterX=80.0), volume)
+
+    def testParametersHash(self):
+        parameters = self.generator.normalizeParameters("flowCube", {}, PRINTER_VOLUME)
+        same = self.generator.normalizeParameters("flowCube", dict(hotendTemperature="210"), PRINTER_VOLUME)
+        other = self.generator.normalizeParameters("flowCube", dict(hotendTemperature=215), PRINTER_VOLUME)
+        self.assertEqual(self.generator.getParametersHash("flowCube", parameters), self.generator.getParametersHash("flowCube", same))
+        self.assertNotEqual(self.generator.getParametersHash("flowCube", parameters), self.generator.getParametersHash("flowCube", other))
+
+    def testTemperatureTower(self):
+        parameters = self.generator.normalizeParameters("temperatureTower", dict(startTemperature=230, endTemperature=215, segmentHeight=2.0), PRINTER_VOLUME)
+        lines = list(self.generator.generateLines("temperatureTower", parameters))
+        self.assertIn("M109 T0 S230", lines)
+        self.assertEqual([line for line in lines if line.startswith("; segment")], \
+            ["; segment 0: 230 C", "; segment 1: 225 C", "; segment 2: 220 C", "; segment 3: 215 C"])
+        self.assertEqual([line for line in lines if line.startswith("M104")], ["M104 T0 S230", "M104 T0 S225", "M104 T0 S220", "M104 T0 S215", "M104 T0 S0"])
+        # 10 layers per segment
+        self.assertEqual(len([line for line in lines if line.startswith("; layer")]), 40)
+        self.assertIn("G0 Z8.000 F600", lines)
+        self._assertWithinBed(lines, PRINTER_VOLUME)
+
+    def testFlowCubeExtrusion(self):
+        parameters = self.generator.normalizeParameters("flowCube", dict(extrusionMultiplier=1.1, size=20.0), PRINTER_VOLUME)
+        lines = list(self.generator.generateLines("flowCube", parameters))
+        # a side of the single wall is size - lineWidth long
+        ePerMm = 0.45 * 0.2 / (3.141592653589793 * 0.875 ** 2) * 1.1
+        side = "G1 X119.775 Y100.225 E%.5f F1200" % (19.55 * ePerMm)
+        self.assertIn(side, lines)
+        self._assertWithinBed(lines, PRINTER_VOLUME)
+
+    def testRetractionTest(self):
+        parameters = self.generator.normalizeParameters("retractionTest", dict(startRetraction=0.5, endRetraction=2.0, retractionStep=0.5), PRINTER_VOLUME)
+        lines = list(self.generator.generateLines("retractionTest", parameters))
+        self.assertEqual([line for line in lines if line.startswith("; segment")], \
+            ["; segment 0: retraction 0.500 mm", "; segment 1: retraction 1.000 mm", "; segment 2: retraction 1.500 mm", "; segment 3: retraction 2.000 mm"])
+        # every retraction is undone before the next tower is printed
+        retractions = [float(re.match(r"G1 E(-?[\d.]+) F2100", line).group(1)) for line in lines if re.match(r"G1 E-?[\d.]+ F2100$", line)]
+        self.assertAlmostEqual(sum(retractions[:-1]), -2.0)
+        self._assertWithinBed(lines, PRINTER_VOLUME)
+
+    def testEvaluateResult(self):
+        tower = self.generator.normalizeParameters("temperatureTower", {}, PRINTER_VOLUME)
+        self.assertEqual(self.generator.evaluateResult("temperatureTower", tower, 205), 205)
+        cube = self.generator.normalizeParameters("flowCube", dict(extrusionMultiplier=1.0), PRINTER_VOLUME)
+        self.assertEqual(self.generator.evaluateResult("flowCube", cube, 0.5), 0.9)
+        retraction = self.generator.normalizeParameters("retractionTest", {}, PRINTER_VOLUME)
+        self.assertEqual(self.generator.evaluateResult("retractionTest", retraction, 1.5), 1.5)
+        for printType, parameters, value in (("temperatureTower", tower, 240), ("flowCube", cube, 0.0), ("flowCube", cube, float("nan")), \
+                ("retractionTest", retraction, 4.5)):
+            with self.assertRaises(ValueError):
+                self.generator.evaluateResult(printType, parameters, value)
+
+    def _assertWithinBed(self, lines, printerVolume):
+        for line in lines:
+            for axis, size in (("X", printerVolume["width"]), ("Y", printerVolume["depth"])):
+                match = re.search(r"\b%s(-?[\d.]+)" % axis, line)
+                if match is not None and not line.startswith(";"):
+                    self.assertTrue(0 <= float(match.group(1)) <= size, line)
+
+
+class GcodeStreamWrapperTest(unittest.TestCase):
+    def setUp(self):
+        self.lines = ["G1 X%d Y%d E0.12345" % (i, i) for i in range(20000)]
+        self.expected = ("\n".join(self.lines) + "\n").encode("utf-8")
+
+    def testChunks(self):
+        chunks = list(GcodeStreamWrapper("test.gcode", iter(self.lines))._chunks())
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) < GcodeStreamWrapper.CHUNK_SIZE + 100 for chunk in chunks))
+        self.assertEqual(b"".join(chunks), self.expected)
+
+    def testStream(self):
+        self.assertEqual(GcodeStreamWrapper("test.gcode", iter(self.lines)).stream().read(), self.expected)
+
+    def testSave(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "test.gcode")
+            GcodeStreamWrapper("test.gcode", iter(self.lines)).save(path)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), self.expected)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    unittest.main()
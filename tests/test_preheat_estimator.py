@@ -0,0 +1,88 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import math
+import unittest
+
+from octoprint_calibration.preheat_estimator import PreheatEstimator
+
+# first order heating curve from 20 degrees towards settleTemperature with the rate constant k (1/s)
+def firstOrderTemperature(sampledAt, settleTemperature, k):
+    return settleTemperature - (settleTemperature - 20.0) * math.exp(-k * sampledAt)
+
+class PreheatEstimatorTest(unittest.TestCase):
+    def setUp(self):
+        self.estimator = PreheatEstimator()
+
+    def _addFirstOrderSamples(self, until, settleTemperature, k, interval=1.0):
+        sampledAt = 0.0
+        while sampledAt <= until:
+            self.estimator.addSample(sampledAt, firstOrderTemperature(sampledAt, settleTemperature, k))
+            sampledAt += interval
+
+    def testNoSamples(self):
+        self.assertEqual(self.estimator.estimate(210.0, 2.0), dict(etaSeconds=None, rate=None, settleTemperature=None, stable=False))
+
+    def testFirstOrderFit(self):
+        self._addFirstOrderSamples(30.0, 215.0, 0.05)
+        result = self.estimator.estimate(210.0, 2.0)
+        self.assertAlmostEqual(result["settleTemperature"], 215.0, delta=0.5)
+        # time the exact curve needs from 30 s to 208 degrees
+        expected = -math.log((215.0 - 208.0) / (215.0 - 20.0)) / 0.05 - 30.0
+        self.assertAlmostEqual(result["etaSeconds"], expected, delta=1.0)
+        self.assertGreater(result["rate"], 0)
+        self.assertFalse(result["stable"])
+
+    def testSettlingBelowTargetHasNoEta(self):
+        # too weak heater, the hotend settles at 190 degrees
+        self._addFirstOrderSamples(30.0, 190.0, 0.05)
+        result = self.estimator.estimate(210.0, 2.0)
+        self.assertAlmostEqual(result["settleTemperature"], 190.0, delta=0.5)
+        self.assertIsNone(result["etaSeconds"])
+
+    def testLinearHeatingIsExtrapolated(self):
+        for i in range(20):
+            self.estimator.addSample(float(i), 100.0 + 2.0 * i)
+        result = self.estimator.estimate(210.0, 2.0)
+        self.assertIsNone(result["settleTemperature"])
+        self.assertAlmostEqual(result["rate"], 2.0)
+        # from 138 degrees at 19 s to 208 degrees
+        self.assertAlmostEqual(result["etaSeconds"], 35.0)
+
+    def testCoolingDown(self):
+        for i in range(20):
+            self.estimator.addSample(float(i), 250.0 - i)
+        self.assertAlmostEqual(self.estimator.estimate(210.0, 2.0)["etaSeconds"], 19.0)
+
+    def testStable(self):
+        for i in range(10):
+            self.estimator.addSample(i * 0.5, 210.0 + (0.3 if i % 2 else -0.3))
+        result = self.estimator.estimate(210.0, 2.0)
+        self.assertTrue(result["stable"])
+        self.assertEqual(result["etaSeconds"], 0.0)
+
+    def testOvershootIsNotStable(self):
+        for i, temperature in enumerate((209.0, 211.0, 213.0, 212.5, 211.0, 210.0)):
+            self.estimator.addSample(float(i), temperature)
+        self.assertFalse(self.estimator.isStable(210.0, 2.0))
+
+    def testTooShortSpanIsNotStable(self):
+        self.estimator.addSample(0.0, 210.0)
+        self.estimator.addSample(1.0, 210.0)
+        self.assertFalse(self.estimator.isStable(210.0, 2.0))
+
+    def testOutOfOrderSamplesAreIgnored(self):
+        self.estimator.addSample(10.0, 100.0)
+        self.estimator.addSample(9.0, 300.0)
+        self.estimator.addSample(10.0, 300.0)
+        self.estimator.addSample(11.0, 102.0)
+        self.assertAlmostEqual(self.estimator.currentRate(), 2.0)
+
+    def testOldSamplesAreDropped(self):
+        for i in range(100):
+            self.estimator.addSample(float(i), 20.0 + i)
+        self.estimator.addSample(200.0, 210.0)
+        self.assertIsNone(self.estimator.currentRate())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import datetime
+import logging
+import unittest
+
+import peewee
+
+import octoprint_calibration.models as models
+from octoprint_calibration.schema_migrations import SchemaMigrator
+
+# e steps calibration table of the first release, before the schema was versioned
+BASELINE_TABLE = 'CREATE TABLE "calib_estepscalibrationmodel" ("databaseId" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, ' \
+    '"filamentName" VARCHAR(255) NOT NULL, "filamentType" VARCHAR(255) NOT NULL, "hotendTemperature" DECIMAL(10, 5) NOT NULL, ' \
+    '"oldESteps" DECIMAL(10, 5) NOT NULL, "newESteps" DECIMAL(10, 5) NOT NULL)'
+
+class SchemaMigratorTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("test")
+        self.database = peewee.SqliteDatabase(":memory:")
+        self.database.bind(models.MODELS)
+        self.database.connect()
+
+    def tearDown(self):
+        self.database.close()
+
+    def _createBaselineDatabase(self, rowCount=50):
+        self.database.execute_sql(BASELINE_TABLE)
+        for i in range(rowCount):
+            self.database.execute_sql('INSERT INTO "calib_estepscalibrationmodel" ("created", "filamentName", "filamentType", '
+                '"hotendTemperature", "oldESteps", "newESteps") VALUES (?, ?, ?, ?, ?, ?)',
+                (datetime.datetime(2021, 1, 1) + datetime.timedelta(hours=i), "Filament %d" % (i % 3), "PLA", 210, 93.0, 93.0 + i % 5))
+
+    def _integrityCheck(self):
+        return [row[0] for row in self.database.execute_sql("PRAGMA integrity_check").fetchall()]
+
+    def _sqlOfSchema(self):
+        return sorted(row[0] for row in self.database.execute_sql("SELECT name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'").fetchall())
+
+    def testBaselineDatabaseIsUpgradedIntact(self):
+        self._createBaselineDatabase()
+
+        version = SchemaMigrator(self.logger, self.database).migrate()
+
+        self.assertEqual(version, SchemaMigrator.LATEST_VERSION)
+        self.assertEqual(self._integrityCheck(), ["ok"])
+        model = models.EStepsCalibrationModel
+        self.assertEqual(model.select().where(model.sessionId.is_null()).count(), 50)
+        self.assertEqual(model.update(sessionId="session").where(model.databaseId == 1).execute(), 1)
+        self.assertEqual(model.select().where(model.sessionId == "session").count(), 1)
+        self.assertEqual(model.select().where(model.toolIndex == 0).count(), 50)
+        self.assertEqual(models.EStepsFilamentSummaryModel.select().count(), 3)
+        self.assertEqual(self._integrityCheck(), ["ok"])
+
+    def testNewDatabaseMatchesModels(self):
+        SchemaMigrator(self.logger, self.database).migrate()
+        migrated = self._sqlOfSchema()
+        columns = {model._meta.table_name: [column.name for column in self.database.get_columns(model._meta.table_name)] for model in models.MODELS}
+
+        modelDatabase = peewee.SqliteDatabase(":memory:")
+        modelDatabase.bind(models.MODELS)
+        modelDatabase.create_tables(models.MODELS)
+        expected = sorted(row[0] for row in modelDatabase.execute_sql("SELECT name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'").fetchall())
+        self.assertEqual(migrated, expected)
+        for model in models.MODELS:
+            self.assertEqual(columns[model._meta.table_name], [column.name for column in modelDatabase.get_columns(model._meta.table_name)])
+        modelDatabase.close()
+        self.database.bind(models.MODELS)
+
+    def testMigrationIsIdempotent(self):
+        self._createBaselineDatabase()
+        migrator = SchemaMigrator(self.logger, self.database)
+        migrator.migrate()
+        self.assertEqual(migrator.migrate(), SchemaMigrator.LATEST_VERSION)
+        self.assertEqual(models.SchemaVersionModel.select().count(), SchemaMigrator.LATEST_VERSION)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+# coding=utf-8
+# pylint: disable=useless-object-inheritance,invalid-name,missing-function-docstring,missing-class-docstring,missing-module-docstring,line-too-long
+import math
+import unittest
+
+from octoprint_calibration.session_trace import SessionTraceRecorder, decodeEvents, decodeSamples, encodeSamples, lttbIndices
+
+class SessionTraceCodecTest(unittest.TestCase):
+    def testSamplesRoundTrip(self):
+        recorder = SessionTraceRecorder(100.0)
+        for i in range(300):
+            # heating curve with a falling temperature at the end, so the deltas are negative as well
+            actual = 210.0 - 190.0 * math.exp(-i / 40.0) - (i - 250) * 0.5 * (i > 250)
+            recorder.addSample(100.0 + i * 2.0, round(actual, 2), 210.0, i % 128 if i % 2 else None)
+        samplesBlob, _ = recorder.encode()
+
+        decoded = decodeSamples(samplesBlob)
+        self.assertEqual(sorted(decoded), sorted(SessionTraceRecorder.CHANNELS))
+        self.assertEqual(len(decoded["time"]), 300)
+        self.assertEqual(decoded["time"][:3], [0.0, 2.0, 4.0])
+        self.assertAlmostEqual(decoded["actual"][0], 20.0)
+        self.assertAlmostEqual(decoded["actual"][299], round(210.0 - 190.0 * math.exp(-299 / 40.0) - 24.5, 2))
+        self.assertEqual(set(decoded["target"]), {210.0})
+        self.assertEqual(decoded["pwm"][:4], [SessionTraceRecorder.UNKNOWN_PWM, 1.0, SessionTraceRecorder.UNKNOWN_PWM, 3.0])
+
+    def testEmptySamples(self):
+        self.assertEqual(decodeSamples(encodeSamples([])), {name: [] for name in SessionTraceRecorder.CHANNELS})
+
+    def testDeltaEncodingCompresses(self):
+        recorder = SessionTraceRecorder(0.0)
+        for i in range(600):
+            recorder.addSample(i * 2.0, 210.0 + (i % 5) * 0.01, 210.0, 64)
+        samplesBlob, _ = recorder.encode()
+        # 4 channels of 32 bit integers would take 9600 bytes uncompressed
+        self.assertLess(len(samplesBlob), 500)
+
+    def testEventsRoundTrip(self):
+        recorder = SessionTraceRecorder(10.0)
+        recorder.addEvent(10.0, "state WAITING_FOR_TEMP")
+        recorder.addEvent(12.3456, "sent M83, G1 E100 F50")
+        _, eventsBlob = recorder.encode()
+        self.assertEqual(decodeEvents(eventsBlob), [[0.0, "state WAITING_FOR_TEMP"], [2.346, "sent M83, G1 E100 F50"]])
+
+    def testLimits(self):
+        recorder = SessionTraceRecorder(0.0)
+        for i in range(SessionTraceRecorder.MAX_SAMPLES + 5):
+            recorder.addSample(float(i), 20.0, 0.0)
+        for i in range(SessionTraceRecorder.MAX_EVENTS + 5):
+            recorder.addEvent(float(i), "event")
+        self.assertEqual(recorder.getSampleCount(), SessionTraceRecorder.MAX_SAMPLES)
+        self.assertEqual(recorder.droppedSamples, 5)
+        self.assertEqual(recorder.getEventCount(), SessionTraceRecorder.MAX_EVENTS)
+
+
+class LttbIndicesTest(unittest.TestCase):
+    def testFewPointsAreKept(self):
+        xs = list(range(10))
+        self.assertEqual(lttbIndices(xs, xs, 10), list(range(10)))
+        self.assertEqual(lttbIndices(xs, xs, 20), list(range(10)))
+        # below 3 points there is nothing to choose from
+        self.assertEqual(lttbIndices(xs, xs, 2), list(range(10)))
+        self.assertEqual(lttbIndices([], [], 5), [])
+
+    def testThresholdPointsIncludingFirstAndLast(self):
+        xs = [i * 0.5 for i in range(1001)]
+        ys = [math.sin(x / 10.0) for x in xs]
+        indices = lttbIndices(xs, ys, 50)
+        self.assertEqual(len(indices), 50)
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], 1000)
+        self.assertEqual(indices, sorted(set(indices)))
+
+    def testSpikeIsKept(self):
+        xs = list(range(200))
+        ys = [0.0] * 200
+        ys[123] = 50.0
+        self.assertIn(123, lttbIndices(xs, ys, 10))
+
+
+if __name__ == "__main__":
+    unittest.main()